@@ -1,14 +1,46 @@
-from sqlalchemy import create_engine, Column, Integer, String, Float, Date, ForeignKey
+from sqlalchemy import create_engine, event, inspect, Column, Index, Integer, String, Float, Date, ForeignKey, insert, literal, select, text
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, relationship
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 import os
 
 # 获取当前文件所在目录
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-# 数据库文件路径
-DB_PATH = os.path.join(BASE_DIR, "data", "logistics.db")
+# 数据库文件路径（基准测试等场景可以指向其他文件）
+DB_PATH = os.getenv("DB_PATH", os.path.join(BASE_DIR, "data", "logistics.db"))
 
-# 创建数据库引擎
+# 并发模式：wal 使用 WAL 日志，查询使用只读连接，导入写入时查询不需要等待；
+# legacy 保持 SQLite 默认的回滚日志和连接设置
+DB_CONCURRENCY_MODE = os.getenv("DB_CONCURRENCY_MODE", "wal")
+WAL_MODE = DB_CONCURRENCY_MODE == "wal"
+# WAL 模式下的连接参数：同步级别、每个连接的页缓存（KB）、内存映射大小（字节）、等待锁的毫秒数
+DB_SYNCHRONOUS = os.getenv("DB_SYNCHRONOUS", "NORMAL")
+DB_CACHE_SIZE_KB = int(os.getenv("DB_CACHE_SIZE_KB", "16384"))
+DB_MMAP_SIZE = int(os.getenv("DB_MMAP_SIZE", str(256 * 1024 * 1024)))
+DB_BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS", "5000"))
+
+# 每个新连接执行的 PRAGMA
+CONNECTION_PRAGMAS = (
+    f"PRAGMA synchronous={DB_SYNCHRONOUS}",
+    f"PRAGMA cache_size=-{DB_CACHE_SIZE_KB}",
+    f"PRAGMA mmap_size={DB_MMAP_SIZE}",
+    f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}",
+)
+
+def _apply_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    for pragma in CONNECTION_PRAGMAS:
+        cursor.execute(pragma)
+    cursor.close()
+
+def _readonly_url(driver: str) -> str:
+    """只读连接的地址；legacy 模式下与写连接相同"""
+    if WAL_MODE:
+        return f"{driver}:///file:{DB_PATH}?mode=ro&uri=true"
+    return f"{driver}:///{DB_PATH}"
+
+# 创建数据库引擎（写入和启动时的数据补充使用）
 SQLALCHEMY_DATABASE_URL = f"sqlite:///{DB_PATH}"
 engine = create_engine(
     SQLALCHEMY_DATABASE_URL, 
@@ -18,6 +50,31 @@ engine = create_engine(
 # 创建会话工厂
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# 只读的同步引擎，在线程中批量读取数据（趋势、统计快照）时使用
+read_engine = create_engine(_readonly_url("sqlite"), connect_args={"check_same_thread": False})
+
+# 异步连接池的常驻连接数和允许临时增加的连接数
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_POOL_OVERFLOW = int(os.getenv("DB_POOL_OVERFLOW", "10"))
+
+# 创建异步数据库引擎，供 async 接口的查询使用，查询期间不阻塞事件循环
+# （aiosqlite 对文件数据库默认不复用连接，这里显式使用连接池）。
+# WAL 模式下为只读连接，读取的是最近一次提交的数据，不会等待正在进行的写事务
+ASYNC_DATABASE_URL = _readonly_url("sqlite+aiosqlite")
+async_engine = create_async_engine(
+    ASYNC_DATABASE_URL,
+    poolclass=AsyncAdaptedQueuePool,
+    pool_size=DB_POOL_SIZE,
+    max_overflow=DB_POOL_OVERFLOW,
+)
+
+if WAL_MODE:
+    for _engine in (engine, read_engine, async_engine.sync_engine):
+        event.listen(_engine, "connect", _apply_pragmas)
+
+# 创建异步会话工厂
+AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+
 # 创建基类
 Base = declarative_base()
 
@@ -34,23 +91,188 @@ class Shipment(Base):
     total_price = Column(Float)
     quantity = Column(Integer)
     unit = Column(String)
-    raw_goods = Column(String)
+    raw_goods = Column(String, index=True)
+    # 行政区划代码（与 province/city/area 一一对应，无法解析时为空字符串）
+    province_code = Column(String)
+    city_code = Column(String)
+    area_code = Column(String)
+    # 行内容指纹（日期、地址、货物、件数、价格及相同内容的出现序号），用于跳过重复导入的行。
+    # 同时作为批量插入的哨兵列；旧表补充的该列由启动时的 backfill_fingerprints 填充
+    fingerprint = Column(String, nullable=False, insert_sentinel=True)
     
     # 关系
     items = relationship("ShipmentItem", back_populates="shipment")
 
+    __table_args__ = (
+        # 按地区分页时沿 (代码, 日期, id) 顺序读取；索引同时包含价格和件数，
+        # 按地区和日期范围统计单价时只读索引，不读取整行运单
+        Index("ix_shipments_province_code_date_id", "province_code", "shipping_date", "id", "total_price", "quantity"),
+        Index("ix_shipments_city_code_date_id", "city_code", "shipping_date", "id", "total_price", "quantity"),
+        Index("ix_shipments_area_code_date_id", "area_code", "shipping_date", "id", "total_price", "quantity"),
+        Index("ix_shipments_fingerprint", "fingerprint", unique=True),
+    )
+
 class ShipmentItem(Base):
     """运单货物项表"""
     __tablename__ = "shipment_items"
 
     id = Column(Integer, primary_key=True, index=True)
-    shipment_id = Column(Integer, ForeignKey("shipments.id"))
+    shipment_id = Column(Integer, ForeignKey("shipments.id"), index=True)
     goods_type = Column(String, index=True)  # A/B/C/其他
+    goods_type_id = Column(Integer, ForeignKey("goods_types.id"))  # 标准货物类型，未归类的货物为空
     quantity = Column(Integer)
     
     # 关系
     shipment = relationship("Shipment", back_populates="items")
 
+    __table_args__ = (
+        Index("ix_shipment_items_goods_type_id_shipment", "goods_type_id", "shipment_id"),
+    )
+
+class GoodsType(Base):
+    """标准货物类型字典表"""
+    __tablename__ = "goods_types"
+
+    id = Column(Integer, primary_key=True)
+    name = Column(String, unique=True, nullable=False)
+
+class GoodsRule(Base):
+    """货物分类规则表
+
+    货物名称中包含 keyword 时归入 goods_type_id 对应的类型，同时命中多条规则时 priority 小的优先。
+    新增货物类型只需在字典表和规则表中添加数据。
+    """
+    __tablename__ = "goods_rules"
+
+    keyword = Column(String, primary_key=True)
+    goods_type_id = Column(Integer, ForeignKey("goods_types.id"), nullable=False)
+    priority = Column(Integer, nullable=False)
+
+# 默认的货物分类规则：(货物类型, 关键字, 优先级)
+# “半电动”同时包含“电动”，按优先级归为全电动
+DEFAULT_GOODS_RULES = [
+    ('全电动', '全电动', 1),
+    ('全电动', '电动', 1),
+    ('配重', '配重', 2),
+    ('前移', '前移', 3),
+    ('大金刚', '大金刚', 4),
+    ('小金刚', '小金刚', 5),
+    ('半电动', '半电动', 6),
+]
+
+class SearchTerm(Base):
+    """搜索词典表
+
+    记录运单中出现过的每个不重复的省、市、区县、货物类型和原始货物名称。
+    子串查询先在这张小表中找出匹配的值，再用索引按值查询运单。
+    """
+    __tablename__ = "search_terms"
+
+    field = Column(String, primary_key=True)  # province/city/area/goods_type/raw_goods
+    value = Column(String, primary_key=True)
+
+class PriceStat(Base):
+    """单价汇总表
+
+    按（行政区划代码，货物类型）累计单价的数量、总和、平方和、最值和分位数草图，
+    导入运单时在同一事务中增量更新。goods_type 为空字符串表示全部货物。
+    """
+    __tablename__ = "price_stats"
+
+    region_code = Column(String, primary_key=True)
+    goods_type = Column(String, primary_key=True)
+    count = Column(Integer, nullable=False)
+    total = Column(Float, nullable=False)
+    total_sq = Column(Float, nullable=False)
+    min_price = Column(Float)
+    max_price = Column(Float)
+    sketch = Column(String)  # 分位数草图（JSON）
+
+class DataVersion(Base):
+    """数据版本表
+
+    只有一行，记录运单数据的版本号。影响查询结果的写入在同一事务中递增版本号，
+    各个工作进程按它判断缓存的查询结果是否过期。goods_generation 是货物类型和分类规则的版本号，
+    由 goods_types、goods_rules 表上的触发器递增，各进程据此重新加载货物分类器。
+    """
+    __tablename__ = "data_version"
+
+    id = Column(Integer, primary_key=True)
+    generation = Column(Integer, nullable=False)
+    goods_generation = Column(Integer)
+
+# 货物类型和分类规则有变化时递增版本号的触发器
+GOODS_VERSION_TABLES = ('goods_types', 'goods_rules')
+
+def _create_goods_version_triggers(conn):
+    """在货物类型和分类规则表上创建触发器，直接修改表中的数据也会使各进程重新加载分类器"""
+    for table in GOODS_VERSION_TABLES:
+        for operation in ('INSERT', 'UPDATE', 'DELETE'):
+            conn.execute(text(
+                f"CREATE TRIGGER IF NOT EXISTS {table}_{operation.lower()}_version AFTER {operation} ON {table} "
+                "BEGIN UPDATE data_version SET generation = generation + 1, "
+                "goods_generation = COALESCE(goods_generation, 0) + 1; END"
+            ))
+
+# 加入搜索词典的字段
+SEARCH_TERM_COLUMNS = {
+    'province': Shipment.province,
+    'city': Shipment.city,
+    'area': Shipment.area,
+    'raw_goods': Shipment.raw_goods,
+    'goods_type': ShipmentItem.goods_type,
+}
+
+def _backfill_search_terms(conn):
+    """根据已有的运单数据补建搜索词典"""
+    if conn.execute(select(SearchTerm.field).limit(1)).first() is not None:
+        return
+    for field, column in SEARCH_TERM_COLUMNS.items():
+        values = select(literal(field), column).where(column.isnot(None)).distinct()
+        conn.execute(insert(SearchTerm).prefix_with("OR IGNORE").from_select(['field', 'value'], values))
+
+def _seed_goods_rules(conn):
+    """货物类型字典为空时写入默认的分类规则"""
+    if conn.execute(select(GoodsType.id).limit(1)).first() is not None:
+        return
+    type_ids = {}
+    for name, keyword, priority in DEFAULT_GOODS_RULES:
+        if name not in type_ids:
+            type_ids[name] = conn.execute(insert(GoodsType).values(name=name)).inserted_primary_key[0]
+        conn.execute(insert(GoodsRule).values(keyword=keyword, goods_type_id=type_ids[name], priority=priority))
+
+def _add_missing_columns(conn):
+    """为已有的表补充新增的列（SQLite 只支持逐列 ADD COLUMN）"""
+    inspector = inspect(conn)
+    for table in Base.metadata.sorted_tables:
+        existing = {column['name'] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in existing:
+                column_type = column.type.compile(dialect=conn.dialect)
+                conn.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'))
+
+# 已被其他索引取代的索引，启动时删除
+OBSOLETE_INDEXES = (
+    'ix_shipments_province_code_date',
+    'ix_shipments_city_code_date',
+    'ix_shipments_area_code_date',
+)
+
 # 创建所有表
 def init_db():
-    Base.metadata.create_all(bind=engine) 
\ No newline at end of file
+    # 日志模式保存在数据库文件中，只读连接打开前由写连接设置
+    with engine.connect() as conn:
+        conn.exec_driver_sql(f"PRAGMA journal_mode={'WAL' if WAL_MODE else 'DELETE'}")
+    Base.metadata.create_all(bind=engine)
+    with engine.begin() as conn:
+        _add_missing_columns(conn)
+        # 为已有的表补建新增的索引
+        for table in Base.metadata.sorted_tables:
+            for index in table.indexes:
+                index.create(bind=conn, checkfirst=True)
+        for name in OBSOLETE_INDEXES:
+            conn.execute(text(f'DROP INDEX IF EXISTS {name}'))
+        _backfill_search_terms(conn)
+        _seed_goods_rules(conn)
+        conn.execute(insert(DataVersion).prefix_with("OR IGNORE").values(id=1, generation=0, goods_generation=0))
+        _create_goods_version_triggers(conn) 
\ No newline at end of file
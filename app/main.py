@@ -1,19 +1,33 @@
-from fastapi import FastAPI, UploadFile, File, HTTPException, Request, BackgroundTasks, Form
+from fastapi import FastAPI, UploadFile, File, HTTPException, Request, BackgroundTasks, Form, Body, Query
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import HTMLResponse
+from fastapi.responses import HTMLResponse, PlainTextResponse, StreamingResponse
 from fastapi.templating import Jinja2Templates
-import pandas as pd
+from datetime import date
 from typing import List, Optional
 import os
-from io import BytesIO
 from . import database
-from .services import excel_service, price_service
+from .services import (
+    backup_service, cache, export_service, goods_service, job_service, metrics, parallel, price_service, quote_service, region_service,
+    shipment_writer, staging_service, stats_service, suggest_service, write_queue,
+)
+from .services.startup import startup_timer
+
+startup_timer.mark('imported')
 
 # 初始化数据库
 database.init_db()
+# 读取一次数据版本号，之后查询时按间隔在线程中重新读取
+cache.data_generation.refresh()
+startup_timer.mark('database_ready')
 
 app = FastAPI(title="物流价格查询系统")
 
+# 记录请求耗时和每个请求的数据库查询数
+app.add_middleware(metrics.MetricsMiddleware)
+metrics.instrument_engine(database.engine)
+metrics.instrument_engine(database.read_engine)
+metrics.instrument_engine(database.async_engine.sync_engine)
+
 # 获取当前文件所在目录
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 # 静态文件目录
@@ -26,8 +40,8 @@ UPLOAD_PASSWORD = os.getenv("UPLOAD_PASSWORD", "default_password")
 app.mount("/static", StaticFiles(directory=STATIC_DIR), name="static")
 templates = Jinja2Templates(directory=STATIC_DIR)
 
-# 存储待处理的DataFrame
-pending_dfs = {}
+# 上传文件每次读取的字节数
+UPLOAD_READ_SIZE = 1024 * 1024
 
 @app.post("/upload")
 async def upload_excel(file: UploadFile = File(...), password: str = Form(...)):
@@ -38,33 +52,54 @@ async def upload_excel(file: UploadFile = File(...), password: str = Form(...)):
             raise HTTPException(status_code=401, detail="密码错误")
         
         # 检查文件类型
-        if not file.filename.endswith(('.xlsx', '.xls')):
+        if not file.filename.endswith(staging_service.UPLOAD_SUFFIXES):
             raise HTTPException(status_code=400, detail="只支持 .xlsx 或 .xls 格式的文件")
         
-        # 读取Excel文件
+        # 把上传的文件分块写入暂存区，不在内存中保留整个文件
+        store = staging_service.staging_store
+        suffix = os.path.splitext(file.filename)[1]
+        task_id, path = store.new_upload(suffix)
         try:
-            contents = await file.read()
-            df = pd.read_excel(BytesIO(contents), skiprows=1)
-            print(f"Excel文件读取成功，列名: {df.columns.tolist()}")
-        except Exception as e:
-            print(f"Excel文件读取失败: {str(e)}")
-            raise HTTPException(status_code=400, detail=f"Excel文件读取失败: {str(e)}")
+            size = 0
+            with open(path, "wb") as spool:
+                while True:
+                    chunk = await file.read(UPLOAD_READ_SIZE)
+                    if not chunk:
+                        break
+                    size += len(chunk)
+                    store.check_size(size)
+                    spool.write(chunk)
+        except staging_service.StagingFull as e:
+            store.discard(path)
+            raise HTTPException(status_code=413, detail=str(e))
+        except Exception:
+            store.discard(path)
+            raise
         finally:
             # 确保文件被关闭
             await file.close()
+
+        # 只读取表头，检查必要的列是否存在（pandas 导入较慢，第一次上传时才加载）
+        from .services import excel_service
+        try:
+            try:
+                columns = excel_service.read_excel_columns(path)
+                print(f"Excel文件读取成功，列名: {columns}")
+            except Exception as e:
+                print(f"Excel文件读取失败: {str(e)}")
+                raise HTTPException(status_code=400, detail=f"Excel文件读取失败: {str(e)}")
+
+            missing_columns = [col for col in excel_service.REQUIRED_COLUMNS if col not in columns]
+            if missing_columns:
+                print(f"缺少必要的列: {missing_columns}")
+                print(f"实际的列: {columns}")
+                raise HTTPException(status_code=400, detail=f"Excel文件格式不正确，缺少以下列：{', '.join(missing_columns)}")
+        except HTTPException:
+            store.discard(path)
+            raise
         
-        # 检查必要的列是否存在
-        required_columns = ['日期', '品名', '件数', '地址', '价格']
-        missing_columns = [col for col in required_columns if col not in df.columns]
-        if missing_columns:
-            print(f"缺少必要的列: {missing_columns}")
-            print(f"实际的列: {df.columns.tolist()}")
-            raise HTTPException(status_code=400, detail=f"Excel文件格式不正确，缺少以下列：{', '.join(missing_columns)}")
-        
-        # 生成一个唯一的任务ID
-        task_id = str(len(pending_dfs))
-        # 存储DataFrame
-        pending_dfs[task_id] = df
+        # 文件进入暂存区，等待解析
+        store.commit(path)
         
         return {"message": "文件已接收，开始解析数据", "task_id": task_id}
             
@@ -76,22 +111,14 @@ async def upload_excel(file: UploadFile = File(...), password: str = Form(...)):
 
 @app.post("/parse/{task_id}")
 async def parse_excel(task_id: str):
-    """解析Excel数据"""
+    """解析Excel数据（在后台任务中执行，立即返回任务ID）"""
     try:
-        if task_id not in pending_dfs:
+        path = staging_service.staging_store.claim(task_id)
+        if path is None:
             raise HTTPException(status_code=404, detail="未找到待处理的数据")
         
-        df = pending_dfs[task_id]
-        
-        # 处理Excel数据
-        try:
-            await excel_service.process_excel(df)
-            # 处理完成后删除数据
-            del pending_dfs[task_id]
-            return {"message": "数据添加成功"}
-        except Exception as e:
-            print(f"数据处理失败: {str(e)}")
-            raise HTTPException(status_code=400, detail=f"数据处理失败: {str(e)}")
+        job = job_service.submit_ingest(path)
+        return {"message": "已开始解析数据", "job_id": job.id}
             
     except HTTPException:
         raise
@@ -99,13 +126,218 @@ async def parse_excel(task_id: str):
         print(f"服务器错误: {str(e)}")
         raise HTTPException(status_code=500, detail=f"服务器错误: {str(e)}")
 
+@app.get("/jobs")
+async def list_jobs():
+    """查询所有导入任务"""
+    return job_service.list_jobs()
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    """查询导入任务的进度"""
+    job = job_service.get_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="未找到导入任务")
+    return job.to_dict()
+
 @app.get("/search")
 async def search(location: str, goods_type: Optional[str] = None):
     """查询物流价格"""
     try:
-        return await price_service.search_prices(location, goods_type)
+        result = await price_service.search_prices(location, goods_type)
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
+    if startup_timer.mark('first_search'):
+        print(startup_timer.summary())
+    return result
+
+@app.get("/suggest")
+async def suggest(q: str, limit: int = suggest_service.SUGGEST_LIMIT):
+    """地点自动补全：返回名称以输入内容开头的省、市、区县，按运单数排序"""
+    return await suggest_service.suggest_locations(q, limit)
+
+@app.get("/shipments")
+async def list_shipments(location: Optional[str] = None, goods_type: Optional[str] = None,
+                         cursor: Optional[str] = None, limit: int = price_service.PAGE_SIZE):
+    """按日期从新到旧分页列出运单，翻页时传入上一页返回的 next_cursor"""
+    try:
+        return await price_service.list_shipments(location, goods_type, cursor, limit)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@app.get("/trend")
+async def trend(location: Optional[str] = None, goods_type: List[str] = Query([]), period: str = 'month',
+                months: int = 12):
+    """单价趋势：按周或按月统计最近若干个月的单价中位数和 p90，可以传入多个货物类型"""
+    # NumPy 导入较慢，第一次查询趋势时才加载
+    from .services import trend_service
+    try:
+        return await trend_service.price_trend(location, goods_type, period, months)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@app.get("/pivot")
+async def pivot(by: str = 'province', start: Optional[date] = None, end: Optional[date] = None):
+    """单价透视表：按省或市 × 标准货物类型汇总数量、平均和中位单价，只读取统计快照"""
+    # NumPy 导入较慢，第一次查询时才加载
+    from .services import analytics_service
+    try:
+        return await analytics_service.price_pivot(by, start, end)
+    except analytics_service.SnapshotUnavailable as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@app.get("/export")
+async def export_shipments(location: Optional[str] = None, goods_type: Optional[str] = None, format: str = 'csv'):
+    """以 CSV 或 NDJSON 格式流式导出匹配的运单"""
+    if format not in export_service.EXPORT_FORMATS:
+        raise HTTPException(status_code=400, detail=f"只支持以下导出格式：{', '.join(export_service.EXPORT_FORMATS)}")
+    return StreamingResponse(
+        export_service.export_shipments(location, goods_type, format),
+        media_type=export_service.EXPORT_FORMATS[format],
+        headers={'Content-Disposition': f'attachment; filename="shipments.{format}"'},
+    )
+
+@app.post("/quote")
+async def quote(locations: List[str] = Body(...), goods_types: List[str] = Body([])):
+    """批量报价：返回多个目的地 × 多个货物类型的价格矩阵"""
+    try:
+        return await quote_service.quote_matrix(locations, goods_types)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@app.post("/quote/upload")
+async def quote_upload(file: UploadFile = File(...), goods_types: str = Form('')):
+    """批量报价：目的地来自上传的表格，货物类型用逗号分隔"""
+    try:
+        data = await file.read(quote_service.MAX_QUOTE_SHEET_BYTES + 1)
+        locations = quote_service.read_locations(data, file.filename)
+        return await quote_service.quote_matrix(locations, goods_types.replace('，', ',').split(','))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    finally:
+        await file.close()
+
+@app.get("/backup")
+async def backup_status():
+    """数据库备份的状态、进度、最近一次备份的耗时和已保留的备份"""
+    return backup_service.backup_manager.status()
+
+@app.post("/backup", status_code=202)
+async def start_backup(password: str = Form(...)):
+    """在后台开始一次数据库在线备份"""
+    if password != UPLOAD_PASSWORD:
+        raise HTTPException(status_code=401, detail="密码错误")
+    if not backup_service.backup_manager.start():
+        raise HTTPException(status_code=409, detail="已有备份正在进行")
+    return backup_service.backup_manager.status()
+
+def _cache_infos():
+    """各个缓存的命中统计"""
+    return {
+        'search': price_service.search_cache_info(),
+        'address': region_service.get_region_service().cache_info(),
+        'goods': goods_service.get_goods_classifier().cache_info(),
+    }
+
+@app.get("/cache/stats")
+async def cache_stats():
+    """查询结果缓存、地址解析缓存和货物分类缓存的命中统计"""
+    return _cache_infos()
+
+def _cache_hit_ratios():
+    ratios = {}
+    for name, info in _cache_infos().items():
+        lookups = info['hits'] + info['misses']
+        ratios[(name,)] = info['hits'] / lookups if lookups else 0.0
+    return ratios
+
+def _job_counts():
+    counts = {(status,): 0 for status in job_service.JOB_STATUSES}
+    for job in job_service.list_jobs():
+        counts[(job['status'],)] += 1
+    return counts
+
+def _last_backup_duration():
+    last = backup_service.backup_manager.status()['last']
+    if last is None or last['status'] != backup_service.BACKUP_SUCCEEDED:
+        return {}
+    return {(): last['duration']}
+
+# 取值时才计算的指标：缓存、暂存区、导入任务、写入队列和备份
+for name, documentation, field in (
+    ('logistics_cache_hits_total', "缓存命中次数", 'hits'),
+    ('logistics_cache_misses_total', "缓存未命中次数", 'misses'),
+    ('logistics_cache_entries', "缓存条目数", 'size'),
+):
+    metrics.registry.register(metrics.GaugeFunc(
+        name, documentation,
+        lambda field=field: {(cache,): info[field] for cache, info in _cache_infos().items()},
+        ('cache',), 'gauge' if field == 'size' else 'counter',
+    ))
+metrics.registry.register(metrics.GaugeFunc(
+    'logistics_cache_hit_ratio', "缓存命中率（启动以来）", _cache_hit_ratios, ('cache',)))
+metrics.registry.register(metrics.GaugeFunc(
+    'logistics_staging_files', "暂存区中等待解析的文件数",
+    lambda: {(): staging_service.staging_store.info()['files']}))
+metrics.registry.register(metrics.GaugeFunc(
+    'logistics_staging_bytes', "暂存区中等待解析的文件总字节数",
+    lambda: {(): staging_service.staging_store.info()['bytes']}))
+metrics.registry.register(metrics.GaugeFunc(
+    'logistics_staging_max_bytes', "暂存区容量上限（字节）",
+    lambda: {(): staging_service.staging_store.max_bytes}))
+metrics.registry.register(metrics.GaugeFunc(
+    'logistics_ingest_jobs', "保留的导入任务数，按状态分类", _job_counts, ('status',)))
+metrics.registry.register(metrics.GaugeFunc(
+    'logistics_write_queue_pending', "写入队列中排队和正在执行的写入操作数",
+    lambda: {(): write_queue.write_queue.pending}))
+metrics.registry.register(metrics.GaugeFunc(
+    'logistics_backup_last_success_timestamp', "最近一次成功备份的完成时间（Unix 时间戳）",
+    lambda: {(): backup['created_at'] for backup in backup_service.backup_manager.backups()[:1]}))
+metrics.registry.register(metrics.GaugeFunc(
+    'logistics_backup_last_duration_seconds', "本进程最近一次备份的耗时（秒）", _last_backup_duration))
+metrics.registry.register(metrics.GaugeFunc(
+    'logistics_startup_phase_seconds', "从进程启动到各阶段完成的秒数",
+    lambda: {(phase,): seconds for phase, seconds in startup_timer.report()['phases'].items()}, ('phase',)))
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    """Prometheus 格式的运行指标"""
+    return PlainTextResponse(metrics.registry.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/startup")
+async def startup_report():
+    """启动耗时：从进程启动到各阶段完成的秒数，以及各步骤的耗时"""
+    return startup_timer.report()
+
+def _update_analytics_snapshot():
+    """补充历史数据后刷新统计快照（NumPy 导入较慢，在后台线程中才加载）"""
+    from .services import analytics_service
+    analytics_service.update_snapshot()
+
+@app.on_event("startup")
+def startup():
+    """在后台为历史运单补充行政区划代码、指纹、标准货物类型和价格汇总，然后刷新统计快照；
+    配置了自动备份间隔时开始定时备份"""
+    startup_timer.mark('app_started')
+    print(startup_timer.summary())
+    backfills = [
+        job_service.run_in_background(backfill)
+        for backfill in (
+            shipment_writer.backfill_region_codes,
+            shipment_writer.backfill_fingerprints,
+            goods_service.backfill_goods_types,
+            stats_service.backfill_price_stats,
+        )
+    ]
+    # 刷新快照只读取数据，不占用写入队列
+    job_service.run_readonly_in_background(_update_analytics_snapshot, after=backfills)
+    backup_service.backup_manager.start_schedule()
+
+@app.on_event("shutdown")
+def shutdown():
+    """关闭并行处理的进程池"""
+    parallel.shutdown()
 
 @app.get("/", response_class=HTMLResponse)
 async def read_root(request: Request):
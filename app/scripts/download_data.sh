@@ -6,6 +6,18 @@ PROJECT_ROOT="$(dirname "$SCRIPT_DIR")"  # 只上移一层
 DATA_DIR="$PROJECT_ROOT/data"
 DB_FILE="$DATA_DIR/china.db"
 TEMP_DB_FILE="$DATA_DIR/china.db.tmp"
+SNAPSHOT_FILE="$DATA_DIR/china.snapshot"
+
+# 生成行政区划索引快照，服务启动时直接加载，不再从数据库构建索引
+build_snapshot() {
+    if [ -f "$SNAPSHOT_FILE" ] && [ "$SNAPSHOT_FILE" -nt "$DB_FILE" ]; then
+        return 0
+    fi
+    if (cd "$(dirname "$PROJECT_ROOT")" && python -m app.services.region_index); then
+        return 0
+    fi
+    echo "警告：生成行政区划快照失败，服务启动时将从数据库构建索引"
+}
 
 # 检查当前的DB_FILE路径
 echo "Current DB_FILE path is: ' $DB_FILE ' ."
@@ -18,6 +30,7 @@ if [ -f "$DB_FILE" ] && [ -s "$DB_FILE" ]; then
     # 验证现有数据库文件是否有效
     if sqlite3 "$DB_FILE" "SELECT 1;" >/dev/null 2>&1; then
         echo "行政区划数据库文件已存在且有效，跳过下载。"
+        build_snapshot
         exit 0
     else
         echo "警告：现有行政区划数据库文件可能已损坏，将重新下载..."
@@ -37,6 +50,7 @@ if curl -L "https://raw.githubusercontent.com/modood/Administrative-divisions-of
             # 设置适当的权限
             chmod 644 "$DB_FILE"
             echo "下载完成！行政区划数据库文件验证成功。"
+            build_snapshot
         else
             echo "错误：下载的行政区划数据库文件不是有效的SQLite数据库"
             rm -f "$TEMP_DB_FILE"
@@ -0,0 +1,449 @@
+"""
+统计快照服务
+
+把运单和货物项中统计需要的几列导出为按列存放的 NumPy 文件（.npy），查询时以内存映射方式打开，
+看板类的汇总查询只读快照文件，不访问正在写入的数据库。
+
+快照目录中每个数据段是一个子目录，每列一个文件；manifest.json 记录当前有效的数据段、
+地区和货物类型字典。导入任务完成后只把新增的运单追加为新数据段，数据段过多时合并为一个；
+历史运单的地区代码或货物类型被补充后整体重建。manifest.json 先写临时文件再替换，
+多个进程同时刷新时用文件锁串行执行。
+
+NumPy 导入较慢，本模块在第一次刷新快照或查询时才导入。
+"""
+import asyncio
+import fcntl
+import json
+import os
+import shutil
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import date
+from typing import Any, Dict, List, Optional, Tuple
+import numpy as np
+from sqlalchemy import func, select
+from ..database import DB_PATH, WAL_MODE, GoodsType, Shipment, ShipmentItem, read_engine
+from .trend_service import SHIPPING_DATE_TEXT, UNIT_PRICE, group_stats
+
+# 快照目录（默认与数据库文件放在一起）
+ANALYTICS_SNAPSHOT_DIR = os.getenv(
+    "ANALYTICS_SNAPSHOT_DIR", os.path.join(os.path.dirname(os.path.abspath(DB_PATH)), "analytics")
+)
+# 数据段超过该数量时合并为一个
+SNAPSHOT_MAX_SEGMENTS = int(os.getenv("SNAPSHOT_MAX_SEGMENTS", "8"))
+# 生成快照时每次从数据库读取的运单数
+SNAPSHOT_READ_BATCH = int(os.getenv("SNAPSHOT_READ_BATCH", "100000"))
+
+SNAPSHOT_VERSION = 1
+MANIFEST_NAME = 'manifest.json'
+LOCK_NAME = '.lock'
+
+# 运单列：id、发货日期、省和市（地区字典中的序号，没有代码时为 -1）、单价（缺失时为 NaN）
+SHIPMENT_COLUMNS = ('id', 'day', 'province', 'city', 'unit_price')
+# 货物项列：运单 id 和标准货物类型 id（同一运单的同一类型只保留一条）
+ITEM_COLUMNS = ('shipment_id', 'goods_type_id')
+
+# 透视表支持的行维度及对应的快照列
+PIVOT_DIMENSIONS = ('province', 'city')
+# 透视表每个单元格输出的分位数
+PIVOT_QUANTILES = {'median': 0.5}
+
+
+class SnapshotUnavailable(Exception):
+    """统计快照尚未生成"""
+
+
+class ColumnarSnapshot:
+    """已生成的统计快照，各列为只读数组
+
+    只有一个数据段时直接使用内存映射的数组；有多个数据段时各列拼接为一个数组。
+
+    Args:
+        directory: 快照目录
+        manifest: manifest.json 的内容
+    """
+    def __init__(self, directory: str, manifest: Dict[str, Any]):
+        self.manifest = manifest
+        self.regions: List[Tuple[str, str]] = [tuple(region) for region in manifest['regions']]
+        self.goods_types: Dict[int, str] = {int(type_id): name for type_id, name in manifest['goods_types']}
+        segments = [os.path.join(directory, segment['name']) for segment in manifest['segments']]
+        for name in SHIPMENT_COLUMNS + ITEM_COLUMNS:
+            arrays = [np.load(os.path.join(path, f'{name}.npy'), mmap_mode='r') for path in segments]
+            setattr(self, name, arrays[0] if len(arrays) == 1 else np.concatenate(arrays))
+        # 运单按 id 顺序存放，货物项按 id 找到所属运单的位置
+        self.item_rows = np.searchsorted(self.id, self.shipment_id)
+
+    @property
+    def rows(self) -> int:
+        return len(self.id)
+
+    def info(self) -> Dict[str, Any]:
+        """快照的行数、最大运单 id 和生成时间"""
+        return {
+            'rows': self.rows,
+            'max_id': self.manifest['max_id'],
+            'segments': len(self.manifest['segments']),
+            'built_at': self.manifest['built_at'],
+        }
+
+
+def _manifest_path(directory: str) -> str:
+    return os.path.join(directory, MANIFEST_NAME)
+
+
+def read_manifest(directory: str) -> Optional[Dict[str, Any]]:
+    """读取快照目录中的 manifest.json，不存在或版本不符时返回 None"""
+    try:
+        with open(_manifest_path(directory), encoding='utf-8') as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if manifest.get('version') != SNAPSHOT_VERSION:
+        return None
+    return manifest
+
+
+def _write_manifest(directory: str, manifest: Dict[str, Any]):
+    """先写临时文件再替换，读取方不会读到半个文件"""
+    path = _manifest_path(directory)
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False)
+    os.replace(temp_path, path)
+
+
+@contextmanager
+def _snapshot_lock(directory: str):
+    """多个进程刷新同一个快照时串行执行"""
+    with open(os.path.join(directory, LOCK_NAME), 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _encode_regions(codes: List[Optional[str]], names: List[Optional[str]],
+                    regions: List[List[str]], index: Dict[str, int]) -> np.ndarray:
+    """把地区代码编码为地区字典中的序号，新出现的代码追加到字典末尾，没有代码时为 -1"""
+    new_codes = set(codes).difference(index, ('', None))
+    if new_codes:
+        region_names = dict(zip(codes, names))
+        for code in sorted(new_codes):
+            index[code] = len(regions)
+            regions.append([code, region_names[code] or ''])
+    lookup = {**index, '': -1, None: -1}
+    return np.fromiter(map(lookup.__getitem__, codes), dtype=np.int32, count=len(codes))
+
+
+def _read_shipments(conn, after_id: int, regions: List[List[str]]) -> Dict[str, np.ndarray]:
+    """读取 id 大于 after_id 的运单，按 id 分批读取后拼接为各列数组"""
+    index = {code: i for i, (code, _) in enumerate(regions)}
+    batches = []
+    last_id = after_id
+    while True:
+        result = conn.execute(
+            select(Shipment.id, SHIPPING_DATE_TEXT, Shipment.province_code, Shipment.province,
+                   Shipment.city_code, Shipment.city, UNIT_PRICE)
+            .where(Shipment.id > last_id)
+            .order_by(Shipment.id)
+            .limit(SNAPSHOT_READ_BATCH)
+        )
+        try:
+            rows = result.cursor.fetchall()
+        finally:
+            result.close()
+        if not rows:
+            break
+        ids, days, province_codes, provinces, city_codes, cities, prices = zip(*rows)
+        batches.append({
+            'id': np.array(ids, dtype=np.int64),
+            'day': np.array(days, dtype='datetime64[D]'),
+            'province': _encode_regions(province_codes, provinces, regions, index),
+            'city': _encode_regions(city_codes, cities, regions, index),
+            'unit_price': np.array(prices, dtype=np.float64),
+        })
+        last_id = ids[-1]
+    if not batches:
+        return {}
+    return {name: np.concatenate([batch[name] for batch in batches]) for name in SHIPMENT_COLUMNS}
+
+
+def _read_items(conn, after_id: int, max_id: int) -> Dict[str, np.ndarray]:
+    """读取运单 id 在 (after_id, max_id] 之间、已归类的货物项"""
+    result = conn.execute(
+        select(ShipmentItem.shipment_id, ShipmentItem.goods_type_id)
+        .where(ShipmentItem.goods_type_id.isnot(None),
+               ShipmentItem.shipment_id > after_id, ShipmentItem.shipment_id <= max_id)
+        .distinct()
+        .order_by(ShipmentItem.shipment_id)
+    )
+    try:
+        rows = result.cursor.fetchall()
+    finally:
+        result.close()
+    shipment_ids, type_ids = zip(*rows) if rows else ((), ())
+    return {
+        'shipment_id': np.array(shipment_ids, dtype=np.int64),
+        'goods_type_id': np.array(type_ids, dtype=np.int32),
+    }
+
+
+def _source_checks(conn, max_id: int) -> Dict[str, int]:
+    """快照所含运单在数据库中的计数，补充地区代码、货物类型或删除运单后会发生变化"""
+    shipments = conn.execute(
+        select(func.count(), func.count(func.nullif(Shipment.province_code, '')),
+               func.count(func.nullif(Shipment.city_code, '')))
+        .where(Shipment.id <= max_id)
+    ).one()
+    return {
+        'rows': shipments[0],
+        'province_codes': shipments[1],
+        'city_codes': shipments[2],
+        'items': _count_items(conn, 0, max_id),
+    }
+
+
+def _count_items(conn, after_id: int, max_id: int) -> int:
+    """运单 id 在 (after_id, max_id] 之间、已归类的货物项数"""
+    return conn.execute(
+        select(func.count(ShipmentItem.goods_type_id))
+        .where(ShipmentItem.shipment_id > after_id, ShipmentItem.shipment_id <= max_id)
+    ).scalar()
+
+
+def _write_segment(directory: str, columns: Dict[str, np.ndarray]) -> Dict[str, Any]:
+    """把各列写入一个新的数据段目录"""
+    name = f"segment-{uuid.uuid4().hex}"
+    path = os.path.join(directory, name)
+    os.makedirs(path)
+    for column, values in columns.items():
+        np.save(os.path.join(path, f'{column}.npy'), values)
+    ids = columns['id']
+    return {'name': name, 'rows': len(ids), 'items': len(columns['shipment_id']),
+            'max_id': int(ids[-1]) if len(ids) else 0}
+
+
+def _merge_segments(directory: str, segments: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """把多个数据段合并为一个（只读取快照文件，不访问数据库）"""
+    columns = {
+        name: np.concatenate([
+            np.load(os.path.join(directory, segment['name'], f'{name}.npy'), mmap_mode='r')
+            for segment in segments
+        ])
+        for name in SHIPMENT_COLUMNS + ITEM_COLUMNS
+    }
+    return _write_segment(directory, columns)
+
+
+def _remove_unused_segments(directory: str, manifest: Dict[str, Any]):
+    """删除不再被 manifest 引用的数据段
+
+    已经以内存映射方式打开这些文件的进程不受影响，文件在其关闭后才真正释放。
+    """
+    used = {segment['name'] for segment in manifest['segments']}
+    for name in os.listdir(directory):
+        if name.startswith('segment-') and name not in used:
+            shutil.rmtree(os.path.join(directory, name), ignore_errors=True)
+
+
+def refresh_snapshot(directory: str = ANALYTICS_SNAPSHOT_DIR, rebuild: bool = False) -> Dict[str, Any]:
+    """把数据库中新增的运单写入快照
+
+    快照不存在、已包含的运单在数据库中发生了变化或 rebuild 为 True 时整体重建，
+    否则只追加 id 大于快照中最大 id 的运单。
+
+    Returns:
+        rows（快照中的运单数）、added（本次写入的运单数）和 rebuilt（是否整体重建）
+    """
+    os.makedirs(directory, exist_ok=True)
+    with _snapshot_lock(directory):
+        manifest = None if rebuild else read_manifest(directory)
+        with read_engine.connect() as conn:
+            if WAL_MODE:
+                # 在一个读事务中读取，各查询看到同一时刻的数据，且不阻塞写入
+                conn.exec_driver_sql("BEGIN")
+            if manifest is not None and _source_checks(conn, manifest['max_id']) != manifest['checks']:
+                manifest = None
+            rebuilt = manifest is None
+            if rebuilt:
+                manifest = {
+                    'version': SNAPSHOT_VERSION, 'max_id': 0, 'rows': 0, 'regions': [], 'segments': [],
+                    'checks': {'rows': 0, 'province_codes': 0, 'city_codes': 0, 'items': 0},
+                }
+            after_id = manifest['max_id']
+            columns = _read_shipments(conn, after_id, manifest['regions'])
+            if columns:
+                manifest['max_id'] = int(columns['id'][-1])
+                columns.update(_read_items(conn, after_id, manifest['max_id']))
+                # 已有部分的计数刚核对过，只需加上新读取的运单
+                checks = manifest['checks']
+                checks['rows'] += len(columns['id'])
+                checks['province_codes'] += int(np.count_nonzero(columns['province'] >= 0))
+                checks['city_codes'] += int(np.count_nonzero(columns['city'] >= 0))
+                checks['items'] += _count_items(conn, after_id, manifest['max_id'])
+            manifest['goods_types'] = [list(row) for row in conn.execute(select(GoodsType.id, GoodsType.name))]
+
+        if columns:
+            manifest['segments'].append(_write_segment(directory, columns))
+        elif rebuilt:
+            # 没有任何运单时也生成一个空数据段，查询时不需要区分
+            manifest['segments'].append(_write_segment(directory, {
+                'id': np.empty(0, dtype=np.int64),
+                'day': np.empty(0, dtype='datetime64[D]'),
+                'province': np.empty(0, dtype=np.int32),
+                'city': np.empty(0, dtype=np.int32),
+                'unit_price': np.empty(0, dtype=np.float64),
+                'shipment_id': np.empty(0, dtype=np.int64),
+                'goods_type_id': np.empty(0, dtype=np.int32),
+            }))
+        if len(manifest['segments']) > SNAPSHOT_MAX_SEGMENTS:
+            manifest['segments'] = [_merge_segments(directory, manifest['segments'])]
+        added = len(columns['id']) if columns else 0
+        manifest['rows'] += added
+        manifest['built_at'] = time.time()
+        _write_manifest(directory, manifest)
+        _remove_unused_segments(directory, manifest)
+    return {'rows': manifest['rows'], 'added': added, 'rebuilt': rebuilt}
+
+
+def update_snapshot() -> Dict[str, Any]:
+    """导入完成或启动补充数据后刷新快照，出错时只打印错误"""
+    try:
+        result = refresh_snapshot()
+    except Exception as e:
+        print(f"刷新统计快照失败: {str(e)}")
+        return {}
+    if result['rebuilt']:
+        print(f"已根据 {result['rows']} 条运单生成统计快照")
+    return result
+
+
+class SnapshotReader:
+    """按需重新打开快照的读取器
+
+    每次读取时检查 manifest.json 是否被替换，被替换时重新打开各列文件；
+    打开失败（例如数据段刚被其他进程合并删除）时继续使用之前打开的快照。
+
+    Args:
+        directory: 快照目录
+    """
+    def __init__(self, directory: str = ANALYTICS_SNAPSHOT_DIR):
+        self.directory = directory
+        self._snapshot: Optional[ColumnarSnapshot] = None
+        self._signature = None
+        self._lock = threading.Lock()
+
+    def get(self) -> Optional[ColumnarSnapshot]:
+        """当前的快照，尚未生成时返回 None"""
+        try:
+            stat = os.stat(_manifest_path(self.directory))
+        except OSError:
+            return self._snapshot
+        signature = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            if signature != self._signature:
+                manifest = read_manifest(self.directory)
+                try:
+                    if manifest is not None:
+                        self._snapshot = ColumnarSnapshot(self.directory, manifest)
+                        self._signature = signature
+                except (OSError, ValueError) as e:
+                    print(f"打开统计快照失败: {str(e)}")
+            return self._snapshot
+
+
+_snapshot_reader: Optional[SnapshotReader] = None
+_snapshot_reader_lock = threading.Lock()
+
+
+def get_snapshot_reader() -> SnapshotReader:
+    """返回共享的快照读取器"""
+    global _snapshot_reader
+    with _snapshot_reader_lock:
+        if _snapshot_reader is None:
+            _snapshot_reader = SnapshotReader()
+        return _snapshot_reader
+
+
+def _cells(stats: Dict[str, np.ndarray]) -> List[Dict[str, Any]]:
+    columns = {name: stats[name].tolist() for name in ('count', 'average', *PIVOT_QUANTILES)}
+    return [{name: values[i] for name, values in columns.items()} for i in range(len(stats['count']))]
+
+
+def pivot_prices(snapshot: ColumnarSnapshot, by: str = 'province', start: Optional[date] = None,
+                 end: Optional[date] = None) -> Dict[str, Any]:
+    """按省或市和标准货物类型汇总单价的数量、平均值和中位数
+
+    一个运单计入其所在地区的全部货物（total）以及它包含的每种标准货物类型；
+    没有单价或没有对应地区代码的运单不计入。
+
+    Args:
+        snapshot: 统计快照
+        by: province 或 city
+        start: 起始日期（包含），为空时不限
+        end: 结束日期（包含），为空时不限
+
+    Returns:
+        by、goods_types（表头）、rows（按运单数从多到少排列，每行为 code、name、total
+        和 goods：各货物类型的 count、average、median，没有运单时为 None）和 snapshot（快照信息）
+
+    Raises:
+        ValueError: 行维度不正确
+    """
+    if by not in PIVOT_DIMENSIONS:
+        raise ValueError(f"只支持以下行维度：{', '.join(PIVOT_DIMENSIONS)}")
+    regions = getattr(snapshot, by)
+    mask = (regions >= 0) & np.isfinite(snapshot.unit_price)
+    if start is not None:
+        mask &= snapshot.day >= np.datetime64(start, 'D')
+    if end is not None:
+        mask &= snapshot.day <= np.datetime64(end, 'D')
+
+    # 全部货物：按地区分组
+    rows = {}
+    if mask.any():
+        region_keys, total_stats = group_stats(regions[mask], snapshot.unit_price[mask], PIVOT_QUANTILES)
+        for key, cell in zip(region_keys.tolist(), _cells(total_stats)):
+            code, name = snapshot.regions[key]
+            rows[key] = {'code': code, 'name': name, 'total': cell, 'goods': {}}
+
+    # 各货物类型：以 (地区, 货物类型) 为分组，所有类型一次算完
+    type_ids = np.array(sorted(snapshot.goods_types), dtype=np.int32)
+    goods_names = [snapshot.goods_types[type_id] for type_id in type_ids.tolist()]
+    selected = mask[snapshot.item_rows]
+    item_rows = snapshot.item_rows[selected]
+    item_type_ids = snapshot.goods_type_id[selected]
+    type_indexes = np.minimum(np.searchsorted(type_ids, item_type_ids), max(len(type_ids) - 1, 0))
+    # 字典中已不存在的货物类型不计入
+    known = type_ids[type_indexes] == item_type_ids if len(type_ids) else np.zeros(len(item_rows), dtype=bool)
+    if known.any():
+        item_rows, type_indexes = item_rows[known], type_indexes[known]
+        keys = regions[item_rows].astype(np.int64) * len(type_ids) + type_indexes
+        goods_keys, goods_stats = group_stats(keys, snapshot.unit_price[item_rows], PIVOT_QUANTILES)
+        for key, cell in zip(goods_keys.tolist(), _cells(goods_stats)):
+            region, type_index = divmod(key, len(type_ids))
+            rows[region]['goods'][goods_names[type_index]] = cell
+
+    ordered = sorted(rows.values(), key=lambda row: (-row['total']['count'], row['code']))
+    for row in ordered:
+        row['goods'] = {name: row['goods'].get(name) for name in goods_names}
+    return {'by': by, 'goods_types': goods_names, 'rows': ordered, 'snapshot': snapshot.info()}
+
+
+async def price_pivot(by: str = 'province', start: Optional[date] = None,
+                      end: Optional[date] = None) -> Dict[str, Any]:
+    """从统计快照计算单价透视表，在线程中执行，不阻塞事件循环
+
+    Raises:
+        SnapshotUnavailable: 统计快照尚未生成
+        ValueError: 行维度不正确
+    """
+    def compute():
+        snapshot = get_snapshot_reader().get()
+        if snapshot is None:
+            raise SnapshotUnavailable("统计快照尚未生成，请稍后再试")
+        return pivot_prices(snapshot, by, start, end)
+    return await asyncio.to_thread(compute)
@@ -0,0 +1,305 @@
+"""
+数据库在线备份服务
+
+使用 SQLite 的在线备份接口每次复制少量页面，两步之间暂停片刻，备份期间查询和导入照常进行。
+复制完成后把备份文件分块压缩为 .gz，再按保留天数删除旧的备份。
+
+备份在一个读事务中进行：WAL 模式下读事务看到的是开始时刻的数据，导入提交新数据不会使备份重新开始，
+也不会阻塞导入。legacy 模式下读事务会阻塞写入，改为在写入队列中执行，备份期间导入的写入排队等待。
+"""
+import fcntl
+import gzip
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+from ..database import DB_BUSY_TIMEOUT_MS, DB_PATH, WAL_MODE
+from .write_queue import write_queue
+
+# 备份文件存放目录（默认与数据库文件放在一起）
+BACKUP_DIR = os.getenv("BACKUP_DIR", os.path.join(os.path.dirname(os.path.abspath(DB_PATH)), "backups"))
+# 备份文件名前缀
+BACKUP_PREFIX = os.getenv("BACKUP_PREFIX", "logistics_backup")
+# 备份保留的天数（最新的一个备份总是保留）
+BACKUP_RETENTION_DAYS = float(os.getenv("BACKUP_RETENTION_DAYS", "7"))
+# 自动备份的间隔（小时），为 0 时只在调用接口时备份
+BACKUP_INTERVAL_HOURS = float(os.getenv("BACKUP_INTERVAL_HOURS", "0"))
+# 每步复制的页数和两步之间暂停的秒数
+BACKUP_STEP_PAGES = int(os.getenv("BACKUP_STEP_PAGES", "256"))
+BACKUP_STEP_SLEEP = float(os.getenv("BACKUP_STEP_SLEEP", "0.01"))
+# 压缩时每次读取的字节数和压缩级别（级别 1 比默认的 6 快一倍多，文件只大约一成）
+BACKUP_COMPRESS_CHUNK = 1024 * 1024
+BACKUP_COMPRESS_LEVEL = int(os.getenv("BACKUP_COMPRESS_LEVEL", "1"))
+
+BACKUP_SUFFIX = '.db.gz'
+LOCK_NAME = '.lock'
+
+# 备份状态
+BACKUP_IDLE = 'idle'
+BACKUP_RUNNING = 'running'
+BACKUP_SUCCEEDED = 'succeeded'
+BACKUP_FAILED = 'failed'
+
+
+class BackupBusy(Exception):
+    """已有备份正在进行（可能在其他工作进程中）"""
+
+
+def copy_database(source_path: str, target_path: str, step_pages: int = BACKUP_STEP_PAGES,
+                  step_sleep: float = BACKUP_STEP_SLEEP, progress=None) -> int:
+    """用在线备份接口把数据库复制到 target_path，返回复制的页数
+
+    WAL 模式下先在源连接上开启读事务，整个复制过程读取同一时刻的数据；
+    否则其他连接每提交一次，备份就要从头开始，导入期间可能一直无法完成。
+    """
+    if WAL_MODE:
+        source = sqlite3.connect(f"file:{source_path}?mode=ro", uri=True, isolation_level=None)
+    else:
+        source = sqlite3.connect(source_path, isolation_level=None)
+    target = sqlite3.connect(target_path)
+    pages = 0
+    try:
+        source.execute(f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}")
+        if WAL_MODE:
+            source.execute("BEGIN")
+            source.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()
+
+        def on_step(status, remaining, total):
+            nonlocal pages
+            pages = total
+            if progress:
+                progress(total - remaining, total)
+            # 暂停期间释放磁盘和 CPU，查询和导入不必等待整个备份完成
+            if remaining and step_sleep > 0:
+                time.sleep(step_sleep)
+
+        source.backup(target, pages=max(1, step_pages), progress=on_step)
+        if WAL_MODE:
+            source.execute("COMMIT")
+    finally:
+        target.close()
+        source.close()
+    return pages
+
+
+def compress_file(source_path: str, target_path: str, chunk_size: int = BACKUP_COMPRESS_CHUNK,
+                  step_sleep: float = BACKUP_STEP_SLEEP, progress=None) -> int:
+    """把文件分块压缩为 gzip，返回压缩后的字节数
+
+    先写临时文件再改名，目录中不会出现不完整的备份。
+    """
+    total = os.path.getsize(source_path)
+    temp_path = f"{target_path}.tmp"
+    done = 0
+    try:
+        with open(source_path, 'rb') as src, open(temp_path, 'wb') as raw, \
+                gzip.GzipFile(fileobj=raw, mode='wb', compresslevel=BACKUP_COMPRESS_LEVEL) as dst:
+            while True:
+                chunk = src.read(chunk_size)
+                if not chunk:
+                    break
+                dst.write(chunk)
+                done += len(chunk)
+                if progress:
+                    progress(done, total)
+                if step_sleep > 0:
+                    time.sleep(step_sleep)
+        os.replace(temp_path, target_path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    return os.path.getsize(target_path)
+
+
+class BackupManager:
+    """执行备份并记录状态
+
+    同一时间只执行一个备份；多个工作进程共用备份目录时用文件锁互斥。
+
+    Args:
+        db_path: 数据库文件路径
+        backup_dir: 备份文件存放目录
+        prefix: 备份文件名前缀
+        retention_days: 备份保留的天数
+    """
+    def __init__(self, db_path: str = DB_PATH, backup_dir: str = BACKUP_DIR, prefix: str = BACKUP_PREFIX,
+                 retention_days: float = BACKUP_RETENTION_DAYS):
+        self.db_path = db_path
+        self.backup_dir = backup_dir
+        self.prefix = prefix
+        self.retention_days = retention_days
+        self._status = BACKUP_IDLE
+        self._phase: Optional[str] = None
+        self._progress = (0, 0)
+        self._last: Optional[Dict[str, Any]] = None
+        self._lock = threading.Lock()
+        self._scheduler: Optional[threading.Thread] = None
+
+    def _set_progress(self, phase: str, done: int, total: int):
+        with self._lock:
+            self._phase = phase
+            self._progress = (done, total)
+
+    def backups(self) -> List[Dict[str, Any]]:
+        """备份目录中已完成的备份，最新的在前"""
+        try:
+            names = os.listdir(self.backup_dir)
+        except OSError:
+            return []
+        result = []
+        for name in names:
+            if not (name.startswith(self.prefix) and name.endswith(BACKUP_SUFFIX)):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.backup_dir, name))
+            except OSError:
+                continue
+            result.append({'name': name, 'bytes': stat.st_size, 'created_at': stat.st_mtime})
+        return sorted(result, key=lambda backup: backup['created_at'], reverse=True)
+
+    def apply_retention(self, now: Optional[float] = None) -> List[str]:
+        """删除超过保留天数的备份，最新的一个总是保留；返回删除的文件名"""
+        cutoff = (now or time.time()) - self.retention_days * 86400
+        removed = []
+        for backup in self.backups()[1:]:
+            if backup['created_at'] < cutoff:
+                try:
+                    os.remove(os.path.join(self.backup_dir, backup['name']))
+                    removed.append(backup['name'])
+                except OSError as e:
+                    print(f"删除旧备份 {backup['name']} 失败: {str(e)}")
+        return removed
+
+    def _backup(self) -> Dict[str, Any]:
+        """复制、压缩并清理旧备份，返回本次备份的结果"""
+        name = f"{self.prefix}_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+        copy_path = os.path.join(self.backup_dir, f"{name}.db.tmp")
+        target_path = os.path.join(self.backup_dir, f"{name}{BACKUP_SUFFIX}")
+        started = time.time()
+
+        def copy() -> int:
+            return copy_database(
+                self.db_path, copy_path, progress=lambda done, total: self._set_progress('copy', done, total))
+
+        try:
+            pages = copy() if WAL_MODE else write_queue.run(copy)
+            copied = time.time()
+            size = os.path.getsize(copy_path)
+            compressed = compress_file(
+                copy_path, target_path, progress=lambda done, total: self._set_progress('compress', done, total))
+        finally:
+            if os.path.exists(copy_path):
+                os.remove(copy_path)
+        finished = time.time()
+        return {
+            'name': os.path.basename(target_path),
+            'pages': pages,
+            'bytes': size,
+            'compressed_bytes': compressed,
+            'started_at': started,
+            'finished_at': finished,
+            'duration': finished - started,
+            'copy_seconds': copied - started,
+            'compress_seconds': finished - copied,
+            'removed': self.apply_retention(finished),
+        }
+
+    def _claim(self) -> bool:
+        """把状态切换为进行中；已有备份正在进行时返回 False"""
+        with self._lock:
+            if self._status == BACKUP_RUNNING:
+                return False
+            self._status = BACKUP_RUNNING
+            self._phase = None
+            self._progress = (0, 0)
+            return True
+
+    def run(self, claimed: bool = False) -> Dict[str, Any]:
+        """执行一次备份并等待完成
+
+        Args:
+            claimed: 调用方已通过 _claim 把状态切换为进行中
+
+        Raises:
+            BackupBusy: 已有备份正在进行
+        """
+        if not claimed and not self._claim():
+            raise BackupBusy("已有备份正在进行")
+        try:
+            os.makedirs(self.backup_dir, exist_ok=True)
+            with open(os.path.join(self.backup_dir, LOCK_NAME), 'a') as lock_file:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    raise BackupBusy("其他工作进程正在备份")
+                result = {'status': BACKUP_SUCCEEDED, **self._backup()}
+                print(f"数据库备份完成: {result['name']}，耗时 {result['duration']:.1f} 秒")
+        except BackupBusy:
+            with self._lock:
+                self._status = self._last['status'] if self._last else BACKUP_IDLE
+            raise
+        except Exception as e:
+            print(f"数据库备份失败: {str(e)}")
+            result = {'status': BACKUP_FAILED, 'error': str(e), 'finished_at': time.time()}
+        with self._lock:
+            self._status = result['status']
+            self._phase = None
+            self._last = result
+        return result
+
+    def start(self) -> bool:
+        """在后台线程中开始备份，已有备份正在进行时返回 False
+
+        状态在返回前就切换为进行中，紧接着的第二次调用一定返回 False。
+        """
+        if not self._claim():
+            return False
+
+        def run():
+            try:
+                self.run(claimed=True)
+            except BackupBusy as e:
+                print(f"跳过数据库备份: {str(e)}")
+        threading.Thread(target=run, name="db-backup", daemon=True).start()
+        return True
+
+    def start_schedule(self, interval_hours: float = BACKUP_INTERVAL_HOURS):
+        """每隔 interval_hours 小时自动备份一次
+
+        最新的备份距今不到半个间隔时跳过，多个工作进程各自计时也不会重复备份。
+        """
+        if interval_hours <= 0 or self._scheduler is not None:
+            return
+        interval = interval_hours * 3600
+
+        def loop():
+            while True:
+                backups = self.backups()
+                if not backups or time.time() - backups[0]['created_at'] >= interval / 2:
+                    try:
+                        self.run()
+                    except BackupBusy:
+                        pass
+                time.sleep(interval)
+        self._scheduler = threading.Thread(target=loop, name="db-backup-schedule", daemon=True)
+        self._scheduler.start()
+
+    def status(self) -> Dict[str, Any]:
+        """当前状态、进度、最近一次备份的结果和已保留的备份"""
+        with self._lock:
+            status, phase, (done, total), last = self._status, self._phase, self._progress, self._last
+        return {
+            'status': status,
+            'phase': phase,
+            'progress': done / total if total else None,
+            'last': last,
+            'backups': self.backups(),
+            'interval_hours': BACKUP_INTERVAL_HOURS,
+            'retention_days': self.retention_days,
+        }
+
+
+backup_manager = BackupManager()
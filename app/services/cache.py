@@ -0,0 +1,150 @@
+"""
+进程内缓存和数据版本号
+"""
+import asyncio
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional, Tuple
+from sqlalchemy import event, update
+from ..database import DataVersion, read_engine
+
+# 重新读取数据版本号的间隔秒数（其他工作进程的写入最多延迟这么久后使缓存失效）
+GENERATION_REFRESH_INTERVAL = float(os.getenv("GENERATION_REFRESH_INTERVAL", "0.2"))
+
+
+class LRUCache:
+    """线程安全的 LRU 缓存，记录命中与未命中次数
+
+    Args:
+        maxsize: 最多缓存的条目数，不大于 0 时不缓存
+        ttl: 条目的有效秒数，None 表示永不过期
+    """
+    def __init__(self, maxsize: int, ttl: Optional[float] = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data: "OrderedDict[Hashable, Tuple[Optional[float], Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        """查找缓存，未命中或已过期返回 None"""
+        with self._lock:
+            try:
+                expires_at, value = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return None
+            if expires_at is not None and expires_at <= time.monotonic():
+                del self._data[key]
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key: Hashable, value: Any):
+        """写入缓存，超出容量时淘汰最久未使用的条目"""
+        if self.maxsize <= 0:
+            return
+        expires_at = time.monotonic() + self.ttl if self.ttl is not None else None
+        with self._lock:
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        """清空缓存和统计"""
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def info(self) -> Dict[str, int]:
+        """返回缓存统计"""
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'size': len(self._data),
+                'maxsize': self.maxsize,
+            }
+
+
+class Generation:
+    """数据版本号
+
+    版本号保存在数据库的 data_version 表中，由写入在提交前的同一事务中递增，所有工作进程共用。
+    缓存键中带上读取数据前的版本号，任何进程提交写入之后，各进程的查询都使用新的版本号，
+    不会读到提交前缓存的结果。
+
+    同时读取货物类型和分类规则的版本号（goods_value），规则有变化时各进程重新加载货物分类器。
+
+    进程内保存最近读到的值：查询通过 current 取版本号，距上次读取不到 refresh_interval 秒时
+    直接返回，否则在线程中重新读取，事件循环不会等待数据库。本进程提交的写入在提交后立即
+    （在写入线程中）刷新，其他进程的写入最多 refresh_interval 秒后可见。
+
+    Args:
+        refresh_interval: 重新读取版本号的间隔秒数
+    """
+    def __init__(self, refresh_interval: float = GENERATION_REFRESH_INTERVAL):
+        self.refresh_interval = refresh_interval
+        self._value: Optional[int] = None
+        self._goods_value = 0
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def value(self) -> int:
+        """最近读到的版本号（不访问数据库，进程中第一次读取除外）"""
+        if self._value is None:
+            return self.refresh()
+        return self._value
+
+    @property
+    def goods_value(self) -> int:
+        """最近读到的货物类型和分类规则的版本号（不访问数据库，进程中第一次读取除外）"""
+        if self._value is None:
+            self.refresh()
+        return self._goods_value
+
+    async def current(self) -> int:
+        """查询使用的版本号：超过 refresh_interval 秒未读取时在线程中重新读取"""
+        if self._value is not None and time.monotonic() - self._checked_at < self.refresh_interval:
+            return self._value
+        return await asyncio.to_thread(self.refresh, self.refresh_interval)
+
+    def refresh(self, max_age: float = 0.0) -> int:
+        """从数据库读取已提交的版本号
+
+        Args:
+            max_age: 距上次读取不到这么多秒时直接返回（同时过期的多个查询只读取一次）
+        """
+        with self._lock:
+            if self._value is not None and time.monotonic() - self._checked_at < max_age:
+                return self._value
+            with read_engine.connect() as conn:
+                row = conn.exec_driver_sql("SELECT generation, goods_generation FROM data_version").first()
+            value, goods_value = (row[0] or 0, row[1] or 0) if row else (0, 0)
+            self._value = max(value, self._value or 0)
+            self._goods_value = max(goods_value, self._goods_value)
+            self._checked_at = time.monotonic()
+            return self._value
+
+    def bump(self, session):
+        """在 session 的事务中递增版本号，随写入一起提交；提交后刷新本进程的版本号"""
+        session.execute(update(DataVersion).values(generation=DataVersion.generation + 1))
+        event.listen(session, "after_commit", self._after_commit, once=True)
+
+    def _after_commit(self, session):
+        try:
+            self.refresh()
+        except Exception as e:
+            print(f"读取数据版本号失败: {str(e)}")
+
+
+# 运单数据的版本号
+data_generation = Generation()
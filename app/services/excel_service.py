@@ -1,13 +1,56 @@
 import pandas as pd
+import numpy as np
+import os
 import re
-from typing import List, Dict, Any
-from sqlalchemy.orm import Session
-from ..database import SessionLocal, Shipment, ShipmentItem
+import time
+from typing import List, Dict, Any, Callable, Iterator, Optional, Tuple
 from datetime import datetime
-from .region_service import RegionService
+from openpyxl import load_workbook
+from openpyxl.cell.cell import TYPE_ERROR, TYPE_NUMERIC
+from . import metrics, parallel
+from .cache import data_generation
+from .goods_service import get_goods_classifier
+from .region_service import get_region_service
+from .shipment_writer import (
+    INGEST_CHUNK_SIZE, content_digest, find_existing_fingerprints, next_fingerprint,
+    write_shipments,
+)
 
-# 创建地址解析服务实例
-region_service = RegionService()
+# 地址解析服务实例
+region_service = get_region_service()
+
+# 跳过行的原因
+SKIP_REASONS = {
+    'empty_row': '空行',
+    'invalid_value': '数据无法处理',
+    'missing_price': '没有价格',
+    'invalid_price': '价格格式不正确',
+}
+
+# Excel 数字日期的起点（1900 日期系统）及其序数
+EXCEL_EPOCH = np.datetime64('1899-12-30', 'D')
+EXCEL_EPOCH_ORDINAL = 693594
+# datetime.date 支持的序数范围
+MIN_ORDINAL, MAX_ORDINAL = 1, 3652059
+# 超出 C int 范围的序数会导致 OverflowError
+MIN_C_INT, MAX_C_INT = -2 ** 31, 2 ** 31 - 1
+
+# 常见字符：ASCII、CJK 标点、CJK 统一汉字和全角字符
+COMMON_CHARS = r'[\x00-\x7f\u3000-\u303f\u4e00-\u9fff\uff00-\uffef]*'
+
+# 必须存在的列
+REQUIRED_COLUMNS = ['日期', '品名', '件数', '地址', '价格']
+# 流式读取时每批处理的行数
+STREAM_BATCH_SIZE = int(os.getenv("STREAM_BATCH_SIZE", "5000"))
+# 表头之后需要跳过的行数（第一行是合并单元格，第二行是表头）
+SKIP_DATA_ROWS = 2
+# 导入流程的各个阶段：读取、清洗、地址解析、货物解析、写入数据库
+INGEST_STAGES = ('read', 'clean', 'dedupe', 'address', 'goods', 'write')
+# 与 pandas read_excel 默认一致的缺失值字符串
+NA_VALUES = {
+    '', '#N/A', '#N/A N/A', '#NA', '-1.#IND', '-1.#QNAN', '-NaN', '-nan', '1.#IND',
+    '1.#QNAN', '<NA>', 'N/A', 'NA', 'NULL', 'NaN', 'None', 'n/a', 'nan', 'null',
+}
 
 def extract_numbers(text: str) -> int:
     """从文本中提取数字"""
@@ -21,150 +64,422 @@ def parse_goods(goods_name: str) -> List[str]:
     if pd.isna(goods_name):
         return ['其他']
     
-    goods_name = str(goods_name)
-    # 分割复合货物（使用+号分割）
-    goods_list = goods_name.split('+')
-    
-    # 处理每个货物
-    result = []
-    for good in goods_list:
-        good = good.strip()
-        # 检查是否包含特定货物类型
-        if any(keyword in good for keyword in ['全电动', '电动']):
-            result.append('全电动')
-        elif '配重' in good:
-            result.append('配重')
-        elif '前移' in good:
-            result.append('前移')
-        elif '大金刚' in good:
-            result.append('大金刚')
-        elif '小金刚' in good:
-            result.append('小金刚')
-        elif '半电动' in good:
-            result.append('半电动')
-        else:
-            # 保留原始货物名称，方便后续模糊匹配
-            result.append(good)
-    
-    return result
+    # 分割复合货物（使用+号分割），按分类规则识别每个货物的类型
+    return get_goods_classifier().parse_goods(str(goods_name))
+
+def _value_kinds(values: pd.Series) -> pd.Series:
+    """按 Python 类型把一列数据分类为 str / datetime / number / other"""
+    def kind_of(value_type):
+        if issubclass(value_type, str):
+            return 'str'
+        if issubclass(value_type, datetime):
+            return 'datetime'
+        if issubclass(value_type, (int, float)):
+            return 'number'
+        return 'other'
 
-async def process_excel(df: pd.DataFrame):
-    """处理Excel数据并存入数据库"""
-    session = SessionLocal()
+    types = values.map(type)
+    return types.map({value_type: kind_of(value_type) for value_type in types.unique()})
+
+def _parse_date_string(value: str, default):
+    """逐个解析未能批量转换的日期字符串"""
     try:
-        # 跳过前两行（第一行是合并单元格，第二行是表头）
-        df = df.iloc[2:]
-
-        # 处理每一行数据
-        for _, row in df.iterrows():
-            try:
-                # 检查是否为空行
-                if row.isna().all():
-                    continue  # 跳过完全为空的行
-
-                # 处理日期（使用'日期'列）
-                shipping_date = row['日期']
-                if pd.isna(shipping_date):
-                    shipping_date = datetime.now().date()
-                elif isinstance(shipping_date, str):
-                    try:
-                        shipping_date = datetime.strptime(shipping_date, "%Y-%m-%d").date()
-                    except ValueError:
-                        shipping_date = datetime.now().date()
-                elif isinstance(shipping_date, (int, float)):  # 处理Excel数字日期格式
-                    try:
-                        shipping_date = datetime.fromordinal(int(shipping_date) + datetime(1900, 1, 1).toordinal() - 2).date()
-                    except (ValueError, TypeError):
-                        shipping_date = datetime.now().date()
-                elif isinstance(shipping_date, datetime):
-                    shipping_date = shipping_date.date()
-
-                # 处理地址（使用'地址'列）
-                raw_address = str(row['地址']).strip()
-                if pd.isna(raw_address):
-                    continue  # 跳过没有地址的行
-
-                # 解析地址
-                address_info = region_service.parse_address(raw_address)
-                province = address_info['province']
-                city = address_info['city']
-                area = address_info['area']
-
-                # 处理货物信息（使用'品名'列）
-                goods_info = str(row['品名']).strip()
-                if pd.isna(goods_info):
-                    continue  # 跳过没有货物信息的行
-
-                # 处理数量（使用'件数'列）
-                quantity = row['件数']
-                if pd.isna(quantity):
-                    quantity = 1  # 默认数量为1
-                else:
-                    try:
-                        # 处理 "1台" 这样的格式
-                        if isinstance(quantity, str):
-                            quantity = int(''.join(filter(str.isdigit, quantity)))
-                        else:
-                            quantity = int(float(quantity))
-                    except (ValueError, TypeError):
-                        quantity = 1
-
-                # 处理价格（使用'价格'列）
-                total_price = row['价格']
-                if pd.isna(total_price):
-                    print(f"警告：发现没有价格的行，跳过处理。行数据：{row.to_dict()}")
-                    continue  # 跳过没有价格的行
-                try:
-                    total_price = float(total_price)
-                except (ValueError, TypeError):
-                    print(f"警告：价格格式不正确，跳过处理。行数据：{row.to_dict()}")
-                    continue  # 跳过无法转换为价格的行
-
-                # 解析货物
-                goods_types = parse_goods(goods_info)
-                if not goods_types:  # 如果没有识别出货物类型，使用原始货物名称
-                    goods_types = [goods_info]
-
-                # 创建发货记录
-                shipment = Shipment(
-                    shipping_date=shipping_date,
-                    raw_address=raw_address,  # 保存原始地址
-                    province=province,
-                    city=city,
-                    area=area,
-                    total_price=total_price,
-                    quantity=quantity,
-                    unit="件",
-                    raw_goods=goods_info,  # 使用原始货物名称
-                )
-                session.add(shipment)
-                session.flush()
-
-                # 为每个货物类型创建发货项目记录
-                for goods_type in goods_types:
-                    item = ShipmentItem(
-                        shipment_id=shipment.id,
-                        goods_type=goods_type,
-                        quantity=quantity // len(goods_types),  # 平均分配数量
-                    )
-                    session.add(item)
-
-            except Exception as e:
-                print(f"处理行数据时出错: {str(e)}")
-                print(f"问题行数据: {row.to_dict()}")
-                continue  # 跳过出错的行，继续处理下一行
-
-        session.commit()
-        return True
+        return datetime.strptime(value, "%Y-%m-%d").date()
+    except ValueError:
+        return default
 
-    except Exception as e:
-        session.rollback()
-        raise Exception(f"数据处理失败: {str(e)}")
+def _to_float(value):
+    """逐个转换未能批量转换的价格，失败返回 None"""
+    try:
+        return float(value)
+    except (ValueError, TypeError):
+        return None
+
+def _to_quantity(value: str) -> int:
+    """逐个处理未能批量转换的件数字符串"""
+    try:
+        return int(''.join(filter(str.isdigit, value)))
+    except ValueError:
+        return 1
+
+def clean_dates(values: pd.Series) -> Tuple[pd.Series, pd.Series]:
+    """批量处理日期列
+
+    支持 "YYYY-MM-DD" 字符串、Excel 数字日期和 datetime，为空或无法解析时使用当天日期。
+
+    Returns:
+        (日期列, 无法处理的行的掩码)
+    """
+    today = datetime.now().date()
+    dates = pd.Series(today, index=values.index, dtype=object)
+    errors = pd.Series(False, index=values.index)
+    kinds = _value_kinds(values).where(values.notna(), 'missing')
+
+    # 字符串日期，批量解析后对剩余的逐个兜底
+    strings = values[kinds == 'str']
+    if len(strings):
+        parsed = pd.to_datetime(strings, format="%Y-%m-%d", errors='coerce')
+        ok = parsed.notna()
+        dates[ok[ok].index] = parsed[ok].dt.date
+        rest = strings[~ok]
+        dates[rest.index] = rest.map(lambda value: _parse_date_string(value, today))
+
+    # Excel 数字日期
+    numbers = pd.to_numeric(values[kinds == 'number'])
+    if len(numbers):
+        days = np.trunc(numbers.to_numpy(dtype=float))
+        ordinals = days + EXCEL_EPOCH_ORDINAL
+        overflow = ~np.isfinite(days) | (ordinals < MIN_C_INT) | (ordinals > MAX_C_INT)
+        valid = ~overflow & (ordinals >= MIN_ORDINAL) & (ordinals <= MAX_ORDINAL)
+        serial_dates = EXCEL_EPOCH + days[valid].astype(np.int64).astype('timedelta64[D]')
+        dates[numbers.index[valid]] = serial_dates.astype(object)
+        errors[numbers.index[overflow]] = True
+
+    # datetime 只保留日期部分
+    stamps = values[kinds == 'datetime']
+    if len(stamps):
+        try:
+            dates[stamps.index] = pd.to_datetime(stamps).dt.date
+        except (ValueError, TypeError, OverflowError):
+            dates[stamps.index] = stamps.map(lambda value: value.date())
+
+    # 其他类型保持原值
+    others = values[kinds == 'other']
+    dates[others.index] = others
+    return dates, errors
+
+def clean_quantities(values: pd.Series) -> Tuple[pd.Series, pd.Series]:
+    """批量处理件数列
+
+    字符串（如 "1台"）取其中的数字，数值取整，为空或无法解析时默认为 1。
+
+    Returns:
+        (件数列, 无法处理的行的掩码)
+    """
+    quantities = pd.Series(1, index=values.index, dtype=np.int64)
+    errors = pd.Series(False, index=values.index)
+    kinds = _value_kinds(values).where(values.notna(), 'missing')
+
+    # 字符串件数，去掉非数字字符后批量转换，剩余的逐个兜底
+    strings = values[kinds == 'str']
+    if len(strings):
+        digits = pd.to_numeric(strings.str.replace(r'\D', '', regex=True), errors='coerce')
+        # 含有其他字符（如 ① ² 等 isdigit 但非十进制数字的字符）的交给逐个处理
+        ok = digits.notna() & strings.str.fullmatch(COMMON_CHARS)
+        quantities[ok[ok].index] = digits[ok].astype(np.int64)
+        rest = strings[~ok]
+        quantities[rest.index] = rest.map(_to_quantity).astype(np.int64)
+
+    # 数值件数取整
+    numbers = pd.to_numeric(values[kinds == 'number']).astype(float)
+    if len(numbers):
+        finite = np.isfinite(numbers)
+        quantities[numbers.index[finite]] = np.trunc(numbers[finite]).astype(np.int64)
+        errors[numbers.index[~finite]] = True
+    return quantities, errors
+
+def clean_prices(values: pd.Series) -> Tuple[pd.Series, pd.Series, pd.Series]:
+    """批量处理价格列
+
+    Returns:
+        (价格列, 没有价格的行的掩码, 价格格式不正确的行的掩码)
+    """
+    missing = values.isna()
+    prices = pd.to_numeric(values, errors='coerce').astype(float)
+    # 批量转换失败的再逐个兜底（如全角数字、带下划线的数字）
+    rest = values[prices.isna() & ~missing]
+    invalid = pd.Series(False, index=values.index)
+    if len(rest):
+        converted = [_to_float(value) for value in rest]
+        invalid[rest.index] = [value is None for value in converted]
+        prices[rest.index] = [np.nan if value is None else value for value in converted]
+    return prices, missing, invalid
+
+def clean_rows(df: pd.DataFrame) -> Tuple[pd.DataFrame, Dict[str, List[Any]]]:
+    """按列批量清洗 Excel 数据
+
+    Args:
+        df: 原始数据（已去掉表头行）
+
+    Returns:
+        (清洗后的数据, 按原因分类的跳过行索引)
+        清洗后的数据包含 shipping_date, raw_address, raw_goods, quantity, total_price 列，
+        索引与原始数据一致。
+    """
+    empty = df.isna().all(axis=1)
+    shipping_dates, date_errors = clean_dates(df['日期'])
+    quantities, quantity_errors = clean_quantities(df['件数'])
+    prices, missing_price, invalid_price = clean_prices(df['价格'])
+
+    # 按原逐行处理的检查顺序确定每行的跳过原因
+    masks = {
+        'empty_row': empty,
+        'invalid_value': date_errors | quantity_errors,
+        'missing_price': missing_price,
+        'invalid_price': invalid_price,
+    }
+    rejected = pd.Series(False, index=df.index)
+    rejections = {}
+    for reason, mask in masks.items():
+        mask = mask & ~rejected
+        rejections[reason] = df.index[mask.to_numpy()].tolist()
+        rejected |= mask
+
+    keep = ~rejected
+    clean = pd.DataFrame({
+        'shipping_date': shipping_dates[keep],
+        # 地址和货物信息统一转为字符串
+        'raw_address': df.loc[keep, '地址'].astype(str).str.strip(),
+        'raw_goods': df.loc[keep, '品名'].astype(str).str.strip(),
+        'quantity': quantities[keep],
+        'total_price': prices[keep],
+    })
+    return clean, rejections
+
+def classify_goods(goods_names: List[str]) -> List[List[str]]:
+    """批量解析货物名称，相同的名称只解析一次"""
+    unique = list(dict.fromkeys(goods_names))
+    if parallel.PARALLEL_GOODS and parallel.should_parallelize(len(unique)):
+        results = parallel.map_shards(parse_goods_shard, unique)
+    else:
+        results = [parse_goods(goods_name) for goods_name in unique]
+    classified = dict(zip(unique, results))
+    return [classified[goods_name] for goods_name in goods_names]
 
+def parse_goods_shard(goods_names: List[str]) -> List[List[str]]:
+    """在子进程中解析一个分片的货物名称"""
+    return [parse_goods(goods_name) for goods_name in goods_names]
+
+def build_records(df: pd.DataFrame, address_infos: List[Dict[str, str]]) -> List[Dict[str, Any]]:
+    """把清洗后的数据和地址解析结果组装为待写入的运单记录"""
+    records = []
+    columns = [df[column].tolist() for column in ('shipping_date', 'raw_address', 'raw_goods', 'quantity', 'total_price', 'fingerprint')]
+    # 解析货物
+    goods_types_list = classify_goods(columns[2])
+    rows = zip(zip(*columns), address_infos, goods_types_list)
+    for (shipping_date, raw_address, raw_goods, quantity, total_price, fingerprint), address_info, goods_types in rows:
+        if not goods_types:  # 如果没有识别出货物类型，使用原始货物名称
+            goods_types = [raw_goods]
+
+        records.append({
+            'shipping_date': shipping_date,
+            'raw_address': raw_address,  # 保存原始地址
+            'province': address_info['province'],
+            'city': address_info['city'],
+            'area': address_info['area'],
+            'province_code': address_info['province_code'],
+            'city_code': address_info['city_code'],
+            'area_code': address_info['area_code'],
+            'total_price': total_price,
+            'quantity': quantity,
+            'unit': "件",
+            'raw_goods': raw_goods,  # 使用原始货物名称
+            'goods_types': goods_types,
+            'fingerprint': fingerprint,
+        })
+    return records
+
+def _cell_value(cell):
+    """按 pandas read_excel 的规则转换单元格的值"""
+    value = cell.value
+    if value is None or cell.data_type == TYPE_ERROR:
+        return np.nan
+    if cell.data_type == TYPE_NUMERIC:
+        integer = int(value)
+        return integer if integer == value else float(value)
+    if isinstance(value, str) and value in NA_VALUES:
+        return np.nan
+    return value
+
+def read_excel_columns(path: str) -> List[Any]:
+    """只读取表头，返回列名（与 pd.read_excel(skiprows=1) 一致）"""
+    return pd.read_excel(path, skiprows=1, nrows=0).columns.tolist()
+
+def iter_excel_batches(path: str, batch_size: int = STREAM_BATCH_SIZE) -> Iterator[pd.DataFrame]:
+    """流式读取 Excel 文件，按固定行数分批返回数据
+
+    .xlsx 使用 openpyxl 只读模式逐行读取，内存占用与文件大小无关；
+    其他格式整表读取后再分批。每批的索引与 pd.read_excel(skiprows=1) 得到的行号一致。
+    """
+    batch_size = max(1, batch_size)
+    if not path.endswith('.xlsx'):
+        df = pd.read_excel(path, skiprows=1)
+        for start in range(0, len(df), batch_size):
+            yield df.iloc[start:start + batch_size]
+        return
+
+    columns = read_excel_columns(path)
+    width = len(columns)
+    workbook = load_workbook(path, read_only=True, data_only=True, keep_links=False)
+    try:
+        sheet = workbook.worksheets[0]
+        sheet.reset_dimensions()
+        rows = sheet.rows
+        # 跳过第一行和表头
+        for _ in range(2):
+            next(rows, None)
+
+        batch = []
+        start = 0
+        for row in rows:
+            values = [_cell_value(cell) for cell in row[:width]]
+            values.extend([np.nan] * (width - len(values)))
+            batch.append(values)
+            if len(batch) >= batch_size:
+                yield pd.DataFrame(batch, columns=columns, index=range(start, start + len(batch)), dtype=object)
+                start += len(batch)
+                batch = []
+        if batch:
+            yield pd.DataFrame(batch, columns=columns, index=range(start, start + len(batch)), dtype=object)
     finally:
-        session.close()
+        workbook.close()
+
+def _empty_report() -> Dict[str, Any]:
+    """空的处理结果"""
+    return {
+        'rows': 0,
+        'inserted': 0,
+        'duplicates': 0,
+        'items': 0,
+        'failed_chunks': [],
+        'skipped': {},
+        'timings': {stage: 0.0 for stage in INGEST_STAGES},
+    }
+
+def _merge_report(total: Dict[str, Any], report: Dict[str, Any]) -> Dict[str, Any]:
+    """合并两批数据的处理结果"""
+    total['rows'] += report['rows']
+    total['inserted'] += report['inserted']
+    total['duplicates'] += report['duplicates']
+    total['items'] += report['items']
+    total['failed_chunks'].extend(report['failed_chunks'])
+    for reason, count in report['skipped'].items():
+        total['skipped'][reason] = total['skipped'].get(reason, 0) + count
+    for stage, seconds in report['timings'].items():
+        total['timings'][stage] = total['timings'].get(stage, 0.0) + seconds
+    return total
+
+def mark_duplicates(df: pd.DataFrame, occurrences: Dict[str, int]) -> Tuple[pd.DataFrame, int]:
+    """为清洗后的每行计算指纹，去掉已经导入过的行
+
+    Args:
+        df: 清洗后的数据
+        occurrences: 本次导入中每种行内容已出现的次数，跨批次共用
+
+    Returns:
+        (带 fingerprint 列的新行, 重复的行数)
+    """
+    columns = [df[column].tolist() for column in ('shipping_date', 'raw_address', 'raw_goods', 'quantity', 'total_price')]
+    fingerprints = [next_fingerprint(content_digest(*row), occurrences) for row in zip(*columns)]
+    existing = find_existing_fingerprints(fingerprints)
+    df = df.assign(fingerprint=fingerprints)
+    if not existing:
+        return df, 0
+    new = df[~df['fingerprint'].isin(existing)]
+    return new, len(df) - len(new)
+
+def prepare_frame(df: pd.DataFrame, occurrences: Optional[Dict[str, int]] = None
+                  ) -> Tuple[List[Dict[str, Any]], Dict[str, Any]]:
+    """处理一批数据中不涉及写入的部分：清洗 → 去重 → 解析地址 → 解析货物
+
+    Args:
+        df: 原始数据
+        occurrences: 见 mark_duplicates，为 None 时只在本批内计数
+
+    Returns:
+        待写入的运单记录，以及不含写入结果的处理报告
+    """
+    timings = {}
+    rows = len(df)
 
-async def test_excel_processing(file_path: str) -> None:
-    """测试Excel处理功能"""
-    df = pd.read_excel(file_path)
-    await process_excel(df) 
\ No newline at end of file
+    # 按列批量清洗数据
+    started = time.perf_counter()
+    df, rejections = clean_rows(df)
+    timings['clean'] = time.perf_counter() - started
+    for reason, skipped_rows in rejections.items():
+        if skipped_rows and reason != 'empty_row':
+            print(f"警告：{len(skipped_rows)} 行{SKIP_REASONS[reason]}，跳过处理。行号：{skipped_rows[:20]}")
+
+    # 跳过已经导入过的行，只解析和写入新行
+    started = time.perf_counter()
+    df, duplicates = mark_duplicates(df, {} if occurrences is None else occurrences)
+    timings['dedupe'] = time.perf_counter() - started
+
+    # 批量解析地址，相同的地址只解析一次
+    started = time.perf_counter()
+    address_infos = region_service.parse_addresses(df['raw_address'])
+    timings['address'] = time.perf_counter() - started
+
+    # 解析货物
+    started = time.perf_counter()
+    records = build_records(df, address_infos)
+    timings['goods'] = time.perf_counter() - started
+
+    report = {
+        'rows': rows,
+        'duplicates': duplicates,
+        'skipped': {reason: len(skipped_rows) for reason, skipped_rows in rejections.items()},
+        'timings': timings,
+    }
+    return records, report
+
+def ingest_frame(df: pd.DataFrame, chunk_size: int = INGEST_CHUNK_SIZE,
+                 occurrences: Optional[Dict[str, int]] = None) -> Dict[str, Any]:
+    """处理一批数据：清洗 → 去重 → 解析地址 → 解析货物 → 写入数据库
+
+    Returns:
+        处理结果：读取的行数、写入的运单数、重复的行数、按原因统计的跳过行数、写入失败的批次以及各阶段耗时（秒）
+    """
+    records, report = prepare_frame(df, occurrences)
+
+    # 分批写入数据库
+    started = time.perf_counter()
+    written = write_shipments(records, chunk_size)
+    # 去重检查之后由其他任务写入的相同运单在写入时跳过，同样计为重复
+    report['duplicates'] += written.pop('duplicates')
+    report.update(written)
+    report['timings']['write'] = time.perf_counter() - started
+    metrics.record_ingest(report)
+    return report
+
+def ingest_file(path: str, batch_size: int = STREAM_BATCH_SIZE, chunk_size: int = INGEST_CHUNK_SIZE,
+                on_batch: Optional[Callable[[Dict[str, Any]], None]] = None) -> Dict[str, Any]:
+    """流式处理Excel文件并存入数据库（同步执行）
+
+    逐批读取并处理，不把整个文件加载到内存中（只为每种行内容保留一个计数，用于生成指纹）。
+
+    Args:
+        path: Excel 文件路径
+        batch_size: 每批读取的行数
+        chunk_size: 每次提交写入的行数
+        on_batch: 每批处理完成后以累计结果调用，用于汇报进度
+
+    Returns:
+        处理结果，见 ingest_frame
+    """
+    try:
+        # 读取最新的数据版本号，导入前修改的分类规则对本次导入生效
+        data_generation.refresh(data_generation.refresh_interval)
+        total = _empty_report()
+        occurrences: Dict[str, int] = {}
+        batches = iter_excel_batches(path, batch_size)
+        while True:
+            # 读取下一批
+            started = time.perf_counter()
+            batch = next(batches, None)
+            elapsed = time.perf_counter() - started
+            total['timings']['read'] += elapsed
+            metrics.INGEST_STAGE_SECONDS.observe(elapsed, stage='read')
+            if batch is None:
+                break
+
+            # 跳过前两行（第一行是合并单元格，第二行是表头）
+            batch = batch[batch.index >= SKIP_DATA_ROWS]
+            if len(batch):
+                _merge_report(total, ingest_frame(batch, chunk_size, occurrences))
+                if on_batch:
+                    on_batch(total)
+        return total
+
+    except Exception as e:
+        raise Exception(f"数据处理失败: {str(e)}")
@@ -0,0 +1,85 @@
+"""
+运单导出服务
+
+按查询条件逐页读取运单，逐行编码为 CSV 或 NDJSON 后交给流式响应，
+内存占用只与每页的条数有关，与导出的总行数无关。
+"""
+import csv
+import io
+import json
+import os
+from typing import Any, AsyncIterator, Dict, List, Optional
+from ..database import Shipment
+from . import stats_service
+from .price_service import iter_shipment_pages
+
+# 每次从数据库读取的运单数
+EXPORT_PAGE_SIZE = int(os.getenv("EXPORT_PAGE_SIZE", "1000"))
+
+# 导出的字段
+EXPORT_FIELDS = (
+    'id', 'shipping_date', 'raw_address', 'province', 'city', 'area',
+    'raw_goods', 'quantity', 'unit', 'total_price', 'unit_price',
+)
+
+# 支持的导出格式及其 Content-Type
+EXPORT_FORMATS = {
+    'csv': 'text/csv',
+    'ndjson': 'application/x-ndjson',
+}
+
+# CSV 开头的 BOM，Excel 据此按 UTF-8 打开中文内容
+CSV_BOM = '\ufeff'
+
+
+def export_row(shipment: Shipment) -> Dict[str, Any]:
+    """导出的一行数据"""
+    return {
+        'id': shipment.id,
+        'shipping_date': shipment.shipping_date.isoformat() if shipment.shipping_date else None,
+        'raw_address': shipment.raw_address,
+        'province': shipment.province,
+        'city': shipment.city,
+        'area': shipment.area,
+        'raw_goods': shipment.raw_goods,
+        'quantity': shipment.quantity,
+        'unit': shipment.unit,
+        'total_price': shipment.total_price,
+        'unit_price': stats_service.unit_price(shipment.total_price, shipment.quantity),
+    }
+
+
+def _csv_chunk(rows: List[Dict[str, Any]], header: bool) -> str:
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=EXPORT_FIELDS, lineterminator='\n')
+    if header:
+        buffer.write(CSV_BOM)
+        writer.writeheader()
+    writer.writerows(rows)
+    return buffer.getvalue()
+
+
+def _ndjson_chunk(rows: List[Dict[str, Any]]) -> str:
+    return ''.join(json.dumps(row, ensure_ascii=False) + '\n' for row in rows)
+
+
+async def export_shipments(location: Optional[str] = None, goods_type: Optional[str] = None,
+                           export_format: str = 'csv', page_size: int = EXPORT_PAGE_SIZE) -> AsyncIterator[str]:
+    """按日期从新到旧导出匹配的运单，每次产出一页编码后的文本
+
+    Args:
+        location: 地点，为空时导出全部运单
+        goods_type: 货物类型
+        export_format: csv 或 ndjson
+        page_size: 每次从数据库读取的运单数
+    """
+    if export_format not in EXPORT_FORMATS:
+        raise ValueError(f"不支持的导出格式: {export_format}")
+    first = True
+    async for shipments in iter_shipment_pages(location, goods_type, page_size):
+        rows = [export_row(shipment) for shipment in shipments]
+        yield _csv_chunk(rows, first) if export_format == 'csv' else _ndjson_chunk(rows)
+        first = False
+    if first and export_format == 'csv':
+        # 没有匹配的运单时只输出表头
+        yield _csv_chunk([], True)
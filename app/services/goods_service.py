@@ -0,0 +1,176 @@
+"""
+货物分类服务
+
+根据规则表把货物名称归入标准货物类型。所有关键字编译为一个多模式匹配器，
+一次扫描即可找出名称中出现的全部关键字，再按优先级选出货物类型。
+"""
+import os
+import threading
+from typing import Dict, Iterable, List, Optional, Tuple
+from sqlalchemy import insert, select, update
+from ..database import DEFAULT_GOODS_RULES, SessionLocal, GoodsRule, GoodsType, SearchTerm, ShipmentItem
+from .cache import LRUCache, data_generation
+from .region_index import PatternMatcher
+
+# 货物名称分类结果的缓存条目数
+GOODS_CACHE_SIZE = int(os.getenv("GOODS_CACHE_SIZE", "50000"))
+
+
+class GoodsClassifier:
+    """货物分类器
+
+    Args:
+        rules: 分类规则 (货物类型, 关键字, 优先级)
+        type_ids: 标准货物类型名称到 id 的映射
+        cache_size: 分类结果的缓存条目数
+    """
+    def __init__(self, rules: Iterable[Tuple[str, str, int]], type_ids: Dict[str, int],
+                 cache_size: int = GOODS_CACHE_SIZE):
+        self._type_ids = dict(type_ids)
+        self._rules: Dict[str, Tuple[int, str]] = {}
+        for goods_type, keyword, priority in rules:
+            self._rules[keyword] = (priority, goods_type)
+        self._matcher = PatternMatcher(self._rules)
+        self._cache = LRUCache(cache_size)
+
+    @property
+    def categories(self) -> List[str]:
+        """所有标准货物类型"""
+        return list(self._type_ids)
+
+    def is_category(self, goods_type: str) -> bool:
+        """是否为标准货物类型"""
+        return goods_type in self._type_ids
+
+    def type_id(self, goods_type: str) -> Optional[int]:
+        """标准货物类型的 id，不是标准类型时返回 None"""
+        return self._type_ids.get(goods_type)
+
+    def classify(self, text: str) -> Optional[str]:
+        """返回 text 所属的标准货物类型，没有命中任何规则时返回 None"""
+        cached = self._cache.get(text)
+        if cached is not None:
+            return cached or None
+        matched = [self._rules[keyword] for keyword in self._matcher.find_all(text)]
+        goods_type = min(matched)[1] if matched else None
+        # 用空字符串缓存未命中的结果，与缓存未命中区分
+        self._cache.put(text, goods_type or '')
+        return goods_type
+
+    def parse_goods(self, goods_name: str) -> List[str]:
+        """解析货物名称，按“+”拆分复合货物，返回每个货物的类型
+
+        无法归类的货物保留原始名称，方便后续模糊匹配。
+        """
+        result = []
+        for good in goods_name.split('+'):
+            good = good.strip()
+            result.append(self.classify(good) or good)
+        return result
+
+    def normalize(self, goods_type: str) -> str:
+        """标准化查询的货物类型"""
+        if not goods_type:
+            return ''
+        goods_type = goods_type.strip()
+        return self.classify(goods_type) or goods_type
+
+    def cache_info(self) -> Dict[str, int]:
+        """返回分类缓存的统计"""
+        return self._cache.info()
+
+
+def load_goods_classifier() -> GoodsClassifier:
+    """从规则表加载货物分类器，规则表为空时使用默认规则"""
+    session = SessionLocal()
+    try:
+        type_ids = dict(session.execute(select(GoodsType.name, GoodsType.id).order_by(GoodsType.id)).all())
+        rules = session.execute(
+            select(GoodsType.name, GoodsRule.keyword, GoodsRule.priority)
+            .join(GoodsType, GoodsRule.goods_type_id == GoodsType.id)
+        ).all()
+    finally:
+        session.close()
+    if not type_ids:
+        print("货物类型字典为空，使用默认分类规则")
+        rules = DEFAULT_GOODS_RULES
+        type_ids = {}
+        for name, _, _ in rules:
+            type_ids.setdefault(name, None)
+    return GoodsClassifier(rules, type_ids)
+
+
+def backfill_goods_types() -> int:
+    """按当前规则为尚未归类的货物项补充标准货物类型
+
+    历史数据和新增规则之前写入的货物项只保存了原始名称，
+    这里按不重复的名称重新分类并批量更新。类型名称有变化时在同一事务中重建价格汇总表，
+    查询不会读到清空后尚未重建的汇总。
+
+    Returns:
+        更新的货物项数
+    """
+    classifier = get_goods_classifier()
+    updated = 0
+    renamed = 0
+    session = SessionLocal()
+    try:
+        values = session.execute(
+            select(ShipmentItem.goods_type)
+            .where(ShipmentItem.goods_type_id.is_(None), ShipmentItem.goods_type.isnot(None))
+            .distinct()
+        ).scalars().all()
+        for value in values:
+            goods_type = classifier.classify(value)
+            type_id = classifier.type_id(goods_type) if goods_type else None
+            if type_id is None:
+                continue
+            result = session.execute(
+                update(ShipmentItem)
+                .where(ShipmentItem.goods_type_id.is_(None), ShipmentItem.goods_type == value)
+                .values(goods_type=goods_type, goods_type_id=type_id)
+            )
+            updated += result.rowcount
+            if goods_type != value:
+                renamed += result.rowcount
+                session.execute(
+                    insert(SearchTerm).prefix_with("OR IGNORE").values(field='goods_type', value=goods_type)
+                )
+        if renamed:
+            # 汇总表按货物类型名称分组，名称变化后按新名称重新汇总（避免与 stats_service 循环导入）
+            from .stats_service import rebuild_price_stats
+            rebuild_price_stats(session)
+        if updated:
+            data_generation.bump(session)
+        session.commit()
+    except Exception as e:
+        session.rollback()
+        print(f"补充标准货物类型失败: {str(e)}")
+        return 0
+    finally:
+        session.close()
+
+    if updated:
+        print(f"已为 {updated} 个货物项补充标准货物类型")
+    return updated
+
+
+_goods_classifier: Optional[GoodsClassifier] = None
+# 加载分类器时读到的货物类型和分类规则的版本号
+_goods_generation = 0
+_goods_classifier_lock = threading.Lock()
+
+
+def get_goods_classifier() -> GoodsClassifier:
+    """返回共享的货物分类器
+
+    货物类型或分类规则表有变化时（触发器递增 data_version 中的 goods_generation），
+    在本进程读到新的版本号后重新加载，不需要重启服务。
+    """
+    global _goods_classifier, _goods_generation
+    generation = data_generation.goods_value
+    with _goods_classifier_lock:
+        if _goods_classifier is None or generation != _goods_generation:
+            _goods_classifier = load_goods_classifier()
+            _goods_generation = generation
+        return _goods_classifier
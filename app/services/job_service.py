@@ -0,0 +1,166 @@
+"""
+后台导入任务服务
+"""
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from typing import Any, Callable, Dict, Iterable, Optional
+from .write_queue import write_queue
+
+# 同时执行的导入任务数（各任务的写入经写入队列串行执行，默认一次处理一个文件）
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", "1"))
+# 最多保留的任务记录数
+MAX_JOBS = int(os.getenv("MAX_JOBS", "100"))
+
+# 任务状态
+JOB_PENDING = 'pending'
+JOB_RUNNING = 'running'
+JOB_SUCCEEDED = 'succeeded'
+JOB_FAILED = 'failed'
+JOB_STATUSES = (JOB_PENDING, JOB_RUNNING, JOB_SUCCEEDED, JOB_FAILED)
+
+
+class IngestJob:
+    """一个导入任务"""
+    def __init__(self, path: str):
+        self.id = uuid.uuid4().hex
+        self.path = path
+        self.status = JOB_PENDING
+        self.created_at = time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.report: Dict[str, Any] = {}
+        self.error: Optional[str] = None
+        self._lock = threading.Lock()
+
+    def update(self, report: Dict[str, Any]):
+        """记录最新的累计处理结果"""
+        with self._lock:
+            self.report = {
+                'rows': report['rows'],
+                'inserted': report['inserted'],
+                'duplicates': report['duplicates'],
+                'items': report['items'],
+                'failed_chunks': list(report['failed_chunks']),
+                'skipped': dict(report['skipped']),
+                'timings': dict(report['timings']),
+            }
+
+    def to_dict(self) -> Dict[str, Any]:
+        """返回任务状态"""
+        with self._lock:
+            report = dict(self.report)
+            status = self.status
+            started_at, finished_at = self.started_at, self.finished_at
+            error = self.error
+
+        rows = report.get('rows', 0)
+        elapsed = 0.0
+        if started_at is not None:
+            elapsed = (finished_at or time.time()) - started_at
+        return {
+            'job_id': self.id,
+            'status': status,
+            'rows_processed': rows,
+            'rows_inserted': report.get('inserted', 0),
+            'rows_duplicate': report.get('duplicates', 0),
+            'rows_skipped': sum(report.get('skipped', {}).values()),
+            'skipped': report.get('skipped', {}),
+            'failed_chunks': report.get('failed_chunks', []),
+            'elapsed': elapsed,
+            'rows_per_sec': rows / elapsed if elapsed > 0 else 0.0,
+            'timings': report.get('timings', {}),
+            'error': error,
+        }
+
+    def _update_snapshot(self):
+        """把本次写入的运单追加到统计快照，任务完成后查询到的汇总已包含新数据"""
+        with self._lock:
+            inserted = self.report.get('inserted', 0)
+        if inserted:
+            # NumPy 导入较慢，有新数据时才加载
+            from . import analytics_service
+            analytics_service.update_snapshot()
+
+    def run(self):
+        """在工作线程中执行导入"""
+        with self._lock:
+            self.status = JOB_RUNNING
+            self.started_at = time.time()
+        try:
+            # pandas 导入较慢，第一次执行导入任务时才加载
+            from . import excel_service
+            report = excel_service.ingest_file(self.path, on_batch=self.update)
+            self.update(report)
+            self._update_snapshot()
+            with self._lock:
+                self.status = JOB_SUCCEEDED
+        except Exception as e:
+            print(f"导入任务 {self.id} 失败: {str(e)}")
+            # 失败前已提交的批次也写入统计快照
+            self._update_snapshot()
+            with self._lock:
+                self.status = JOB_FAILED
+                self.error = str(e)
+        finally:
+            with self._lock:
+                self.finished_at = time.time()
+            # 处理完成后删除上传的文件
+            if os.path.exists(self.path):
+                os.remove(self.path)
+
+
+_executor = ThreadPoolExecutor(max_workers=INGEST_WORKERS, thread_name_prefix="ingest")
+# 只读的维护任务（刷新统计快照等）在单独的线程中执行，不占用写入线程
+_maintenance_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="maintenance")
+_jobs: "OrderedDict[str, IngestJob]" = OrderedDict()
+_jobs_lock = threading.Lock()
+
+
+def submit_ingest(path: str) -> IngestJob:
+    """提交一个导入任务，立即返回"""
+    job = IngestJob(path)
+    with _jobs_lock:
+        _jobs[job.id] = job
+        # 只保留最近的任务记录，正在执行的任务不清理
+        for job_id in list(_jobs):
+            if len(_jobs) <= MAX_JOBS:
+                break
+            if _jobs[job_id].status not in (JOB_PENDING, JOB_RUNNING):
+                del _jobs[job_id]
+    _executor.submit(job.run)
+    return job
+
+
+def run_in_background(func: Callable[[], Any]) -> Future:
+    """在写入队列中执行写入数据库的维护任务，与导入的写入串行执行"""
+    return write_queue.submit(func)
+
+
+def run_readonly_in_background(func: Callable[[], Any], after: Iterable[Future] = ()) -> Future:
+    """在维护线程中执行只读的维护任务，等 after 中的任务都结束后才开始
+
+    只读任务不进入写入队列，执行期间导入的写入不必排队等待。
+    """
+    after = list(after)
+
+    def run():
+        wait(after)
+        return func()
+    return _maintenance_executor.submit(run)
+
+
+def get_job(job_id: str) -> Optional[IngestJob]:
+    """查找任务"""
+    with _jobs_lock:
+        return _jobs.get(job_id)
+
+
+def list_jobs() -> list:
+    """返回所有任务的状态，最新的在前"""
+    with _jobs_lock:
+        jobs = list(_jobs.values())
+    return [job.to_dict() for job in reversed(jobs)]
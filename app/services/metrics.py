@@ -0,0 +1,245 @@
+"""
+运行指标
+
+进程内的计数器和直方图，按 Prometheus 文本格式输出。每次记录只在锁内更新几个数字，
+开销很小，可以在生产环境中一直开启。多个工作进程时每个进程单独统计。
+"""
+import bisect
+import contextvars
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+from sqlalchemy import event
+
+# 请求耗时的直方图分桶（秒）
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# 导入阶段耗时的直方图分桶（秒，每批数据）
+STAGE_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+# 每个请求数据库查询次数的直方图分桶
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+LabelValues = Tuple[str, ...]
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _escape(value: str) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in zip(names, values)) + '}'
+
+
+class Metric:
+    """指标的公共部分
+
+    Args:
+        name: 指标名称
+        documentation: 说明
+        labelnames: 标签名称
+    """
+    type_name = 'untyped'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> LabelValues:
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def samples(self) -> Iterable[Tuple[str, Sequence[str], Sequence[str], float]]:
+        """返回 (名称后缀, 标签名称, 标签值, 值)"""
+        raise NotImplementedError
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type_name}"]
+        for suffix, names, values, value in self.samples():
+            lines.append(f"{self.name}{suffix}{_format_labels(names, values)} {_format_value(value)}")
+        return lines
+
+
+class Counter(Metric):
+    """只增不减的计数器"""
+    type_name = 'counter'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        return [('', self.labelnames, key, value) for key, value in values]
+
+
+class Histogram(Metric):
+    """直方图，记录落在各个分桶中的次数以及总和"""
+    type_name = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # 每组标签：各分桶的次数（最后一个是 +Inf）、总和
+        self._values: Dict[LabelValues, Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total = self._values.get(key) or self._values.setdefault(
+                key, ([0] * (len(self.buckets) + 1), [0.0]))
+            counts[index] += 1
+            total[0] += value
+
+    def samples(self):
+        with self._lock:
+            values = sorted((key, (list(counts), total[0])) for key, (counts, total) in self._values.items())
+        result = []
+        names = self.labelnames + ('le',)
+        for key, (counts, total) in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                result.append(('_bucket', names, key + (_format_value(bound),), cumulative))
+            result.append(('_sum', self.labelnames, key, total))
+            result.append(('_count', self.labelnames, key, cumulative))
+        return result
+
+
+class GaugeFunc(Metric):
+    """取值时才计算的指标，适合缓存大小、暂存区大小等已有统计的数据
+
+    Args:
+        func: 返回 {标签值: 值} 的函数，没有标签时键为空元组
+        type_name: 按 gauge 或 counter 输出
+    """
+    def __init__(self, name: str, documentation: str, func: Callable[[], Dict[LabelValues, float]],
+                 labelnames: Sequence[str] = (), type_name: str = 'gauge'):
+        super().__init__(name, documentation, labelnames)
+        self.type_name = type_name
+        self._func = func
+
+    def samples(self):
+        return [('', self.labelnames, key, value) for key, value in sorted(self._func().items())]
+
+
+class Registry:
+    """指标集合"""
+    def __init__(self):
+        self._metrics: List[Metric] = []
+        self._lock = threading.Lock()
+
+    def register(self, metric: Metric) -> Metric:
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        """按 Prometheus 文本格式输出所有指标"""
+        with self._lock:
+            metrics = list(self._metrics)
+        lines = []
+        for metric in metrics:
+            try:
+                lines.extend(metric.render())
+            except Exception as e:
+                print(f"输出指标 {metric.name} 失败: {str(e)}")
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+HTTP_REQUEST_SECONDS = registry.register(Histogram(
+    'logistics_http_request_duration_seconds', "HTTP 请求耗时", ('method', 'route', 'status')))
+HTTP_REQUEST_QUERIES = registry.register(Histogram(
+    'logistics_http_request_db_queries', "每个 HTTP 请求执行的数据库查询数", ('route',), QUERY_COUNT_BUCKETS))
+DB_QUERIES = registry.register(Counter('logistics_db_queries_total', "数据库查询总数"))
+INGEST_STAGE_SECONDS = registry.register(Histogram(
+    'logistics_ingest_stage_duration_seconds', "导入每批数据各阶段的耗时", ('stage',), STAGE_BUCKETS))
+INGEST_ROWS = registry.register(Counter(
+    'logistics_ingest_rows_total', "导入的行数，按结果分类（inserted 写入、duplicate 重复、skipped 跳过、failed 写入失败）",
+    ('result',)))
+INGEST_SKIPPED_ROWS = registry.register(Counter(
+    'logistics_ingest_skipped_rows_total', "导入时跳过的行数，按原因分类", ('reason',)))
+
+
+# 当前请求的数据库查询计数，由 MetricsMiddleware 设置
+_query_counter: contextvars.ContextVar[Optional[List[int]]] = contextvars.ContextVar('query_counter', default=None)
+
+
+def count_query(*args):
+    """数据库执行语句前调用（注册为 before_cursor_execute 事件）"""
+    DB_QUERIES.inc()
+    counter = _query_counter.get()
+    if counter is not None:
+        counter[0] += 1
+
+
+def instrument_engine(engine) -> None:
+    """统计引擎执行的数据库查询（异步引擎传入其 sync_engine）"""
+    event.listen(engine, 'before_cursor_execute', count_query)
+
+
+def record_ingest(report: Dict) -> None:
+    """记录一批数据的导入结果和各阶段耗时"""
+    for stage, seconds in report['timings'].items():
+        INGEST_STAGE_SECONDS.observe(seconds, stage=stage)
+    failed = sum(chunk['rows'] for chunk in report['failed_chunks'])
+    INGEST_ROWS.inc(report['inserted'], result='inserted')
+    INGEST_ROWS.inc(report['duplicates'], result='duplicate')
+    INGEST_ROWS.inc(failed, result='failed')
+    for reason, count in report['skipped'].items():
+        INGEST_ROWS.inc(count, result='skipped')
+        INGEST_SKIPPED_ROWS.inc(count, reason=reason)
+
+
+class MetricsMiddleware:
+    """记录每个请求的耗时和数据库查询数（ASGI 中间件）
+
+    按路由模板（如 /parse/{task_id}）分组，没有匹配到路由的请求（静态文件、404）不记录。
+    """
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        status = [500]
+
+        async def send_with_status(message):
+            if message['type'] == 'http.response.start':
+                status[0] = message['status']
+            await send(message)
+
+        counter = [0]
+        token = _query_counter.set(counter)
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            elapsed = time.perf_counter() - started
+            _query_counter.reset(token)
+            route = scope.get('route')
+            path = getattr(route, 'path', None)
+            if path is not None:
+                HTTP_REQUEST_SECONDS.observe(elapsed, method=scope['method'], route=path, status=status[0])
+                HTTP_REQUEST_QUERIES.observe(counter[0], route=path)
@@ -0,0 +1,71 @@
+"""
+多进程并行处理
+"""
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, List, Optional, Sequence, TypeVar
+
+T = TypeVar('T')
+R = TypeVar('R')
+
+# 并行处理使用的进程数，0 表示关闭并行模式
+PARALLEL_WORKERS = int(os.getenv("PARALLEL_WORKERS", "0"))
+# 待处理条目少于该数量时仍在当前进程中处理
+PARALLEL_MIN_ITEMS = int(os.getenv("PARALLEL_MIN_ITEMS", "5000"))
+# 是否同时并行解析货物
+PARALLEL_GOODS = os.getenv("PARALLEL_GOODS", "0") == "1"
+
+_pool: Optional[ProcessPoolExecutor] = None
+_pool_lock = threading.Lock()
+
+
+def should_parallelize(count: int) -> bool:
+    """是否对 count 个待处理条目使用多进程"""
+    return PARALLEL_WORKERS > 0 and count >= PARALLEL_MIN_ITEMS
+
+
+def _get_pool() -> ProcessPoolExecutor:
+    """懒加载进程池
+
+    使用 spawn 方式启动子进程，避免在多线程的服务进程中 fork。
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(
+                max_workers=PARALLEL_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return _pool
+
+
+def map_shards(func: Callable[[List[T]], List[R]], items: Sequence[T]) -> List[R]:
+    """把 items 切分为连续的分片交给进程池处理，按原顺序合并结果
+
+    Args:
+        func: 处理一个分片的模块级函数，返回与分片一一对应的结果
+        items: 待处理的条目
+
+    Returns:
+        与 items 一一对应的结果
+    """
+    items = list(items)
+    if not items:
+        return []
+    shard_size = -(-len(items) // PARALLEL_WORKERS)
+    shards = [items[start:start + shard_size] for start in range(0, len(items), shard_size)]
+    results: List[R] = []
+    for shard_result in _get_pool().map(func, shards):
+        results.extend(shard_result)
+    return results
+
+
+def shutdown():
+    """关闭进程池"""
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown()
+            _pool = None
@@ -1,7 +1,19 @@
-from sqlalchemy import or_, and_
-from sqlalchemy.orm import Session
-from typing import List, Dict, Any
-from ..database import SessionLocal, Shipment, ShipmentItem
+from sqlalchemy import Select, or_, select, tuple_
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+from datetime import date
+import base64
+import os
+from ..database import AsyncSessionLocal, SearchTerm, Shipment, ShipmentItem
+from . import stats_service
+from .cache import LRUCache, data_generation
+from .goods_service import get_goods_classifier
+from .region_service import get_region_service
+
+# 查询结果缓存的条目数和有效秒数
+SEARCH_CACHE_SIZE = int(os.getenv("SEARCH_CACHE_SIZE", "1024"))
+SEARCH_CACHE_TTL = float(os.getenv("SEARCH_CACHE_TTL", "300"))
+
+_search_cache = LRUCache(SEARCH_CACHE_SIZE, ttl=SEARCH_CACHE_TTL)
 
 def normalize_location(location: str) -> str:
     """标准化地址格式"""
@@ -15,101 +27,240 @@ def normalize_location(location: str) -> str:
 
 def normalize_goods_type(goods_type: str) -> str:
     """标准化货物类型"""
-    if not goods_type:
-        return ''
-    
-    # 移除空格
-    goods_type = goods_type.strip()
-    
-    # 标准化货物类型
-    if any(keyword in goods_type for keyword in ['全电动', '电动']):
-        return '全电动'
-    elif '配重' in goods_type:
-        return '配重'
-    elif '前移' in goods_type:
-        return '前移'
-    elif '大金刚' in goods_type:
-        return '大金刚'
-    elif '小金刚' in goods_type:
-        return '小金刚'
-    elif '半电动' in goods_type:
-        return '半电动'
-    
-    return goods_type
+    return get_goods_classifier().normalize(goods_type)
+
+def contains(column, field: str, keyword: str):
+    """子串匹配条件，等价于 column LIKE '%keyword%'
+
+    先在搜索词典中找出包含关键字的不重复值，再按值走索引查询，
+    避免对运单表做前导通配符的全表扫描。
+    """
+    values = select(SearchTerm.value).where(
+        SearchTerm.field == field,
+        SearchTerm.value.like(f'%{keyword}%'),
+    )
+    return column.in_(values)
 
 async def search_prices(location: str, goods_type: str = None) -> Dict[str, Any]:
-    """查询物流价格"""
-    db = SessionLocal()
+    """查询物流价格
+
+    结果按标准化后的地址和货物类型缓存。缓存键带有查询前的数据版本号，
+    导入数据提交后版本号递增，之后的查询不会命中旧结果。返回的结果可能被其他请求共用，调用方不应修改。
+    """
+    # 标准化地址和货物类型
+    normalized_location = normalize_location(location)
+    normalized_goods_type = normalize_goods_type(goods_type)
+
+    key = (await data_generation.current(), normalized_location, normalized_goods_type)
+    result = _search_cache.get(key)
+    if result is None:
+        result = await _query_prices(normalized_location, normalized_goods_type)
+        _search_cache.put(key, result)
+    return result
+
+def search_cache_info() -> Dict[str, int]:
+    """返回查询结果缓存的统计"""
+    return {**_search_cache.info(), 'generation': data_generation.value}
+
+# 分页查询每页的默认条数和最大条数
+PAGE_SIZE = int(os.getenv("PAGE_SIZE", "50"))
+MAX_PAGE_SIZE = int(os.getenv("MAX_PAGE_SIZE", "500"))
+# 查询结果中最近记录的条数
+RECENT_ITEMS = 10
+
+# 按行政区划代码查询的列（直辖市的区县和县级市的代码记在 city_code 中，代码长度不能区分列）
+REGION_CODE_COLUMNS = (Shipment.province_code, Shipment.city_code, Shipment.area_code)
+
+# 分页顺序：日期从新到旧，同一天按 id 从大到小；没有日期的运单排在最后，按 id 从大到小
+PAGE_ORDER = (Shipment.shipping_date.desc(), Shipment.id.desc())
+NULL_DATE_ORDER = (Shipment.id.desc(),)
+
+
+def page_key(shipment: Shipment) -> Tuple[bool, date, int]:
+    """运单在 PAGE_ORDER 中的排序键（倒序排列），没有日期的运单排在有日期的之后"""
+    return shipment.shipping_date is not None, shipment.shipping_date or date.min, shipment.id
+
+def encode_cursor(shipping_date: Optional[date], shipment_id: int) -> str:
+    """把一页最后一条运单的 (日期, id) 编码为游标，没有日期时日期部分为空"""
+    text = f"{shipping_date.isoformat() if shipping_date else ''}|{shipment_id}"
+    return base64.urlsafe_b64encode(text.encode()).decode().rstrip('=')
+
+def decode_cursor(cursor: str) -> Tuple[Optional[date], int]:
+    """解析游标，格式不正确时抛出 ValueError"""
     try:
-        # 标准化地址和货物类型
-        normalized_location = normalize_location(location)
-        normalized_goods_type = normalize_goods_type(goods_type)
-        
-        # 构建查询条件
-        location_conditions = [
-            or_(
-                Shipment.province.like(f'%{normalized_location}%'),
-                Shipment.city.like(f'%{normalized_location}%'),
-                Shipment.area.like(f'%{normalized_location}%')
-            )
+        text = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        shipping_date, shipment_id = text.split('|')
+        return (date.fromisoformat(shipping_date) if shipping_date else None), int(shipment_id)
+    except (ValueError, UnicodeDecodeError) as e:
+        raise ValueError(f"无效的游标: {cursor}") from e
+
+def location_condition(normalized_location: str, region_codes: List[str]):
+    """地点条件：能解析为行政区划代码时按代码精确查询，否则按名称模糊匹配；没有地点时返回 None"""
+    if region_codes:
+        return or_(
+            Shipment.province_code.in_(region_codes),
+            Shipment.city_code.in_(region_codes),
+            Shipment.area_code.in_(region_codes)
+        )
+    if normalized_location:
+        return or_(
+            contains(Shipment.province, 'province', normalized_location),
+            contains(Shipment.city, 'city', normalized_location),
+            contains(Shipment.area, 'area', normalized_location)
+        )
+    return None
+
+def goods_condition(normalized_goods_type: str):
+    """货物类型条件（对货物项的 EXISTS 子查询），没有货物类型时返回 None"""
+    goods_type_id = get_goods_classifier().type_id(normalized_goods_type)
+    if goods_type_id is not None:
+        # 标准货物类型按 id 关联货物项
+        return Shipment.items.any(ShipmentItem.goods_type_id == goods_type_id)
+    if normalized_goods_type:
+        return or_(
+            Shipment.items.any(contains(ShipmentItem.goods_type, 'goods_type', normalized_goods_type)),
+            contains(Shipment.raw_goods, 'raw_goods', normalized_goods_type)
+        )
+    return None
+
+def _page_queries(normalized_location: str, normalized_goods_type: str, region_codes: List[str]) -> List[Select]:
+    """构建分页查询，结果按 PAGE_ORDER 排列
+
+    每个行政区划代码在每一列上单独查询：条件是 “某一列 = 代码”，可以沿 (代码, 日期, id) 索引
+    按顺序读取，取一页只需读取一页的行，与翻到第几页无关。
+    用 OR 合并多列多个代码时 SQLite 需要取出全部匹配的行再排序。
+    """
+    conditions = []
+    goods = goods_condition(normalized_goods_type)
+    if goods is not None:
+        conditions.append(goods)
+    if region_codes:
+        return [
+            select(Shipment).where(column == code, *conditions)
+            for code in region_codes for column in REGION_CODE_COLUMNS
         ]
+    location = location_condition(normalized_location, region_codes)
+    if location is not None:
+        conditions.append(location)
+    return [select(Shipment).where(*conditions)]
+
+async def _fetch_page(db, queries: List[Select], after: Optional[Tuple[Optional[date], int]],
+                      limit: int) -> List[Shipment]:
+    """执行分页查询，合并后返回排在 after 之后的 limit 条运单
+
+    有日期和没有日期的运单分两段读取：(日期, id) 的行值比较会跳过日期为 NULL 的行，
+    因此先按 (日期, id) 读有日期的运单，不足一页时再按 id 接着读没有日期的运单。
+    两段都能沿 (代码, 日期, id) 索引按顺序读取。
+    """
+    shipments: Dict[int, Shipment] = {}
+    for query in queries:
+        fetched = 0
+        if after is None or after[0] is not None:
+            dated = query.where(Shipment.shipping_date.is_not(None))
+            if after is not None:
+                dated = dated.where(tuple_(Shipment.shipping_date, Shipment.id) < tuple_(*after))
+            for shipment in (await db.execute(dated.order_by(*PAGE_ORDER).limit(limit))).scalars():
+                # 同一运单可能匹配多个代码或多列
+                shipments[shipment.id] = shipment
+                fetched += 1
+        if fetched < limit:
+            undated = query.where(Shipment.shipping_date.is_(None))
+            if after is not None and after[0] is None:
+                undated = undated.where(Shipment.id < after[1])
+            for shipment in (await db.execute(undated.order_by(*NULL_DATE_ORDER).limit(limit - fetched))).scalars():
+                shipments[shipment.id] = shipment
+    ordered = sorted(shipments.values(), key=page_key, reverse=True)
+    return ordered[:limit]
+
+def shipment_item(shipment: Shipment) -> Dict[str, Any]:
+    """查询结果中的一条运单明细"""
+    return {
+        'id': shipment.id,
+        'date': shipment.shipping_date.isoformat() if shipment.shipping_date else None,
+        'goods': shipment.raw_goods,
+        'quantity': f"{shipment.quantity}{shipment.unit}",
+        'price': stats_service.unit_price(shipment.total_price, shipment.quantity),
+        'destination': shipment.raw_address
+    }
+
+def _page_result(shipments: List[Shipment], limit: int) -> Dict[str, Any]:
+    last = shipments[-1] if len(shipments) == limit else None
+    return {
+        'items': [shipment_item(shipment) for shipment in shipments],
+        # 不足一页说明已经是最后一页
+        'next_cursor': encode_cursor(last.shipping_date, last.id) if last is not None else None,
+    }
+
+async def list_shipments(location: Optional[str] = None, goods_type: Optional[str] = None,
+                         cursor: Optional[str] = None, limit: int = PAGE_SIZE) -> Dict[str, Any]:
+    """按日期从新到旧分页列出运单
+
+    使用 (shipping_date, id) 游标分页，每页的查询代价与页码无关。没有日期的运单排在最后。
+
+    Args:
+        location: 地点，为空时列出全部运单
+        goods_type: 货物类型
+        cursor: 上一页返回的 next_cursor，为空时返回第一页
+        limit: 每页条数
+
+    Returns:
+        items（运单明细）和 next_cursor（下一页的游标，没有下一页时为 None）
+    """
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    after = decode_cursor(cursor) if cursor else None
+    normalized_location = normalize_location(location or '')
+    normalized_goods_type = normalize_goods_type(goods_type)
+    region_codes = get_region_service().resolve_codes(normalized_location, normalize_location)
+    queries = _page_queries(normalized_location, normalized_goods_type, region_codes)
+    async with AsyncSessionLocal() as db:
+        shipments = await _fetch_page(db, queries, after, limit)
+    return _page_result(shipments, limit)
+
+async def iter_shipment_pages(location: Optional[str] = None, goods_type: Optional[str] = None,
+                              page_size: int = MAX_PAGE_SIZE) -> AsyncIterator[List[Shipment]]:
+    """按日期从新到旧逐页读取全部匹配的运单，用于导出
+
+    每页使用单独的会话，不会长时间占用读事务而阻塞导入写入。
+    """
+    normalized_location = normalize_location(location or '')
+    normalized_goods_type = normalize_goods_type(goods_type)
+    region_codes = get_region_service().resolve_codes(normalized_location, normalize_location)
+    queries = _page_queries(normalized_location, normalized_goods_type, region_codes)
+    after = None
+    while True:
+        async with AsyncSessionLocal() as db:
+            shipments = await _fetch_page(db, queries, after, page_size)
+        if shipments:
+            yield shipments
+        if len(shipments) < page_size:
+            return
+        after = (shipments[-1].shipping_date, shipments[-1].id)
+
+async def _query_prices(normalized_location: str, normalized_goods_type: str) -> Dict[str, Any]:
+    """在数据库中查询物流价格"""
+    async with AsyncSessionLocal() as db:
+        region_codes = get_region_service().resolve_codes(normalized_location, normalize_location)
         
         # 构建基础查询
-        base_query = db.query(Shipment)
-        if normalized_goods_type:
-            base_query = base_query.join(ShipmentItem).filter(
-                and_(
-                    *location_conditions,
-                    or_(
-                        ShipmentItem.goods_type.like(f'%{normalized_goods_type}%'),
-                        Shipment.raw_goods.like(f'%{normalized_goods_type}%')
-                    )
-                )
-            ).distinct()
-        else:
-            base_query = base_query.filter(*location_conditions)
-        
-        # 获取总记录数
-        total_count = base_query.count()
-        
-        # 获取最近10条记录
-        shipments = base_query.order_by(Shipment.shipping_date.desc()).limit(10).all()
-        
-        # 处理结果
-        items = []
-        total_price = 0
-        min_price = float('inf')
-        max_price = 0
+        conditions = [
+            condition for condition in (
+                location_condition(normalized_location, region_codes),
+                goods_condition(normalized_goods_type),
+            ) if condition is not None
+        ]
+        base_query = select(Shipment.id).where(*conditions)
         
-        for shipment in shipments:
-            # 计算单价
-            unit_price = shipment.total_price / shipment.quantity
-            
-            # 更新统计信息
-            total_price += unit_price
-            min_price = min(min_price, unit_price)
-            max_price = max(max_price, unit_price)
-            
-            # 添加明细
-            items.append({
-                'goods': shipment.raw_goods,
-                'quantity': f"{shipment.quantity}{shipment.unit}",
-                'price': unit_price,
-                'destination': shipment.raw_address
-            })
+        # 统计全部历史记录：地区和货物类型都有汇总时直接读取汇总表，否则在数据库中计算
+        if region_codes and stats_service.has_price_stats(normalized_goods_type):
+            stats = await stats_service.get_price_stats(db, region_codes, normalized_goods_type)
+        else:
+            stats = await stats_service.query_price_stats(db, base_query)
         
-        # 计算统计信息
-        count = total_count  # 使用总记录数
-        average_price = total_price / len(items) if items else 0  # 均价只基于显示的记录计算
+        # 获取最近的记录（即分页的第一页）
+        queries = _page_queries(normalized_location, normalized_goods_type, region_codes)
+        shipments = await _fetch_page(db, queries, None, RECENT_ITEMS)
         
         return {
-            'stats': {
-                'average': average_price,
-                'min': min_price if min_price != float('inf') else 0,
-                'max': max_price,
-                'count': count
-            },
-            'items': items
+            'stats': stats,
+            **_page_result(shipments, RECENT_ITEMS),
         }
-    finally:
-        db.close() 
\ No newline at end of file
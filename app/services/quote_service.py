@@ -0,0 +1,294 @@
+"""
+批量报价服务
+
+一次给出多个目的地 × 多个货物类型的价格矩阵：每格包含运单数、平均、最低、最高单价和最近一次的单价。
+所有目的地和货物类型合并为少数几条按 (目的地, 货物类型) 分组的查询，
+查询次数与矩阵的大小无关，不需要对每个目的地、每种货物分别调用 /search。
+"""
+import csv
+import io
+import json
+import os
+from datetime import date
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+from sqlalchemy import case, func, literal, select, union_all
+from ..database import AsyncSessionLocal, PriceStat, Shipment
+from . import stats_service
+from .price_service import (
+    PAGE_ORDER, REGION_CODE_COLUMNS, goods_condition, location_condition, normalize_goods_type, normalize_location,
+)
+from .region_service import get_region_service
+
+# 每次最多查询的目的地数和货物类型数
+MAX_QUOTE_LOCATIONS = int(os.getenv("MAX_QUOTE_LOCATIONS", "500"))
+MAX_QUOTE_GOODS_TYPES = int(os.getenv("MAX_QUOTE_GOODS_TYPES", "20"))
+# 上传的目的地表格的最大字节数
+MAX_QUOTE_SHEET_BYTES = int(os.getenv("MAX_QUOTE_SHEET_BYTES", str(5 * 1024 * 1024)))
+# 一条 UNION ALL 查询最多合并的子查询数（SQLite 默认上限为 500）
+QUOTE_BRANCHES_PER_QUERY = 200
+
+# 表格中目的地所在列的列名，没有这些列名时取第一列
+LOCATION_HEADERS = ('目的地', '地址', '地点', '到达地')
+# 上传表格支持的格式
+QUOTE_SHEET_SUFFIXES = ('.xlsx', '.csv')
+
+# 运单的单价（件数为 0 或价格缺失时为 NULL）
+UNIT_PRICE = Shipment.total_price / Shipment.quantity
+
+
+class QuoteCell:
+    """矩阵中一格的统计，可以合并多个行政区划代码的部分结果"""
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min_price: Optional[float] = None
+        self.max_price: Optional[float] = None
+        # 最近一条运单的 (日期, id, 单价)
+        self.latest: Optional[Tuple[date, int, float]] = None
+
+    def add_stats(self, count: int, total: float, min_price: Optional[float], max_price: Optional[float]):
+        if not count:
+            return
+        self.count += count
+        self.total += total
+        self.min_price = min_price if self.min_price is None else min(self.min_price, min_price)
+        self.max_price = max_price if self.max_price is None else max(self.max_price, max_price)
+
+    def add_latest(self, latest: Optional[Tuple[date, int, float]]):
+        if latest is not None and (self.latest is None or latest[:2] > self.latest[:2]):
+            self.latest = latest
+
+    def merge(self, other: "QuoteCell"):
+        self.add_stats(other.count, other.total, other.min_price, other.max_price)
+        self.add_latest(other.latest)
+
+    def to_dict(self) -> Dict[str, Any]:
+        """没有运单时除 count 外均为 None"""
+        latest = self.latest
+        return {
+            'count': self.count,
+            'average': self.total / self.count if self.count else None,
+            'min': self.min_price,
+            'max': self.max_price,
+            'latest_price': latest[2] if latest else None,
+            'latest_date': latest[0].isoformat() if latest and latest[0] else None,
+        }
+
+
+Cells = Dict[Tuple[str, str], QuoteCell]
+
+
+def _cell(cells: Cells, key: str, goods: str) -> QuoteCell:
+    cell = cells.get((key, goods))
+    if cell is None:
+        cell = cells[(key, goods)] = QuoteCell()
+    return cell
+
+
+def _to_date(value) -> Optional[date]:
+    # 子查询和聚合函数的结果没有列类型，日期以字符串返回
+    if value is None or isinstance(value, date):
+        return value
+    return date.fromisoformat(value)
+
+
+def _codes_table(codes: List[str]):
+    """行政区划代码作为一张临时表（只占一个 SQL 参数，代码再多也不会超过参数个数上限）"""
+    rows = func.json_each(json.dumps(codes)).table_valued('value')
+    return select(rows.c.value.label('code')).cte('quote_codes')
+
+
+def _conditions(goods_key: str, *conditions) -> tuple:
+    goods = goods_condition(goods_key)
+    return conditions + (UNIT_PRICE.isnot(None),) + ((goods,) if goods is not None else ())
+
+
+def _latest_branch(codes, column, goods_key: str):
+    """每个代码在 column 列中日期最新的一条运单：沿 (代码, 日期, id) 索引倒序读取，通常只需读取几行"""
+    latest_id = (
+        select(Shipment.id)
+        .where(*_conditions(goods_key, column == codes.c.code))
+        .order_by(*PAGE_ORDER)
+        .limit(1)
+        .scalar_subquery()
+    )
+    return select(codes.c.code.label('key'), literal(goods_key).label('goods'), latest_id.label('id'))
+
+
+async def _collect_latest(db, branches: List, cells: Cells):
+    latest = union_all(*branches).subquery()
+    for key, goods, shipping_date, shipment_id, price in await db.execute(
+        select(latest.c.key, latest.c.goods, Shipment.shipping_date, Shipment.id, UNIT_PRICE)
+        .join(Shipment, Shipment.id == latest.c.id)
+    ):
+        _cell(cells, key, goods).add_latest((_to_date(shipping_date), shipment_id, price))
+
+
+async def _collect_price_stats(db, codes: List[str], goods_keys: List[str], cells: Cells):
+    """从价格汇总表读取统计，与 /search 使用相同的数据"""
+    for row in (await db.execute(
+        select(PriceStat).where(PriceStat.region_code.in_(codes), PriceStat.goods_type.in_(goods_keys))
+    )).scalars():
+        _cell(cells, row.region_code, row.goods_type).add_stats(row.count, row.total, row.min_price, row.max_price)
+
+
+def _scan_branch(key, goods_key: str, *conditions):
+    """一组 (目的地, 货物类型) 匹配的运单单价"""
+    return select(
+        key.label('key'), literal(goods_key).label('goods'), UNIT_PRICE.label('price'),
+        Shipment.shipping_date.label('shipping_date'), Shipment.id.label('id'),
+    ).where(*_conditions(goods_key, *conditions))
+
+
+async def _collect_scan(db, branches: List, cells: Cells):
+    """合并子查询，按 (目的地, 货物类型) 分组统计，并取出每组日期最新的一条运单"""
+    matches = union_all(*branches).subquery()
+    rank = func.row_number().over(
+        partition_by=(matches.c.key, matches.c.goods),
+        order_by=(matches.c.shipping_date.desc(), matches.c.id.desc()),
+    )
+    ranked = select(matches, rank.label('rank')).subquery()
+    first = ranked.c.rank == 1
+    for key, goods, count, total, min_price, max_price, latest_date, latest_id, latest_price in await db.execute(
+        select(
+            ranked.c.key, ranked.c.goods,
+            func.count(), func.sum(ranked.c.price), func.min(ranked.c.price), func.max(ranked.c.price),
+            func.max(case((first, ranked.c.shipping_date))),
+            func.max(case((first, ranked.c.id))),
+            func.max(case((first, ranked.c.price))),
+        ).group_by(ranked.c.key, ranked.c.goods)
+    ):
+        cell = _cell(cells, key, goods)
+        cell.add_stats(count, total, min_price, max_price)
+        cell.add_latest((_to_date(latest_date), latest_id, latest_price))
+
+
+def _clean(values: Optional[Iterable[str]]) -> List[str]:
+    return [value.strip() for value in values or [] if value and value.strip()]
+
+
+async def quote_matrix(locations: Iterable[str], goods_types: Optional[Iterable[str]] = None) -> Dict[str, Any]:
+    """查询目的地 × 货物类型的价格矩阵
+
+    能解析为行政区划代码的目的地：标准货物类型和全部货物的统计读取价格汇总表，
+    最近单价在一条查询中按索引逐个代码查找；其他货物类型和无法解析的目的地需要扫描匹配的运单，
+    同样合并为按 (目的地, 货物类型) 分组的查询。查询次数与目的地和货物类型的数量无关。
+
+    Args:
+        locations: 目的地，空白的目的地被忽略
+        goods_types: 货物类型，为空时只统计全部货物
+
+    Returns:
+        goods_types（矩阵的列）和 rows（每个目的地一行，quotes 与 goods_types 一一对应）
+
+    Raises:
+        ValueError: 没有目的地，或目的地、货物类型超过数量上限
+    """
+    locations = _clean(locations)
+    goods_types = _clean(goods_types)
+    if not locations:
+        raise ValueError("请至少提供一个目的地")
+    if len(locations) > MAX_QUOTE_LOCATIONS:
+        raise ValueError(f"每次最多查询 {MAX_QUOTE_LOCATIONS} 个目的地")
+    if len(goods_types) > MAX_QUOTE_GOODS_TYPES:
+        raise ValueError(f"每次最多查询 {MAX_QUOTE_GOODS_TYPES} 种货物类型")
+
+    goods_keys = [normalize_goods_type(goods_type) for goods_type in goods_types] or [stats_service.ALL_GOODS]
+    unique_goods = list(dict.fromkeys(goods_keys))
+    summarized_goods = [goods_key for goods_key in unique_goods if stats_service.has_price_stats(goods_key)]
+    scanned_goods = [goods_key for goods_key in unique_goods if not stats_service.has_price_stats(goods_key)]
+
+    # 目的地解析为互不包含的行政区划代码，同一运单在一个目的地下只计入一次
+    region_service = get_region_service()
+    location_codes: Dict[str, List[str]] = {}
+    for location in locations:
+        normalized = normalize_location(location)
+        if normalized not in location_codes:
+            location_codes[normalized] = stats_service.top_level_codes(
+                region_service.resolve_codes(normalized, normalize_location))
+    codes = list(dict.fromkeys(code for values in location_codes.values() for code in values))
+    names = [name for name, values in location_codes.items() if not values and name]
+
+    code_cells: Cells = {}
+    name_cells: Cells = {}
+    async with AsyncSessionLocal() as db:
+        if codes:
+            # 直辖市的区县和县级市的代码记在 city_code 中，每个代码都要在三列中查找
+            codes_table = _codes_table(codes)
+            if summarized_goods:
+                await _collect_price_stats(db, codes, summarized_goods, code_cells)
+                await _collect_latest(db, [
+                    _latest_branch(codes_table, column, goods_key)
+                    for column in REGION_CODE_COLUMNS for goods_key in summarized_goods
+                ], code_cells)
+            if scanned_goods:
+                await _collect_scan(db, [
+                    _scan_branch(column, goods_key, column.in_(select(codes_table.c.code)))
+                    for column in REGION_CODE_COLUMNS for goods_key in scanned_goods
+                ], code_cells)
+        branches = [
+            _scan_branch(literal(name), goods_key, location_condition(name, []))
+            for name in names for goods_key in unique_goods
+        ]
+        for start in range(0, len(branches), QUOTE_BRANCHES_PER_QUERY):
+            await _collect_scan(db, branches[start:start + QUOTE_BRANCHES_PER_QUERY], name_cells)
+
+    rows = []
+    for location in locations:
+        normalized = normalize_location(location)
+        codes = location_codes[normalized]
+        quotes = []
+        for goods_key in goods_keys:
+            cell = QuoteCell()
+            parts = [code_cells.get((code, goods_key)) for code in codes] if codes \
+                else [name_cells.get((normalized, goods_key))]
+            for part in parts:
+                if part is not None:
+                    cell.merge(part)
+            quotes.append(cell.to_dict())
+        rows.append({'location': location, 'quotes': quotes})
+    return {'goods_types': goods_types or [stats_service.ALL_GOODS], 'rows': rows}
+
+
+def _sheet_rows(data: bytes, filename: str) -> List[List[Any]]:
+    if filename.endswith('.csv'):
+        text = data.decode('utf-8-sig')
+        return [row for row in csv.reader(io.StringIO(text))]
+    from openpyxl import load_workbook
+    workbook = load_workbook(io.BytesIO(data), read_only=True, data_only=True)
+    try:
+        return [list(row) for row in workbook.worksheets[0].iter_rows(values_only=True)]
+    finally:
+        workbook.close()
+
+
+def read_locations(data: bytes, filename: str) -> List[str]:
+    """从上传的表格中读取目的地
+
+    第一个工作表中找到列名为“目的地”“地址”等的列时读取该列下方的单元格，否则读取第一列。
+
+    Raises:
+        ValueError: 格式不支持、文件过大或无法读取
+    """
+    if not filename.endswith(QUOTE_SHEET_SUFFIXES):
+        raise ValueError(f"只支持 {' 或 '.join(QUOTE_SHEET_SUFFIXES)} 格式的文件")
+    if len(data) > MAX_QUOTE_SHEET_BYTES:
+        raise ValueError(f"文件超过 {MAX_QUOTE_SHEET_BYTES // (1024 * 1024)} MB")
+    try:
+        rows = _sheet_rows(data, filename)
+    except Exception as e:
+        raise ValueError(f"表格读取失败: {str(e)}") from e
+
+    column = 0
+    start = 0
+    for index, row in enumerate(rows):
+        headers = [str(value).strip() if value is not None else '' for value in row]
+        matched = [position for position, header in enumerate(headers) if header in LOCATION_HEADERS]
+        if matched:
+            column = matched[0]
+            start = index + 1
+            break
+    return [
+        str(row[column]).strip() for row in rows[start:]
+        if column < len(row) and row[column] is not None and str(row[column]).strip()
+    ]
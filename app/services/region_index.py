@@ -0,0 +1,321 @@
+"""
+行政区划索引
+
+从 china.db 构建地址解析使用的内存索引，并读写索引快照。只依赖标准库，
+下载行政区划数据后不需要安装应用的其他依赖即可生成快照：
+
+    python -m app.services.region_index
+"""
+import marshal
+import mmap
+import os
+import sqlite3
+import struct
+from collections import deque
+from contextlib import closing
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+# 直辖市
+MUNICIPALITIES = ['北京市', '上海市', '天津市', '重庆市']
+
+# 行政区划数据库路径
+DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data")
+CHINA_DB_PATH = os.path.join(DATA_DIR, "china.db")
+# 行政区划索引快照路径（下载数据后由 build_snapshot 生成），启动时直接加载，不再从 china.db 重建索引
+REGION_SNAPSHOT_PATH = os.getenv("REGION_SNAPSHOT_PATH", os.path.join(DATA_DIR, "china.snapshot"))
+
+# 快照格式版本，索引结构变化时递增，旧版本的快照会被忽略并重建
+SNAPSHOT_VERSION = 2
+SNAPSHOT_MAGIC = b'LFRS'
+# 快照文件头：标识、格式版本、生成快照时 china.db 的大小和修改时间（纳秒）
+_SNAPSHOT_HEADER = struct.Struct('<4sIqq')
+# 快照内容用 marshal 序列化，只包含字典、列表、元组和字符串，加载时不会执行任何代码；
+# 固定格式版本，不同 Python 版本写入的快照可以互相读取
+_SNAPSHOT_MARSHAL_VERSION = 4
+# 保存到快照中的索引
+SNAPSHOT_FIELDS = (
+    'provinces', 'municipalities', '_city_names', 'jiangsu_cities', 'jiangsu_county_cities',
+    '_province_prefix', '_jiangsu_city_prefix', '_jiangsu_county_prefix',
+    '_cities', '_cities_stripped', '_areas', '_municipal_districts', '_county_cities',
+    '_regions', '_matcher',
+)
+
+# 作用域索引：匹配模式 -> (原始顺序, 名称, 值)
+ScopeIndex = Dict[str, Tuple[int, str, object]]
+
+
+class PatternMatcher:
+    """Aho-Corasick 多模式匹配器
+
+    一次扫描地址即可找出其中出现的所有地名（全称及去后缀的简称），
+    代替逐个地名做子串判断。
+    """
+    def __init__(self, patterns: Iterable[str]):
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._output: List[Tuple[str, ...]] = [()]
+        self._match_empty = False
+        for pattern in patterns:
+            self._add(pattern)
+        self._build()
+
+    def to_state(self) -> Tuple[Any, ...]:
+        """匹配器的状态转移表，只包含基本类型，用于写入快照"""
+        return self._goto, self._fail, self._output, self._match_empty
+
+    @classmethod
+    def from_state(cls, state: Tuple[Any, ...]) -> "PatternMatcher":
+        """从 to_state 的结果恢复匹配器，不重新构建字典树"""
+        matcher = cls.__new__(cls)
+        matcher._goto, matcher._fail, matcher._output, matcher._match_empty = state
+        return matcher
+
+    def _add(self, pattern: str):
+        """把一个模式加入字典树"""
+        if not pattern:
+            # 空串是任何地址的子串
+            self._match_empty = True
+            return
+        node = 0
+        for ch in pattern:
+            child = self._goto[node].get(ch)
+            if child is None:
+                child = len(self._goto)
+                self._goto[node][ch] = child
+                self._goto.append({})
+                self._fail.append(0)
+                self._output.append(())
+            node = child
+        if pattern not in self._output[node]:
+            self._output[node] += (pattern,)
+
+    def _build(self):
+        """按层次遍历构建失败指针，并合并输出"""
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for ch, child in self._goto[node].items():
+                queue.append(child)
+                fail = self._fail[node]
+                while fail and ch not in self._goto[fail]:
+                    fail = self._fail[fail]
+                target = self._goto[fail].get(ch, 0)
+                self._fail[child] = target if target != child else 0
+                self._output[child] += self._output[self._fail[child]]
+
+    def find_all(self, text: str) -> Set[str]:
+        """返回 text 中出现的所有模式"""
+        found = {''} if self._match_empty else set()
+        goto, fail, output = self._goto, self._fail, self._output
+        node = 0
+        for ch in text:
+            while node and ch not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(ch, 0)
+            if output[node]:
+                found.update(output[node])
+        return found
+
+
+def _build_scope(entries: Iterable[Tuple[str, object]], strip: Optional[str] = None) -> ScopeIndex:
+    """构建一个作用域索引
+
+    entries 按数据库返回顺序给出 (名称, 值)，去重语义与 ``{name: value}`` 字典推导一致：
+    位置取第一次出现，值取最后一次出现。strip 不为空时使用去掉后缀的名称作为匹配模式，
+    由于去后缀名称总是全称的前缀，"全称或简称出现在地址中" 等价于 "简称出现在地址中"。
+    """
+    ordered = {}
+    for name, value in entries:
+        ordered[name] = value
+    index: ScopeIndex = {}
+    for rank, (name, value) in enumerate(ordered.items()):
+        pattern = name.rstrip(strip) if strip else name
+        if pattern not in index:
+            index[pattern] = (rank, name, value)
+    return index
+
+
+def _build_prefix(items: Iterable[Tuple[str, str]]) -> Dict[str, Tuple[str, str]]:
+    """按名称前两个字建立索引，保留第一个匹配项"""
+    index = {}
+    for name, code in items:
+        if len(name) >= 2:
+            index.setdefault(name[:2], (name, code))
+    return index
+
+
+def load_rows(db_path: str = CHINA_DB_PATH):
+    """一次性读取省、市、区县三张表"""
+    with closing(sqlite3.connect(db_path)) as conn:
+        provinces = conn.execute("SELECT code, name FROM province").fetchall()
+        cities = conn.execute("SELECT code, name, provinceCode FROM city").fetchall()
+        areas = conn.execute("SELECT code, name, cityCode, provinceCode FROM area").fetchall()
+    return provinces, cities, areas
+
+
+def build_indexes(province_rows, city_rows, area_rows) -> Dict[str, Any]:
+    """根据省、市、区县数据构建地址解析使用的内存索引
+
+    Returns:
+        RegionService 的属性名到索引的映射，键与 SNAPSHOT_FIELDS 一致
+    """
+    # 所有省份
+    provinces = {name: code for code, name in province_rows}
+
+    # 所有直辖市
+    municipalities = {}
+    for name, code in provinces.items():
+        if name in MUNICIPALITIES:
+            municipalities[name] = code
+
+    jiangsu_codes = {code for code, name in province_rows if name == '江苏省'}
+    city_province = {}
+    city_names = {}
+    cities_by_province: Dict[str, List[Tuple[str, str]]] = {}
+    for code, name, province_code in city_rows:
+        city_province.setdefault(code, province_code)
+        city_names.setdefault(code, name)
+        cities_by_province.setdefault(province_code, []).append((name, code))
+
+    # 江苏省的城市（地级市）
+    jiangsu_cities = {
+        name: code for code, name, province_code in city_rows if province_code in jiangsu_codes
+    }
+
+    areas_by_city: Dict[str, List[Tuple[str, str]]] = {}
+    areas_by_province: Dict[str, List[Tuple[str, str]]] = {}
+    areas_by_city_province: Dict[str, List[Tuple[str, Tuple[str, str]]]] = {}
+    jiangsu_county_items = []
+    for code, name, city_code, province_code in area_rows:
+        areas_by_city.setdefault(city_code, []).append((name, code))
+        areas_by_province.setdefault(province_code, []).append((name, code))
+        # 只保留能关联到城市的区县（与 JOIN city 的语义一致）
+        if city_code in city_province:
+            city_province_code = city_province[city_code]
+            areas_by_city_province.setdefault(city_province_code, []).append((name, (code, city_code)))
+            if city_province_code in jiangsu_codes and name.endswith('市'):
+                jiangsu_county_items.append((name, code))
+
+    # 江苏省的县级市
+    jiangsu_county_cities = dict(jiangsu_county_items)
+
+    # 前缀索引
+    province_prefix = _build_prefix(provinces.items())
+    jiangsu_city_prefix = _build_prefix(jiangsu_cities.items())
+    jiangsu_county_prefix = _build_prefix(jiangsu_county_cities.items())
+
+    # 作用域索引
+    cities = {code: _build_scope(items) for code, items in cities_by_province.items()}
+    cities_stripped = {code: _build_scope(items, '市') for code, items in cities_by_province.items()}
+    areas = {code: _build_scope(items) for code, items in areas_by_city.items()}
+    municipal_districts = {
+        code: _build_scope(areas_by_province.get(code, []), '区县') for code in municipalities.values()
+    }
+    county_cities = {
+        code: _build_scope([item for item in items if item[0].endswith('市')], '市')
+        for code, items in areas_by_city_province.items()
+    }
+
+    # 所有地名，用于把查询关键字解析为行政区划代码
+    regions = (
+        [(code, name) for code, name in province_rows]
+        + [(code, name) for code, name, _ in city_rows]
+        + [(code, name) for code, name, _, _ in area_rows]
+    )
+
+    patterns = set()
+    for scopes in (cities, cities_stripped, areas, municipal_districts, county_cities):
+        for index in scopes.values():
+            patterns.update(index)
+    matcher = PatternMatcher(patterns)
+
+    return {
+        'provinces': provinces,
+        'municipalities': municipalities,
+        '_city_names': city_names,
+        'jiangsu_cities': jiangsu_cities,
+        'jiangsu_county_cities': jiangsu_county_cities,
+        '_province_prefix': province_prefix,
+        '_jiangsu_city_prefix': jiangsu_city_prefix,
+        '_jiangsu_county_prefix': jiangsu_county_prefix,
+        '_cities': cities,
+        '_cities_stripped': cities_stripped,
+        '_areas': areas,
+        '_municipal_districts': municipal_districts,
+        '_county_cities': county_cities,
+        '_regions': regions,
+        '_matcher': matcher,
+    }
+
+
+def _source_signature(db_path: str) -> Tuple[int, int]:
+    """china.db 的大小和修改时间，用于判断快照是否过期"""
+    stat = os.stat(db_path)
+    return stat.st_size, stat.st_mtime_ns
+
+
+def read_snapshot(snapshot_path: str, db_path: str) -> Optional[Dict[str, Any]]:
+    """通过内存映射读取行政区划索引快照
+
+    Returns:
+        索引，格式见 build_indexes；快照不存在、格式版本不符或 china.db 在生成快照后有变化时返回 None
+    """
+    try:
+        with open(snapshot_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            magic, version, size, mtime = _SNAPSHOT_HEADER.unpack_from(data)
+            if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+                print(f"行政区划快照版本不符，将从数据库构建索引: {snapshot_path}")
+                return None
+            if os.path.exists(db_path) and (size, mtime) != _source_signature(db_path):
+                print(f"行政区划数据已更新，将从数据库构建索引，请重新生成快照: {snapshot_path}")
+                return None
+            with memoryview(data)[_SNAPSHOT_HEADER.size:] as payload:
+                state = marshal.loads(payload)
+        if not isinstance(state, dict) or any(name not in state for name in SNAPSHOT_FIELDS):
+            print(f"行政区划快照内容不完整，将从数据库构建索引: {snapshot_path}")
+            return None
+        state['_matcher'] = PatternMatcher.from_state(state['_matcher'])
+        return state
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        print(f"读取行政区划快照失败: {str(e)}")
+        return None
+
+
+def write_snapshot(snapshot_path: str, db_path: str, indexes: Dict[str, Any]) -> bool:
+    """写入行政区划索引快照（先写临时文件再替换，多个进程同时写入也不会读到半个文件）
+
+    Args:
+        snapshot_path: 快照路径
+        db_path: 构建索引使用的 china.db，记录其大小和修改时间用于判断快照是否过期
+        indexes: 索引，格式见 build_indexes
+    """
+    state = {name: indexes[name] for name in SNAPSHOT_FIELDS}
+    state['_matcher'] = indexes['_matcher'].to_state()
+    size, mtime = _source_signature(db_path)
+    temp_path = f"{snapshot_path}.{os.getpid()}.tmp"
+    try:
+        with open(temp_path, 'wb') as f:
+            f.write(_SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, size, mtime))
+            marshal.dump(state, f, _SNAPSHOT_MARSHAL_VERSION)
+        os.replace(temp_path, snapshot_path)
+        return True
+    except (OSError, ValueError) as e:
+        print(f"写入行政区划快照失败: {str(e)}")
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        return False
+
+
+def build_snapshot(snapshot_path: str = REGION_SNAPSHOT_PATH, db_path: str = CHINA_DB_PATH) -> bool:
+    """从 china.db 重新构建索引并写入快照（下载行政区划数据后由 download_data.sh 调用）"""
+    return write_snapshot(snapshot_path, db_path, build_indexes(*load_rows(db_path)))
+
+
+if __name__ == '__main__':
+    if not build_snapshot():
+        raise SystemExit(1)
+    print(f"已生成行政区划快照: {REGION_SNAPSHOT_PATH}")
@@ -1,296 +1,308 @@
 """RegionService 模块：提供行政区划相关服务。"""
-import sqlite3
 import os
-from typing import Dict, Optional, Tuple
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set, Tuple
+from . import parallel
+from .cache import LRUCache
+from .region_index import (
+    CHINA_DB_PATH, MUNICIPALITIES, REGION_SNAPSHOT_PATH, ScopeIndex, build_indexes, load_rows, read_snapshot,
+)
+from .startup import startup_timer
+
+# 地址解析结果的字段
+ADDRESS_FIELDS = ('province', 'city', 'area', 'province_code', 'city_code', 'area_code')
+
+# 地址解析结果缓存的最大条目数
+ADDRESS_CACHE_SIZE = int(os.getenv("ADDRESS_CACHE_SIZE", "50000"))
+
+
+def _first_match(index: Optional[ScopeIndex], found: Set[str]) -> Optional[Tuple[str, object]]:
+    """返回作用域中按原始顺序第一个出现在地址中的地名"""
+    if not index:
+        return None
+    best = None
+    for pattern in found:
+        entry = index.get(pattern)
+        if entry is not None and (best is None or entry[0] < best[0]):
+            best = entry
+    if best is None:
+        return None
+    return best[1], best[2]
+
+
+def normalize_address(address: Any) -> str:
+    """标准化地址：转为字符串并去掉首尾空白"""
+    return str(address).strip()
+
 
 class RegionService:
-    """行政区划服务类。"""
-    def __init__(self):
-        # 获取当前文件所在目录
-        base_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    """行政区划服务类。
+
+    Args:
+        cache_size: 地址解析结果缓存的最大条目数
+        snapshot_path: 索引快照路径，为 None 时总是从 china.db 构建索引
+    """
+    def __init__(self, cache_size: int = ADDRESS_CACHE_SIZE, snapshot_path: Optional[str] = REGION_SNAPSHOT_PATH):
         # 行政区划数据库路径
-        self.db_path = os.path.join(base_dir, "data", "china.db")
-        self.conn = sqlite3.connect(self.db_path)
-        self.conn.row_factory = sqlite3.Row
-        self.cursor = self.conn.cursor()
+        self.db_path = CHINA_DB_PATH
+        self.snapshot_path = snapshot_path
         # 初始化缓存
+        started = time.perf_counter()
         self._init_cache()
+        startup_timer.record('region_index', time.perf_counter() - started)
+        # 地址解析结果的 LRU 缓存，在多次上传之间共享
+        self._cache = LRUCache(cache_size)
 
     def _init_cache(self):
-        """初始化缓存，加载所有省份和直辖市"""
-        # 加载所有省份
-        self.cursor.execute("SELECT code, name FROM province")
-        self.provinces = {row['name']: row['code'] for row in self.cursor.fetchall()}
-
-        # 加载所有直辖市（假设直辖市在province表中）
-        self.municipalities = {}
-        for name, code in self.provinces.items():
-            if name in ['北京市', '上海市', '天津市', '重庆市']:
-                self.municipalities[name] = code
-
-        # 加载江苏省的城市（包括地级市和县级市）
-        self.cursor.execute("""
-            SELECT c.code, c.name 
-            FROM city c
-            JOIN province p ON c.provinceCode = p.code
-            WHERE p.name = '江苏省'
-        """)
-        self.jiangsu_cities = {row['name']: row['code'] for row in self.cursor.fetchall()}
-
-        # 加载江苏省的县级市
-        self.cursor.execute("""
-            SELECT a.code, a.name 
-            FROM area a
-            JOIN city c ON a.cityCode = c.code
-            JOIN province p ON c.provinceCode = p.code
-            WHERE p.name = '江苏省' AND a.name LIKE '%市'
-        """)
-        self.jiangsu_county_cities = {row['name']: row['code'] for row in self.cursor.fetchall()}
+        """初始化缓存，把整个行政区划层级加载到内存索引中
+
+        优先加载快照；快照不可用时从 china.db 构建索引。快照只由 region_index.build_snapshot 写入，
+        服务进程不会改动数据目录。
+        """
+        indexes = read_snapshot(self.snapshot_path, self.db_path) if self.snapshot_path else None
+        if indexes is None:
+            indexes = build_indexes(*load_rows(self.db_path))
+        for name, value in indexes.items():
+            setattr(self, name, value)
+        self._code_indexes = {}
 
     def find_province(self, address: str) -> Optional[Tuple[str, str]]:
         """查找省份或直辖市
-        
+
         Args:
             address: 地址字符串
-            
+
         Returns:
             如果找到，返回 (省份名称, 省份代码)，否则返回 None
         """
         # 检查前两个字是否匹配省份
         if len(address) >= 2:
-            prefix = address[:2]
-            for province_name, province_code in self.provinces.items():
-                if province_name.startswith(prefix):
-                    return (province_name, province_code)
+            province = self._province_prefix.get(address[:2])
+            if province:
+                return province
 
         # 检查是否匹配直辖市
         for city_name, city_code in self.municipalities.items():
             if address.startswith(city_name):
                 return (city_name, city_code)
 
-        # 检查是否是江苏省的城市（地级市）
-        if len(address) >= 2:
-            prefix = address[:2]
-            for city_name, city_code in self.jiangsu_cities.items():
-                if city_name.startswith(prefix):
-                    return ("江苏省", self.provinces["江苏省"])
-
-        # 检查是否是江苏省的县级市
+        # 检查是否是江苏省的城市（地级市）或县级市
         if len(address) >= 2:
             prefix = address[:2]
-            for city_name, city_code in self.jiangsu_county_cities.items():
-                if city_name.startswith(prefix):
-                    return ("江苏省", self.provinces["江苏省"])
+            if prefix in self._jiangsu_city_prefix or prefix in self._jiangsu_county_prefix:
+                return ("江苏省", self.provinces["江苏省"])
 
         return None
 
     def find_city(self, address: str, province_code: str) -> Optional[Tuple[str, str]]:
         """查找城市
-        
+
         Args:
             address: 地址字符串
             province_code: 省份代码
-            
+
         Returns:
             如果找到，返回 (城市名称, 城市代码)，否则返回 None
         """
-        # 获取该省份下的所有城市
-        self.cursor.execute("""
-            SELECT code, name FROM city 
-            WHERE provinceCode = ?
-        """, (province_code,))
-        cities = {row['name']: row['code'] for row in self.cursor.fetchall()}
-        
-        # 检查地址中是否包含城市名
-        for city_name, city_code in cities.items():
-            if city_name in address:
-                return (city_name, city_code)
-        
-        return None
-    
+        return _first_match(self._cities.get(province_code), self._matcher.find_all(address))
+
     def find_district(self, address: str, city_code: str) -> Optional[Tuple[str, str]]:
         """查找区县
-        
+
         Args:
             address: 地址字符串
             city_code: 城市代码
-            
+
         Returns:
             如果找到，返回 (区县名称, 区县代码)，否则返回 None
         """
-        # 获取该城市下的所有区县
-        self.cursor.execute("""
-            SELECT code, name FROM area 
-            WHERE cityCode = ?
-        """, (city_code,))
-        districts = {row['name']: row['code'] for row in self.cursor.fetchall()}
-        
-        # 检查地址中是否包含区县名
-        for district_name, district_code in districts.items():
-            if district_name in address:
-                return (district_name, district_code)
-        
-        return None
-    
+        return self.find_area(address, city_code)
+
     def parse_address(self, address: str) -> Dict[str, str]:
         """解析地址，返回省市区信息
-        
+
         Args:
             address: 地址字符串
-            
+
         Returns:
-            包含 province, city, area 的字典
+            包含 province, city, area 及对应代码 province_code, city_code, area_code 的字典，
+            代码与名称一一对应（直辖市的区县与名称一样记在 city_code 中）
         """
-        result = {
-            'province': '',
-            'city': '',
-            'area': ''
-        }
-        
+        result = dict.fromkeys(ADDRESS_FIELDS, '')
+
         # 查找省份
         province_info = self.find_province(address)
-        if province_info:
-            province_name, province_code = province_info
-            result['province'] = province_name
-            
-            # 如果是直辖市，特殊处理
-            if province_name in ['北京市', '上海市', '天津市', '重庆市']:
-                # 获取该直辖市下的所有区
-                self.cursor.execute("""
-                    SELECT code, name FROM area 
-                    WHERE provinceCode = ?
-                """, (province_code,))
-                districts = {row['name']: row['code'] for row in self.cursor.fetchall()}
-                
-                # 检查地址中是否包含区名（考虑带后缀和不带后缀的情况）
-                for district_name, district_code in districts.items():
-                    # 去掉后缀后的名称
-                    base_name = district_name.rstrip('区县')
-                    if district_name in address or base_name in address:
-                        result['city'] = district_name
-                        break
-            # 如果是江苏省，使用特殊逻辑
-            elif province_name == "江苏省":
-                # 先检查是否是地级市
-                city_found = False
-                if len(address) >= 2:
-                    prefix = address[:2]
-                    for city_name, city_code in self.jiangsu_cities.items():
-                        # 去掉后缀后的名称
-                        base_name = city_name.rstrip('市')
-                        if city_name.startswith(prefix) or base_name.startswith(prefix):
-                            result['city'] = city_name
-                            city_found = True
-                            break
-
-                # 如果不是地级市，检查是否是县级市
-                if not city_found and len(address) >= 2:
-                    prefix = address[:2]
-                    for city_name, city_code in self.jiangsu_county_cities.items():
-                        # 去掉后缀后的名称
-                        base_name = city_name.rstrip('市')
-                        if city_name.startswith(prefix) or base_name.startswith(prefix):
-                            result['city'] = city_name
-                            city_found = True
-                            break
-
-                # 如果找到了城市，查找区县
-                if city_found:
-                    # 获取城市代码
-                    city_code = None
-                    for name, code in self.jiangsu_cities.items():
-                        if name == result['city']:
-                            city_code = code
-                            break
-
-                    if not city_code:
-                        for name, code in self.jiangsu_county_cities.items():
-                            if name == result['city']:
-                                city_code = code
-                                break
-
-                    if city_code:
-                        # 查找区县
-                        area_info = self.find_area(address, city_code)
-                        if area_info:
-                            area_name, _ = area_info
-                            result['area'] = area_name
-            # 对于其他省份
-            else:
-                # 获取该省份下的所有城市（地级市）
-                self.cursor.execute("""
-                    SELECT code, name FROM city 
-                    WHERE provinceCode = ?
-                """, (province_code,))
-                cities = {row['name']: row['code'] for row in self.cursor.fetchall()}
-
-                # 获取该省份下的所有区县
-                self.cursor.execute("""
-                    SELECT a.code, a.name, a.cityCode 
-                    FROM area a
-                    JOIN city c ON a.cityCode = c.code
-                    WHERE c.provinceCode = ?
-                """, (province_code,))
-                areas = {row['name']: (row['code'], row['cityCode']) for row in self.cursor.fetchall()}
-
-                # 先尝试匹配地级市
-                city_found = False
-                for city_name, city_code in cities.items():
-                    # 去掉后缀后的名称
-                    base_name = city_name.rstrip('市')
-                    if city_name in address or base_name in address:
-                        result['city'] = city_name
-                        city_found = True
-                        # 查找该地级市下的区县
-                        area_info = self.find_area(address, city_code)
-                        if area_info:
-                            area_name, _ = area_info
-                            result['area'] = area_name
-                        break
+        if not province_info:
+            return result
+
+        province_name, province_code = province_info
+        result['province'] = province_name
+        result['province_code'] = province_code
+        # 地址中出现的所有地名（全称和简称）
+        found = self._matcher.find_all(address)
 
+        # 如果是直辖市，特殊处理
+        if province_name in MUNICIPALITIES:
+            # 检查地址中是否包含区名（考虑带后缀和不带后缀的情况）
+            district_info = _first_match(self._municipal_districts.get(province_code), found)
+            if district_info:
+                result['city'], result['city_code'] = district_info
+        # 如果是江苏省，使用特殊逻辑
+        elif province_name == "江苏省":
+            # 先检查是否是地级市，再检查是否是县级市
+            city_info = None
+            if len(address) >= 2:
+                prefix = address[:2]
+                city_info = self._jiangsu_city_prefix.get(prefix) or self._jiangsu_county_prefix.get(prefix)
+
+            # 如果找到了城市，查找区县
+            if city_info:
+                city_name, city_code = city_info
+                result['city'] = city_name
+                result['city_code'] = city_code
+                if city_code:
+                    area_info = _first_match(self._areas.get(city_code), found)
+                    if area_info:
+                        result['area'], result['area_code'] = area_info
+        # 对于其他省份
+        else:
+            # 先尝试匹配地级市
+            city_info = _first_match(self._cities_stripped.get(province_code), found)
+            if city_info:
+                city_name, city_code = city_info
+                result['city'] = city_name
+                result['city_code'] = city_code
+                # 查找该地级市下的区县
+                area_info = _first_match(self._areas.get(city_code), found)
+                if area_info:
+                    result['area'], result['area_code'] = area_info
+            else:
                 # 如果没有找到地级市，检查是否是县级市
-                if not city_found:
-                    for area_name, (area_code, city_code) in areas.items():
-                        # 去掉后缀后的名称
-                        base_name = area_name.rstrip('市')
-                        if (area_name.endswith('市') and (area_name in address or base_name in address)):
-                            # 获取该县级市所属的地级市
-                            self.cursor.execute("""
-                                SELECT name FROM city WHERE code = ?
-                            """, (city_code,))
-                            city_row = self.cursor.fetchone()
-                            if city_row:
-                                result['city'] = city_row['name']
-                                result['area'] = area_name
-                            break
+                county_info = _first_match(self._county_cities.get(province_code), found)
+                if county_info:
+                    area_name, (area_code, city_code) = county_info
+                    # 获取该县级市所属的地级市
+                    if city_code in self._city_names:
+                        result['city'] = self._city_names[city_code]
+                        result['city_code'] = city_code
+                        result['area'] = area_name
+                        result['area_code'] = area_code
 
         return result
 
+    def parse_addresses(self, addresses: Iterable[Any]) -> List[Dict[str, str]]:
+        """批量解析地址
+
+        先标准化并去重，每个不同的地址只解析一次（并经过 LRU 缓存），
+        再按输入顺序展开结果。未命中缓存的地址较多且开启了并行模式时，
+        分片交给多个进程解析。
+
+        Args:
+            addresses: 地址序列
+
+        Returns:
+            与输入一一对应的地址解析结果列表，见 parse_address
+        """
+        normalized = [normalize_address(address) for address in addresses]
+        resolved = {}
+        missing = []
+        for address in dict.fromkeys(normalized):
+            cached = self._cache.get(address)
+            if cached is None:
+                missing.append(address)
+            else:
+                resolved[address] = cached
+
+        if missing:
+            if parallel.should_parallelize(len(missing)):
+                results = [
+                    dict(zip(ADDRESS_FIELDS, values))
+                    for values in parallel.map_shards(parse_address_shard, missing)
+                ]
+            else:
+                results = [self.parse_address(address) for address in missing]
+            for address, result in zip(missing, results):
+                self._cache.put(address, result)
+                resolved[address] = result
+
+        # 返回副本，避免调用方修改缓存中的结果
+        return [dict(resolved[address]) for address in normalized]
+
+    def resolve_codes(self, keyword: str, normalize: Callable[[str], str]) -> List[str]:
+        """把查询关键字解析为行政区划代码
+
+        地名经过 normalize 标准化后与关键字完全相同即视为匹配，可能匹配到多个地区
+        （如多个 "朝阳区"）。省、市、区县代码长度不同，可以直接与任一级代码比较。
+
+        Args:
+            keyword: 已标准化的查询关键字
+            normalize: 标准化函数，与处理关键字时使用的相同
+
+        Returns:
+            匹配的代码列表，没有匹配时返回空列表
+        """
+        if not keyword:
+            return []
+        index = self._code_indexes.get(normalize)
+        if index is None:
+            index = {}
+            for code, name in self._regions:
+                key = normalize(name)
+                if key:
+                    index.setdefault(key, []).append(code)
+            self._code_indexes[normalize] = index
+        return list(dict.fromkeys(index.get(keyword, [])))
+
+    def regions(self) -> List[Tuple[str, str]]:
+        """所有地区的 (代码, 名称)，依次为省、市、区县"""
+        return list(self._regions)
+
+    def cache_info(self) -> Dict[str, int]:
+        """返回地址解析缓存的命中统计"""
+        return self._cache.info()
+
+    def cache_clear(self):
+        """清空地址解析缓存"""
+        self._cache.clear()
+
     def find_area(self, address: str, city_code: str) -> Optional[Tuple[str, str]]:
         """查找区县
-        
+
         Args:
             address: 地址字符串
             city_code: 城市代码
-            
+
         Returns:
             如果找到，返回 (区县名称, 区县代码)，否则返回 None
         """
-        # 获取该城市下的所有区县
-        self.cursor.execute("""
-            SELECT code, name FROM area 
-            WHERE cityCode = ?
-        """, (city_code,))
-        areas = {row['name']: row['code'] for row in self.cursor.fetchall()}
-
-        # 检查地址中是否包含区县名
-        for area_name, area_code in areas.items():
-            if area_name in address:
-                return (area_name, area_code)
+        return _first_match(self._areas.get(city_code), self._matcher.find_all(address))
+
+
+# 并行模式下子进程中使用的地址解析服务（每个进程各自持有一份只读的行政区划索引）
+_shard_service: Optional[RegionService] = None
+
+
+def parse_address_shard(addresses: List[str]) -> List[Tuple[str, ...]]:
+    """在子进程中解析一个分片的地址，按 ADDRESS_FIELDS 的顺序返回元组以减少进程间传输"""
+    global _shard_service
+    if _shard_service is None:
+        _shard_service = RegionService(cache_size=0)
+    results = []
+    for address in addresses:
+        result = _shard_service.parse_address(address)
+        results.append(tuple(result[field] for field in ADDRESS_FIELDS))
+    return results
+
+
+_region_service: Optional[RegionService] = None
+_region_service_lock = threading.Lock()
 
-        return None
 
-    def __del__(self):
-        """关闭数据库连接"""
-        if hasattr(self, 'conn'):
-            self.conn.close() 
\ No newline at end of file
+def get_region_service() -> RegionService:
+    """返回共享的地址解析服务实例"""
+    global _region_service
+    with _region_service_lock:
+        if _region_service is None:
+            _region_service = RegionService()
+        return _region_service
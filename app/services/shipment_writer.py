@@ -0,0 +1,267 @@
+"""
+运单批量写入服务
+"""
+import hashlib
+import math
+import os
+from typing import Any, Dict, Iterable, List, Set, Tuple
+from sqlalchemy import insert, select, update
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from ..database import SessionLocal, SearchTerm, Shipment, ShipmentItem
+from .cache import data_generation
+from .goods_service import get_goods_classifier
+from .region_service import get_region_service
+from .stats_service import update_price_stats
+from .suggest_service import record_shipments
+from .write_queue import write_queue
+
+# 每批写入数据库的行数
+INGEST_CHUNK_SIZE = int(os.getenv("INGEST_CHUNK_SIZE", "5000"))
+
+# 运单表的字段
+SHIPMENT_FIELDS = (
+    'shipping_date', 'raw_address', 'province', 'city', 'area',
+    'total_price', 'quantity', 'unit', 'raw_goods',
+    'province_code', 'city_code', 'area_code', 'fingerprint',
+)
+# 加入搜索词典的运单字段
+SHIPMENT_TERM_FIELDS = ('province', 'city', 'area', 'raw_goods')
+# 每次查询已有指纹的数量
+FINGERPRINT_BATCH_SIZE = int(os.getenv("FINGERPRINT_BATCH_SIZE", "5000"))
+
+def content_digest(shipping_date, raw_address: str, raw_goods: str, quantity: int, total_price) -> str:
+    """按标准化后的日期、地址、货物、件数和价格计算行内容摘要
+
+    导入时和根据数据库中已有运单计算的结果一致：价格缺失（NaN 在数据库中存为 NULL）统一记为空。
+    """
+    if total_price is None or math.isnan(total_price):
+        price = ''
+    else:
+        price = repr(float(total_price))
+    content = '\x1f'.join((shipping_date.isoformat(), str(raw_address), str(raw_goods), str(int(quantity)), price))
+    return hashlib.blake2b(content.encode('utf-8'), digest_size=16).hexdigest()
+
+def next_fingerprint(digest: str, occurrences: Dict[str, int]) -> str:
+    """生成行指纹：内容摘要加上相同内容在本次导入中的出现序号
+
+    同一张表中内容完全相同的多行是不同的运单，按序号区分；
+    再次导入同一张表时，各行得到的指纹与上次相同。
+    """
+    occurrence = occurrences.get(digest, 0) + 1
+    occurrences[digest] = occurrence
+    return f"{digest}-{occurrence}"
+
+def find_existing_fingerprints(fingerprints: Iterable[str], batch_size: int = FINGERPRINT_BATCH_SIZE) -> Set[str]:
+    """分批查询已经导入过的指纹"""
+    fingerprints = list(fingerprints)
+    batch_size = max(1, batch_size)
+    existing = set()
+    session = SessionLocal()
+    try:
+        for start in range(0, len(fingerprints), batch_size):
+            existing.update(session.execute(
+                select(Shipment.fingerprint).where(Shipment.fingerprint.in_(fingerprints[start:start + batch_size]))
+            ).scalars())
+    finally:
+        session.close()
+    return existing
+
+def write_chunk(session, records: List[Dict[str, Any]]) -> Tuple[List[Dict[str, Any]], int]:
+    """在当前事务中批量插入一批运单及其货物项
+
+    运单使用 executemany 形式的 INSERT ... RETURNING 一次取回全部 id，
+    不再逐行 flush。同时把新出现的地区和货物名称加入搜索词典，并更新价格汇总表。
+
+    直接对表执行 Core INSERT：ORM 批量插入会省略值为 None 的列，并按列组合把记录拆成很多小批次。
+    插入带有 ON CONFLICT(fingerprint) DO NOTHING：导入前的去重检查与写入不在同一事务中，
+    其他任务在两者之间写入的相同运单在这里跳过，只为实际插入的运单写入货物项和汇总。
+
+    Args:
+        session: 数据库会话
+        records: 运单记录，除运单字段外还包含 goods_types 列表
+
+    Returns:
+        (实际插入的运单记录, 插入的货物项数量)
+    """
+    table = Shipment.__table__
+    shipment_ids = dict(session.execute(
+        sqlite_insert(table).on_conflict_do_nothing(index_elements=[table.c.fingerprint])
+        .returning(table.c.fingerprint, table.c.id),
+        [{field: record[field] for field in SHIPMENT_FIELDS} for record in records],
+    ).all())
+    if len(shipment_ids) < len(records):
+        records = [record for record in records if record['fingerprint'] in shipment_ids]
+
+    # 为每个货物类型创建发货项目记录
+    classifier = get_goods_classifier()
+    items = []
+    for record in records:
+        shipment_id = shipment_ids[record['fingerprint']]
+        goods_types = record['goods_types']
+        for goods_type in goods_types:
+            items.append({
+                'shipment_id': shipment_id,
+                'goods_type': goods_type,
+                'goods_type_id': classifier.type_id(goods_type),
+                'quantity': record['quantity'] // len(goods_types),  # 平均分配数量
+            })
+    if items:
+        session.execute(insert(ShipmentItem.__table__), items)
+
+    # 在同一事务中更新搜索词典
+    terms = {
+        (field, record[field])
+        for record in records for field in SHIPMENT_TERM_FIELDS if record[field] is not None
+    }
+    terms.update(('goods_type', item['goods_type']) for item in items if item['goods_type'] is not None)
+    if terms:
+        session.execute(
+            insert(SearchTerm.__table__).prefix_with("OR IGNORE"),
+            [{'field': field, 'value': value} for field, value in terms],
+        )
+    update_price_stats(session, records)
+    return records, len(items)
+
+def commit_chunk(records: List[Dict[str, Any]]) -> Tuple[List[Dict[str, Any]], int]:
+    """在一个事务中写入一批运单并提交，失败时回滚并抛出异常
+
+    Returns:
+        (实际插入的运单记录, 插入的货物项数量)
+    """
+    session = SessionLocal()
+    try:
+        inserted, item_count = write_chunk(session, records)
+        data_generation.bump(session)
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+    record_shipments(inserted)
+    return inserted, item_count
+
+def write_shipments(records: List[Dict[str, Any]], chunk_size: int = INGEST_CHUNK_SIZE) -> Dict[str, Any]:
+    """分批写入运单，每批单独提交
+
+    每批的事务交给写入队列执行，与其他导入任务和数据补充串行写入数据库。
+    某一批写入失败时只回滚该批，并在结果中记录，其余批次照常写入。
+
+    Args:
+        records: 运单记录列表
+        chunk_size: 每批的行数
+
+    Returns:
+        写入结果：inserted（写入的运单数）、duplicates（写入时发现已存在而跳过的运单数）、
+        items（写入的货物项数）、failed_chunks（失败的批次）
+    """
+    chunk_size = max(1, chunk_size)
+    report = {'inserted': 0, 'duplicates': 0, 'items': 0, 'failed_chunks': []}
+    for start in range(0, len(records), chunk_size):
+        chunk = records[start:start + chunk_size]
+        try:
+            inserted, item_count = write_queue.run(commit_chunk, chunk)
+            report['inserted'] += len(inserted)
+            report['duplicates'] += len(chunk) - len(inserted)
+            report['items'] += item_count
+        except Exception as e:
+            print(f"写入第 {start + 1}-{start + len(chunk)} 条数据时出错: {str(e)}")
+            report['failed_chunks'].append({
+                'start': start,
+                'rows': len(chunk),
+                'error': str(e),
+            })
+    return report
+
+def backfill_region_codes(batch_size: int = INGEST_CHUNK_SIZE) -> int:
+    """为缺少行政区划代码的历史运单补充代码
+
+    按 id 分批重新解析原始地址，每批单独提交。
+
+    Returns:
+        更新的运单数
+    """
+    updated = 0
+    last_id = 0
+    while True:
+        session = SessionLocal()
+        try:
+            rows = session.execute(
+                select(Shipment.id, Shipment.raw_address)
+                .where(Shipment.province_code.is_(None), Shipment.id > last_id)
+                .order_by(Shipment.id)
+                .limit(batch_size)
+            ).all()
+            if not rows:
+                break
+            address_infos = get_region_service().parse_addresses(row.raw_address for row in rows)
+            session.execute(update(Shipment), [
+                {
+                    'id': row.id,
+                    'province_code': address_info['province_code'],
+                    'city_code': address_info['city_code'],
+                    'area_code': address_info['area_code'],
+                }
+                for row, address_info in zip(rows, address_infos)
+            ])
+            data_generation.bump(session)
+            session.commit()
+            updated += len(rows)
+            last_id = rows[-1].id
+        except Exception as e:
+            session.rollback()
+            print(f"补充行政区划代码失败: {str(e)}")
+            break
+        finally:
+            session.close()
+    if updated:
+        print(f"已为 {updated} 条运单补充行政区划代码")
+    return updated
+
+def backfill_fingerprints(batch_size: int = INGEST_CHUNK_SIZE) -> int:
+    """为没有指纹的历史运单补充指纹
+
+    按行内容排序读取，内容相同的行按 id 顺序编号，与导入同一张表时生成的指纹一致，
+    之后再次上传这些数据时会被识别为重复。所有更新在一个事务中提交。
+
+    Returns:
+        更新的运单数
+    """
+    columns = (Shipment.shipping_date, Shipment.raw_address, Shipment.raw_goods,
+               Shipment.quantity, Shipment.total_price)
+    updated = 0
+    session = SessionLocal()
+    try:
+        rows = session.execute(
+            select(Shipment.id, *columns)
+            .where(Shipment.fingerprint.is_(None))
+            .order_by(*columns, Shipment.id)
+            .execution_options(yield_per=batch_size)
+        )
+        previous = None
+        occurrences: Dict[str, int] = {}
+        batch = []
+        for row in rows:
+            digest = content_digest(*row[1:])
+            # 按内容排序后相同的行相邻，只需保留当前内容的计数
+            if digest != previous:
+                occurrences.clear()
+                previous = digest
+            batch.append({'id': row.id, 'fingerprint': next_fingerprint(digest, occurrences)})
+            if len(batch) >= batch_size:
+                session.execute(update(Shipment), batch)
+                updated += len(batch)
+                batch = []
+        if batch:
+            session.execute(update(Shipment), batch)
+            updated += len(batch)
+        session.commit()
+    except Exception as e:
+        session.rollback()
+        print(f"补充运单指纹失败: {str(e)}")
+        return 0
+    finally:
+        session.close()
+    if updated:
+        print(f"已为 {updated} 条运单补充指纹")
+    return updated
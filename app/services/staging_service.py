@@ -0,0 +1,156 @@
+"""
+上传文件暂存服务
+
+上传的 Excel 文件原样保存在暂存目录中等待解析。所有状态都保存在文件系统中，
+多个工作进程共用同一个目录，进程内存占用与等待解析的上传数量无关。
+"""
+import os
+import re
+import tempfile
+import threading
+import time
+import uuid
+from typing import Dict, List, Optional, Tuple
+
+# 暂存目录
+UPLOAD_SPOOL_DIR = os.getenv("UPLOAD_SPOOL_DIR", os.path.join(tempfile.gettempdir(), "logistics_uploads"))
+# 暂存文件的总字节数上限，超出时淘汰最早上传的文件
+STAGING_MAX_BYTES = int(os.getenv("STAGING_MAX_BYTES", str(1024 * 1024 * 1024)))
+# 暂存文件的有效秒数，过期未解析的文件会被删除
+STAGING_TTL = float(os.getenv("STAGING_TTL", "86400"))
+
+# 允许上传的文件后缀
+UPLOAD_SUFFIXES = ('.xlsx', '.xls')
+# 正在写入的文件后缀
+PARTIAL_SUFFIX = '.partial'
+# 已被解析任务取走的文件所在的子目录
+CLAIMED_DIR = 'claimed'
+
+_UPLOAD_ID = re.compile(r'[0-9a-f]{32}')
+
+
+class StagingFull(Exception):
+    """上传的文件超过暂存区容量"""
+
+
+class StagingStore:
+    """磁盘暂存区
+
+    Args:
+        directory: 暂存目录
+        max_bytes: 暂存文件的总字节数上限
+        ttl: 暂存文件的有效秒数
+    """
+    def __init__(self, directory: str, max_bytes: int, ttl: float):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._lock = threading.Lock()
+
+    def new_upload(self, suffix: str) -> Tuple[str, str]:
+        """为新上传的文件分配 id 和写入路径
+
+        Returns:
+            (上传 id, 写入路径)，写完后调用 commit 或 discard
+        """
+        os.makedirs(os.path.join(self.directory, CLAIMED_DIR), exist_ok=True)
+        upload_id = uuid.uuid4().hex
+        return upload_id, os.path.join(self.directory, f"{upload_id}{suffix}{PARTIAL_SUFFIX}")
+
+    def check_size(self, size: int):
+        """写入过程中检查文件大小，超过容量时抛出 StagingFull"""
+        if size > self.max_bytes:
+            raise StagingFull(f"上传的文件超过 {self.max_bytes} 字节")
+
+    def commit(self, partial_path: str):
+        """写入完成，文件进入暂存区，并按容量和有效期淘汰旧文件"""
+        path = partial_path[:-len(PARTIAL_SUFFIX)]
+        os.replace(partial_path, path)
+        self.evict(keep=path)
+
+    def discard(self, path: str):
+        """删除文件"""
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def claim(self, upload_id: str) -> Optional[str]:
+        """取走一个暂存的文件交给解析任务
+
+        通过原子重命名移入 claimed 子目录，多个进程同时取同一个文件时只有一个成功。
+        取走的文件不再参与淘汰，由解析任务负责删除。
+
+        Returns:
+            文件的新路径，文件不存在、已被取走或已淘汰时返回 None
+        """
+        if not _UPLOAD_ID.fullmatch(upload_id):
+            return None
+        for suffix in UPLOAD_SUFFIXES:
+            name = f"{upload_id}{suffix}"
+            claimed = os.path.join(self.directory, CLAIMED_DIR, name)
+            try:
+                os.replace(os.path.join(self.directory, name), claimed)
+                return claimed
+            except FileNotFoundError:
+                continue
+        return None
+
+    def _entries(self) -> List[Tuple[float, int, str]]:
+        """暂存目录中的文件：(修改时间, 字节数, 路径)"""
+        entries = []
+        try:
+            with os.scandir(self.directory) as it:
+                for entry in it:
+                    if not entry.is_file():
+                        continue
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+        except FileNotFoundError:
+            pass
+        return entries
+
+    def evict(self, keep: Optional[str] = None) -> int:
+        """删除过期的文件，总大小超过上限时按上传时间从早到晚删除
+
+        Args:
+            keep: 不删除的文件（刚上传的文件）
+
+        Returns:
+            删除的文件数
+        """
+        with self._lock:
+            entries = sorted(self._entries())
+            now = time.time()
+            removed = 0
+            total = sum(size for _, size, path in entries if not path.endswith(PARTIAL_SUFFIX))
+            for mtime, size, path in entries:
+                if path == keep:
+                    continue
+                partial = path.endswith(PARTIAL_SUFFIX)
+                expired = now - mtime > self.ttl
+                # 正在写入的文件只在过期（上传中断）时删除，不计入总大小
+                if not expired and (partial or total <= self.max_bytes):
+                    continue
+                self.discard(path)
+                removed += 1
+                if not partial:
+                    total -= size
+            if removed:
+                print(f"已从暂存区删除 {removed} 个文件")
+            return removed
+
+    def info(self) -> Dict[str, int]:
+        """返回暂存区的文件数和总字节数（不含正在写入和已被取走的文件）"""
+        entries = [(size, path) for _, size, path in self._entries() if not path.endswith(PARTIAL_SUFFIX)]
+        return {
+            'files': len(entries),
+            'bytes': sum(size for size, _ in entries),
+            'max_bytes': self.max_bytes,
+        }
+
+
+staging_store = StagingStore(UPLOAD_SPOOL_DIR, STAGING_MAX_BYTES, STAGING_TTL)
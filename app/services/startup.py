@@ -0,0 +1,73 @@
+"""
+启动耗时统计
+
+记录从进程启动到各个阶段完成（导入模块、初始化数据库、开始接收请求、完成第一次查询）的时间，
+以及加载行政区划索引等步骤的耗时，用于跟踪重启和扩容时多久能开始提供查询服务。
+"""
+import os
+import threading
+import time
+from typing import Dict
+
+
+def _process_started() -> float:
+    """进程的启动时间（Unix 时间戳），无法从 /proc 读取时使用本模块的导入时间"""
+    try:
+        with open('/proc/self/stat') as f:
+            # 进程名可能包含空格，从最后一个右括号之后开始按空格拆分，启动时间（开机后的时钟数）是第 22 个字段
+            fields = f.read().rsplit(')', 1)[1].split()
+        with open('/proc/uptime') as f:
+            uptime = float(f.read().split()[0])
+        age = uptime - int(fields[19]) / os.sysconf('SC_CLK_TCK')
+        return time.time() - max(0.0, age)
+    except (OSError, ValueError, IndexError, AttributeError):
+        return time.time()
+
+
+class StartupTimer:
+    """启动耗时
+
+    Args:
+        started: 进程的启动时间（Unix 时间戳）
+    """
+    def __init__(self, started: float):
+        self.started = started
+        # 各阶段完成时距进程启动的秒数
+        self._phases: Dict[str, float] = {}
+        # 各步骤的耗时（秒）
+        self._steps: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def mark(self, phase: str) -> bool:
+        """记录某个阶段完成，每个阶段只记录第一次
+
+        Returns:
+            是否为第一次记录
+        """
+        if phase in self._phases:
+            return False
+        with self._lock:
+            if phase in self._phases:
+                return False
+            self._phases[phase] = time.time() - self.started
+        return True
+
+    def record(self, step: str, seconds: float):
+        """记录某个步骤的耗时，只保留第一次（启动时）的结果"""
+        with self._lock:
+            self._steps.setdefault(step, seconds)
+
+    def report(self) -> Dict[str, Dict[str, float]]:
+        """返回启动耗时报告"""
+        with self._lock:
+            return {'phases': dict(self._phases), 'steps': dict(self._steps)}
+
+    def summary(self) -> str:
+        """一行文字的启动耗时报告"""
+        report = self.report()
+        parts = [f"{phase} {seconds:.3f}s" for phase, seconds in report['phases'].items()]
+        parts += [f"{step} 耗时 {seconds * 1000:.1f}ms" for step, seconds in report['steps'].items()]
+        return "启动耗时: " + ", ".join(parts)
+
+
+startup_timer = StartupTimer(_process_started())
@@ -0,0 +1,409 @@
+"""
+价格汇总服务
+
+按（行政区划代码，货物类型）维护单价的累计统计，导入时在同一事务中增量更新，
+查询时直接读取汇总行，耗时与运单数量无关。
+"""
+import json
+import math
+import sys
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+from sqlalchemy import delete, func, select, tuple_
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from ..database import SessionLocal, PriceStat, Shipment, ShipmentItem
+from .cache import data_generation
+from .goods_service import get_goods_classifier
+
+# 分位数草图的相对误差
+SKETCH_ACCURACY = 0.01
+# 表示全部货物的汇总键
+ALL_GOODS = ''
+# 每次读取的汇总键数（每个键占两个 SQL 参数）
+KEY_BATCH_SIZE = 400
+# 重建汇总时每批读取的运单数
+REBUILD_BATCH_SIZE = 5000
+# 无法使用汇总表时，每批读入分位数草图的单价数
+STATS_STREAM_BATCH_SIZE = 5000
+
+_GAMMA = (1 + SKETCH_ACCURACY) / (1 - SKETCH_ACCURACY)
+_LOG_GAMMA = math.log(_GAMMA)
+
+
+class QuantileSketch:
+    """可合并的分位数草图（DDSketch）
+
+    按对数分桶计数，估计的分位数与真实值的相对误差不超过 SKETCH_ACCURACY。
+    两个草图合并只需把桶计数相加，桶数与数值范围的对数成正比。
+    """
+    def __init__(self, positive: Optional[Dict[int, int]] = None,
+                 negative: Optional[Dict[int, int]] = None, zeros: int = 0):
+        self.positive = positive or {}
+        self.negative = negative or {}
+        self.zeros = zeros
+
+    @property
+    def count(self) -> int:
+        return sum(self.positive.values()) + sum(self.negative.values()) + self.zeros
+
+    def add(self, value: float):
+        """加入一个数值"""
+        if value == 0:
+            self.zeros += 1
+            return
+        bins = self.positive if value > 0 else self.negative
+        index = math.ceil(math.log(abs(value)) / _LOG_GAMMA)
+        bins[index] = bins.get(index, 0) + 1
+
+    def merge(self, other: "QuantileSketch"):
+        """合并另一个草图"""
+        for bins, other_bins in ((self.positive, other.positive), (self.negative, other.negative)):
+            for index, count in other_bins.items():
+                bins[index] = bins.get(index, 0) + count
+        self.zeros += other.zeros
+
+    def quantile(self, q: float) -> Optional[float]:
+        """估计第 q 分位数（0 <= q <= 1），草图为空时返回 None"""
+        total = self.count
+        if total == 0:
+            return None
+        rank = q * (total - 1)
+        seen = 0
+        # 按数值从小到大依次遍历负数桶、零和正数桶
+        for index in sorted(self.negative, reverse=True):
+            seen += self.negative[index]
+            if seen > rank:
+                return -self._bin_value(index)
+        seen += self.zeros
+        if seen > rank:
+            return 0.0
+        for index in sorted(self.positive):
+            seen += self.positive[index]
+            if seen > rank:
+                return self._bin_value(index)
+        return self._bin_value(max(self.positive))
+
+    @staticmethod
+    def _bin_value(index: int) -> float:
+        """桶的代表值，保证相对误差不超过 SKETCH_ACCURACY"""
+        return 2 * _GAMMA ** index / (_GAMMA + 1)
+
+    def to_json(self) -> str:
+        return json.dumps({'p': self.positive, 'n': self.negative, 'z': self.zeros}, separators=(',', ':'))
+
+    @classmethod
+    def from_json(cls, text: Optional[str]) -> "QuantileSketch":
+        if not text:
+            return cls()
+        data = json.loads(text)
+        return cls(
+            {int(index): count for index, count in data.get('p', {}).items()},
+            {int(index): count for index, count in data.get('n', {}).items()},
+            data.get('z', 0),
+        )
+
+
+class PriceAggregate:
+    """一组单价的可合并统计：数量、总和、平方和、最小值、最大值和分位数草图"""
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.total_sq = 0.0
+        self.min_price: Optional[float] = None
+        self.max_price: Optional[float] = None
+        self.sketch = QuantileSketch()
+
+    def add(self, price: float):
+        self.count += 1
+        self.total += price
+        self.total_sq += price * price
+        self.min_price = price if self.min_price is None else min(self.min_price, price)
+        self.max_price = price if self.max_price is None else max(self.max_price, price)
+        self.sketch.add(price)
+
+    def merge(self, other: "PriceAggregate"):
+        if other.count == 0:
+            return
+        self.count += other.count
+        self.total += other.total
+        self.total_sq += other.total_sq
+        for value in (other.min_price, other.max_price):
+            self.min_price = value if self.min_price is None else min(self.min_price, value)
+            self.max_price = value if self.max_price is None else max(self.max_price, value)
+        self.sketch.merge(other.sketch)
+
+    @classmethod
+    def from_row(cls, row: PriceStat) -> "PriceAggregate":
+        aggregate = cls()
+        aggregate.count = row.count
+        aggregate.total = row.total
+        aggregate.total_sq = row.total_sq
+        aggregate.min_price = row.min_price
+        aggregate.max_price = row.max_price
+        aggregate.sketch = QuantileSketch.from_json(row.sketch)
+        return aggregate
+
+    def to_row(self, region_code: str, goods_type: str) -> Dict[str, Any]:
+        return {
+            'region_code': region_code,
+            'goods_type': goods_type,
+            'count': self.count,
+            'total': self.total,
+            'total_sq': self.total_sq,
+            'min_price': self.min_price,
+            'max_price': self.max_price,
+            'sketch': self.sketch.to_json(),
+        }
+
+    def _quantile(self, q: float) -> float:
+        """估计分位数，并限制在最小值和最大值之间"""
+        return min(max(self.sketch.quantile(q), self.min_price), self.max_price)
+
+    def to_stats(self) -> Dict[str, Any]:
+        """转换为 /search 返回的统计信息"""
+        if self.count == 0:
+            return {'average': 0, 'min': 0, 'max': 0, 'count': 0, 'median': 0, 'p90': 0, 'stddev': 0}
+        average = self.total / self.count
+        variance = max(self.total_sq / self.count - average * average, 0.0)
+        return {
+            'average': average,
+            'min': self.min_price,
+            'max': self.max_price,
+            'count': self.count,
+            'median': self._quantile(0.5),
+            'p90': self._quantile(0.9),
+            'stddev': math.sqrt(variance),
+        }
+
+
+def unit_price(total_price: Optional[float], quantity: Optional[int]) -> Optional[float]:
+    """计算单价，价格缺失或件数为 0 时返回 None"""
+    if total_price is None or not quantity:
+        return None
+    price = total_price / quantity
+    return price if math.isfinite(price) else None
+
+
+def _stat_keys(record: Dict[str, Any], goods_types: Iterable[str]) -> List[Tuple[str, str]]:
+    """一条运单计入的所有汇总键"""
+    codes = {record[field] for field in ('province_code', 'city_code', 'area_code') if record[field]}
+    goods_keys = {ALL_GOODS}
+    # 只有标准货物类型单独汇总，其他货物只计入“全部货物”
+    classifier = get_goods_classifier()
+    goods_keys.update(goods_type for goods_type in goods_types if classifier.is_category(goods_type))
+    return [(code, goods_key) for code in codes for goods_key in goods_keys]
+
+
+def aggregate_records(records: Iterable[Dict[str, Any]],
+                      into: Optional[Dict[Tuple[str, str], PriceAggregate]] = None
+                      ) -> Dict[Tuple[str, str], PriceAggregate]:
+    """把运单记录按汇总键累加
+
+    Args:
+        records: 运单记录，包含 total_price、quantity、行政区划代码和 goods_types
+        into: 在已有的累加结果上继续累加
+
+    Returns:
+        汇总键到统计的映射
+    """
+    aggregates = {} if into is None else into
+    for record in records:
+        price = unit_price(record['total_price'], record['quantity'])
+        if price is None:
+            continue
+        for key in _stat_keys(record, record['goods_types']):
+            aggregate = aggregates.get(key)
+            if aggregate is None:
+                aggregate = aggregates[key] = PriceAggregate()
+            aggregate.add(price)
+    return aggregates
+
+
+def _load_aggregates(session, keys: List[Tuple[str, str]]) -> Dict[Tuple[str, str], PriceAggregate]:
+    """读取已有的汇总行"""
+    loaded = {}
+    for start in range(0, len(keys), KEY_BATCH_SIZE):
+        rows = session.execute(
+            select(PriceStat).where(
+                tuple_(PriceStat.region_code, PriceStat.goods_type).in_(keys[start:start + KEY_BATCH_SIZE])
+            )
+        ).scalars()
+        for row in rows:
+            loaded[(row.region_code, row.goods_type)] = PriceAggregate.from_row(row)
+    return loaded
+
+
+def apply_aggregates(session, aggregates: Dict[Tuple[str, str], PriceAggregate]):
+    """把增量统计合并进汇总表（在调用方的事务中执行）"""
+    if not aggregates:
+        return
+    existing = _load_aggregates(session, list(aggregates))
+    rows = []
+    for key, aggregate in aggregates.items():
+        merged = existing.get(key)
+        if merged is None:
+            merged = aggregate
+        else:
+            merged.merge(aggregate)
+        rows.append(merged.to_row(*key))
+    stmt = insert(PriceStat)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[PriceStat.region_code, PriceStat.goods_type],
+        set_={column: stmt.excluded[column]
+              for column in ('count', 'total', 'total_sq', 'min_price', 'max_price', 'sketch')},
+    )
+    session.execute(stmt, rows)
+
+
+def update_price_stats(session, records: List[Dict[str, Any]]):
+    """导入一批运单时更新汇总表"""
+    apply_aggregates(session, aggregate_records(records))
+
+
+def rebuild_price_stats(session=None, batch_size: int = REBUILD_BATCH_SIZE) -> int:
+    """根据全部运单重新计算汇总表
+
+    先清空汇总表再按 id 分批读取运单。不指定 session 时在新的事务中完成并提交；
+    指定 session 时在调用方的事务中执行，由调用方提交，汇总表与同一事务中的其他修改一起生效。
+
+    Returns:
+        汇总的运单数
+    """
+    if session is not None:
+        return _rebuild_price_stats(session, batch_size)
+    session = SessionLocal()
+    try:
+        count = _rebuild_price_stats(session, batch_size)
+        data_generation.bump(session)
+        session.commit()
+        return count
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+
+def _rebuild_price_stats(session, batch_size: int) -> int:
+    session.execute(delete(PriceStat))
+    aggregates: Dict[Tuple[str, str], PriceAggregate] = {}
+    count = 0
+    last_id = 0
+    while True:
+        rows = session.execute(
+            select(Shipment.id, Shipment.total_price, Shipment.quantity,
+                   Shipment.province_code, Shipment.city_code, Shipment.area_code)
+            .where(Shipment.id > last_id)
+            .order_by(Shipment.id)
+            .limit(batch_size)
+        ).all()
+        if not rows:
+            break
+        goods_types: Dict[int, List[str]] = {}
+        for shipment_id, goods_type in session.execute(
+            select(ShipmentItem.shipment_id, ShipmentItem.goods_type)
+            .where(ShipmentItem.shipment_id.between(rows[0].id, rows[-1].id))
+        ):
+            goods_types.setdefault(shipment_id, []).append(goods_type)
+        aggregate_records(
+            ({**row._asdict(), 'goods_types': goods_types.get(row.id, [])} for row in rows),
+            into=aggregates,
+        )
+        count += len(rows)
+        last_id = rows[-1].id
+    apply_aggregates(session, aggregates)
+    return count
+
+
+def backfill_price_stats() -> int:
+    """汇总表为空而已有运单时重建汇总表
+
+    Returns:
+        汇总的运单数
+    """
+    session = SessionLocal()
+    try:
+        has_stats = session.execute(select(PriceStat.region_code).limit(1)).first() is not None
+        has_shipments = session.execute(select(Shipment.id).limit(1)).first() is not None
+    finally:
+        session.close()
+    if has_stats or not has_shipments:
+        return 0
+    try:
+        count = rebuild_price_stats()
+    except Exception as e:
+        print(f"重建价格汇总失败: {str(e)}")
+        return 0
+    print(f"已根据 {count} 条运单重建价格汇总")
+    return count
+
+
+def top_level_codes(codes: Iterable[str]) -> List[str]:
+    """去掉被其他代码包含的下级代码，避免同一运单被重复统计
+
+    行政区划代码按层级逐段延长，下级代码以上级代码为前缀。
+    """
+    codes = sorted(set(codes), key=len)
+    result: List[str] = []
+    for code in codes:
+        if not any(code.startswith(parent) for parent in result):
+            result.append(code)
+    return result
+
+
+async def get_price_stats(session: AsyncSession, region_codes: Iterable[str], goods_type: str = ALL_GOODS) -> Dict[str, Any]:
+    """读取若干地区合并后的统计信息
+
+    Args:
+        session: 异步数据库会话
+        region_codes: 行政区划代码
+        goods_type: 货物类型，ALL_GOODS 表示全部货物
+
+    Returns:
+        统计信息：average、min、max、count、median、p90、stddev
+    """
+    codes = top_level_codes(region_codes)
+    total = PriceAggregate()
+    if codes:
+        rows = (await session.execute(
+            select(PriceStat).where(PriceStat.region_code.in_(codes), PriceStat.goods_type == goods_type)
+        )).scalars()
+        for row in rows:
+            total.merge(PriceAggregate.from_row(row))
+    return total.to_stats()
+
+
+def has_price_stats(goods_type: str) -> bool:
+    """该货物类型是否有单独的汇总"""
+    return goods_type == ALL_GOODS or get_goods_classifier().is_category(goods_type)
+
+
+async def query_price_stats(session: AsyncSession, shipment_ids) -> Dict[str, Any]:
+    """对任意一组运单直接在数据库中计算统计信息（无法使用汇总表时的后备路径）
+
+    数量、总和、平方和及最值由一条 SQL 聚合查询算出；中位数和 p90 需要分位数草图，
+    只把单价逐批读出加入草图，不在 Python 中重复计算其他统计。
+
+    Args:
+        session: 异步数据库会话
+        shipment_ids: 查询运单 id 的 select 语句
+
+    Returns:
+        与 get_price_stats 相同格式的统计信息
+    """
+    price = Shipment.total_price / Shipment.quantity
+    # 单价为 NULL 或无穷大时不计入
+    conditions = (Shipment.id.in_(shipment_ids), func.abs(price) <= sys.float_info.max)
+    row = (await session.execute(
+        select(func.count(), func.sum(price), func.sum(price * price), func.min(price), func.max(price))
+        .where(*conditions)
+    )).one()
+    total = PriceAggregate()
+    if not row[0]:
+        return total.to_stats()
+    total.count, total.total, total.total_sq, total.min_price, total.max_price = row
+    result = await session.stream(select(price).where(*conditions))
+    async for prices in result.scalars().partitions(STATS_STREAM_BATCH_SIZE):
+        for value in prices:
+            total.sketch.add(value)
+    return total.to_stats()
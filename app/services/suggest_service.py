@@ -0,0 +1,189 @@
+"""
+地点自动补全服务
+
+用行政区划名称构建前缀树，用户每输入一个字就返回以输入内容开头的省、市、区县，
+按各地区的运单数从多到少排列。运单数取自价格汇总表，导入数据时按写入的运单增量更新，
+并定期从数据库重新读取，以包含其他工作进程导入的数据。
+"""
+import heapq
+import os
+import threading
+import time
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+from sqlalchemy import select
+from ..database import AsyncSessionLocal, PriceStat
+from . import stats_service
+from .region_service import get_region_service
+
+# 默认和最多返回的候选数
+SUGGEST_LIMIT = 10
+MAX_SUGGEST_LIMIT = 50
+# 运单数从数据库重新读取的间隔（秒）
+SUGGEST_COUNTS_TTL = float(os.getenv("SUGGEST_COUNTS_TTL", "300"))
+
+# 不作为候选的占位地名（直辖市和省直辖县的“市辖区”“县”等）
+PLACEHOLDER_NAMES = ('市辖区', '县')
+# 代码长度对应的行政级别
+REGION_LEVELS = {2: 'province', 4: 'city', 6: 'area'}
+
+
+def is_placeholder(name: str) -> bool:
+    """是否为不对应实际地区的占位地名"""
+    return name in PLACEHOLDER_NAMES or '直辖' in name
+
+
+class RegionTrie:
+    """地名前缀树
+
+    每个节点保存经过该节点的全部地区编号，查询时沿输入逐字走到对应节点即可得到所有候选，
+    耗时只与输入长度和候选数有关，与地区总数无关。
+
+    Args:
+        names: 地区名称，编号为其在序列中的位置
+    """
+    def __init__(self, names: Iterable[str]):
+        self._children: List[Dict[str, int]] = [{}]
+        self._entries: List[List[int]] = [[]]
+        for region_id, name in enumerate(names):
+            self._add(name, region_id)
+
+    def _add(self, name: str, region_id: int):
+        node = 0
+        for ch in name:
+            child = self._children[node].get(ch)
+            if child is None:
+                child = len(self._children)
+                self._children[node][ch] = child
+                self._children.append({})
+                self._entries.append([])
+            node = child
+            self._entries[node].append(region_id)
+
+    def find(self, prefix: str) -> List[int]:
+        """名称以 prefix 开头的地区编号"""
+        if not prefix:
+            return []
+        node = 0
+        for ch in prefix:
+            node = self._children[node].get(ch)
+            if node is None:
+                return []
+        return self._entries[node]
+
+
+class RegionSuggester:
+    """按运单数排序的地点候选
+
+    Args:
+        regions: 地区的 (代码, 名称)
+        counts_ttl: 运单数从数据库重新读取的间隔（秒）
+    """
+    def __init__(self, regions: Iterable[Tuple[str, str]], counts_ttl: float = SUGGEST_COUNTS_TTL):
+        names = {code: name for code, name in regions}
+        self._regions: List[Dict[str, str]] = []
+        for code, name in names.items():
+            if is_placeholder(name) or len(code) not in REGION_LEVELS:
+                continue
+            # 上级地区按代码前缀查找，跳过“市辖区”等占位名称
+            parents = [names.get(code[:length], '') for length in range(2, len(code), 2)]
+            self._regions.append({
+                'name': name,
+                'code': code,
+                'level': REGION_LEVELS[len(code)],
+                'full_name': ''.join(parent for parent in parents if not is_placeholder(parent)) + name,
+            })
+        self._index = {region['code']: region_id for region_id, region in enumerate(self._regions)}
+        self._trie = RegionTrie(region['name'] for region in self._regions)
+        # 同样的运单数时省、市、区县依次排列
+        self._order = [(len(region['code']), region['code']) for region in self._regions]
+        self._counts = [0] * len(self._regions)
+        self.counts_ttl = counts_ttl
+        self._loaded_at: Optional[float] = None
+        self._lock = threading.Lock()
+
+    @property
+    def stale(self) -> bool:
+        """运单数是否需要从数据库重新读取"""
+        return self._loaded_at is None or time.monotonic() - self._loaded_at >= self.counts_ttl
+
+    def set_counts(self, counts: Dict[str, int]):
+        """替换全部地区的运单数"""
+        values = [0] * len(self._regions)
+        for code, count in counts.items():
+            region_id = self._index.get(code)
+            if region_id is not None:
+                values[region_id] = count
+        with self._lock:
+            self._counts = values
+            self._loaded_at = time.monotonic()
+
+    def add_counts(self, counts: Dict[str, int]):
+        """在现有运单数上累加（导入数据后调用）"""
+        with self._lock:
+            for code, count in counts.items():
+                region_id = self._index.get(code)
+                if region_id is not None:
+                    self._counts[region_id] += count
+
+    def suggest(self, prefix: str, limit: int = SUGGEST_LIMIT) -> List[Dict[str, Any]]:
+        """名称以 prefix 开头的地区，按运单数从多到少排列"""
+        candidates = self._trie.find(prefix.strip())
+        counts, order = self._counts, self._order
+        best = heapq.nsmallest(limit, candidates, key=lambda region_id: (-counts[region_id], order[region_id]))
+        return [{**self._regions[region_id], 'count': counts[region_id]} for region_id in best]
+
+
+async def load_region_counts() -> Dict[str, int]:
+    """从价格汇总表读取各地区（全部货物）的运单数"""
+    async with AsyncSessionLocal() as db:
+        rows = await db.execute(
+            select(PriceStat.region_code, PriceStat.count).where(PriceStat.goods_type == stats_service.ALL_GOODS)
+        )
+        return dict(rows.all())
+
+
+def shipment_counts(records: Iterable[Dict[str, Any]]) -> Dict[str, int]:
+    """一批运单计入各地区的运单数，与价格汇总表的计数方式一致（只计有单价的运单）"""
+    counts: Dict[str, int] = {}
+    for record in records:
+        if stats_service.unit_price(record['total_price'], record['quantity']) is None:
+            continue
+        for code in {record['province_code'], record['city_code'], record['area_code']}:
+            if code:
+                counts[code] = counts.get(code, 0) + 1
+    return counts
+
+
+def record_shipments(records: List[Dict[str, Any]]):
+    """写入的运单提交后更新候选的运单数；候选尚未加载时不需要处理"""
+    if _region_suggester is not None and records:
+        _region_suggester.add_counts(shipment_counts(records))
+
+
+_region_suggester: Optional[RegionSuggester] = None
+_region_suggester_lock = threading.Lock()
+
+
+def get_region_suggester() -> RegionSuggester:
+    """返回共享的地点候选服务"""
+    global _region_suggester
+    with _region_suggester_lock:
+        if _region_suggester is None:
+            _region_suggester = RegionSuggester(get_region_service().regions())
+        return _region_suggester
+
+
+async def suggest_locations(prefix: str, limit: int = SUGGEST_LIMIT) -> List[Dict[str, Any]]:
+    """地点自动补全
+
+    Args:
+        prefix: 用户已输入的内容
+        limit: 最多返回的候选数
+
+    Returns:
+        候选地区：name、code、level（province/city/area）、full_name（带上级地区的全称）、count（运单数）
+    """
+    suggester = get_region_suggester()
+    if suggester.stale:
+        suggester.set_counts(await load_region_counts())
+    return suggester.suggest(prefix, max(1, min(limit, MAX_SUGGEST_LIMIT)))
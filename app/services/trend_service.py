@@ -0,0 +1,187 @@
+"""
+价格趋势服务
+
+按周或按月统计一个地区最近若干个月的单价中位数和 p90。只从数据库读取日期和单价两列，
+沿 (行政区划代码, 日期, id, 价格, 件数) 索引按日期范围读取，不读取整行运单；
+分组和分位数用 NumPy 对整列数组计算，不为每条运单创建 ORM 对象。
+
+NumPy 导入较慢，本模块在第一次查询趋势时才导入。
+"""
+import asyncio
+import os
+from datetime import date
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+import numpy as np
+from sqlalchemy import String, select, type_coerce
+from ..database import Shipment, read_engine
+from . import stats_service
+from .price_service import (
+    REGION_CODE_COLUMNS, goods_condition, location_condition, normalize_goods_type, normalize_location,
+)
+from .region_service import get_region_service
+
+# 默认和最多统计的月数
+TREND_MONTHS = 12
+MAX_TREND_MONTHS = int(os.getenv("MAX_TREND_MONTHS", "120"))
+# 每次最多统计的货物类型数
+MAX_TREND_GOODS_TYPES = 10
+# 统计周期
+TREND_PERIODS = ('week', 'month')
+# 每个周期输出的分位数
+TREND_QUANTILES = {'median': 0.5, 'p90': 0.9}
+
+# 运单的单价（件数为 0 或价格缺失时为 NULL）
+UNIT_PRICE = Shipment.total_price / Shipment.quantity
+# 日期按数据库中的 ISO 字符串读取，由 NumPy 整列解析
+SHIPPING_DATE_TEXT = type_coerce(Shipment.shipping_date, String)
+
+
+def window_start(today: date, months: int, period: str) -> date:
+    """统计的起始日期：包含本月在内最近 months 个月的第一天，按周统计时取所在周的周一"""
+    index = today.year * 12 + today.month - 1 - (months - 1)
+    start = date(index // 12, index % 12 + 1, 1)
+    if period == 'week':
+        start = date.fromordinal(start.toordinal() - start.weekday())
+    return start
+
+
+def bucket_starts(days: np.ndarray, period: str) -> np.ndarray:
+    """每个日期所在周期的第一天（按周统计时为周一）"""
+    if period == 'month':
+        return days.astype('datetime64[M]').astype('datetime64[D]')
+    # 1970-01-01 是星期四，向前 3 天是周一
+    offsets = (days.astype(np.int64) + 3) % 7
+    return days - offsets.astype('timedelta64[D]')
+
+
+def group_stats(keys: np.ndarray, values: np.ndarray,
+                quantiles: Dict[str, float]) -> Tuple[np.ndarray, Dict[str, np.ndarray]]:
+    """按 keys 分组计算数量、平均、最低、最高值和分位数
+
+    先按 (分组, 值) 排序，各组在数组中连续且组内有序，分位数直接按位置线性插值
+    （与 numpy.percentile 的默认方法一致），所有组一次算完。
+
+    排序时先按值排序，再按分组稳定排序；分组的取值范围在 65536 以内时（日期、地区序号等）
+    转为 16 位整数，NumPy 对其使用基数排序，比 numpy.lexsort 快数倍。
+
+    Returns:
+        按顺序排列的分组，以及与之对应的 count、average、min、max 和各分位数数组
+    """
+    order = np.argsort(values)
+    sort_keys = keys[order].astype(np.int64)
+    if len(sort_keys):
+        low = sort_keys.min()
+        if sort_keys.max() - low < 1 << 16:
+            sort_keys = (sort_keys - low).astype(np.uint16)
+    order = order[np.argsort(sort_keys, kind='stable')]
+    keys = keys[order]
+    values = values[order]
+    starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+    counts = np.diff(np.r_[starts, len(values)])
+    stats = {
+        'count': counts,
+        'average': np.add.reduceat(values, starts) / counts,
+        'min': values[starts],
+        'max': values[starts + counts - 1],
+    }
+    for name, q in quantiles.items():
+        position = starts + q * (counts - 1)
+        lower = np.floor(position).astype(np.int64)
+        upper = np.minimum(lower + 1, starts + counts - 1)
+        stats[name] = values[lower] + (values[upper] - values[lower]) * (position - lower)
+    return keys[starts], stats
+
+
+def bucket_stats(days: np.ndarray, prices: np.ndarray, period: str) -> List[Dict[str, Any]]:
+    """按周期分组计算数量、平均、最低、最高单价和分位数"""
+    if len(prices) == 0:
+        return []
+    buckets, stats = group_stats(bucket_starts(days, period), prices, TREND_QUANTILES)
+    columns = {name: values.tolist() for name, values in stats.items()}
+    labels = [str(value) for value in buckets]
+    return [
+        {'start': label, **{name: values[i] for name, values in columns.items()}}
+        for i, label in enumerate(labels)
+    ]
+
+
+def _load_prices(queries: Iterable) -> Tuple[np.ndarray, np.ndarray]:
+    """执行查询，返回日期和单价数组
+
+    使用只读的同步引擎在线程中执行：几万行数据经 aiosqlite 逐批跨线程传递，
+    再逐行包装为 Row 对象，比直接从 DBAPI 游标取出元组慢数倍。
+    """
+    dates: List[str] = []
+    prices: List[float] = []
+    with read_engine.connect() as conn:
+        for query in queries:
+            result = conn.execute(query)
+            try:
+                rows = result.cursor.fetchall()
+            finally:
+                result.close()
+            if rows:
+                day_values, price_values = zip(*rows)
+                dates.extend(day_values)
+                prices.extend(price_values)
+    prices_array = np.array(prices, dtype=np.float64)
+    # 单价为无穷大等异常值时不计入
+    finite = np.isfinite(prices_array)
+    return np.array(dates, dtype='datetime64[D]')[finite], prices_array[finite]
+
+
+def _trend_queries(normalized_location: str, normalized_goods_type: str, start: date) -> List:
+    """日期在 start 之后、匹配地区和货物类型的 (日期, 单价)
+
+    地区解析为行政区划代码时每个代码在每一列上单独查询，沿 (代码, 日期, id, 价格, 件数) 索引只读取时间窗口内的行；
+    代码互不包含，同一运单只会被一条查询取到。
+    """
+    conditions = [SHIPPING_DATE_TEXT >= start.isoformat(), UNIT_PRICE.isnot(None)]
+    goods = goods_condition(normalized_goods_type)
+    if goods is not None:
+        conditions.append(goods)
+    base = select(SHIPPING_DATE_TEXT, UNIT_PRICE)
+    codes = stats_service.top_level_codes(get_region_service().resolve_codes(normalized_location, normalize_location))
+    if codes:
+        return [base.where(column == code, *conditions) for code in codes for column in REGION_CODE_COLUMNS]
+    location = location_condition(normalized_location, codes)
+    if location is not None:
+        conditions.append(location)
+    return [base.where(*conditions)]
+
+
+async def price_trend(location: Optional[str] = None, goods_types: Optional[Iterable[str]] = None,
+                      period: str = 'month', months: int = TREND_MONTHS,
+                      today: Optional[date] = None) -> Dict[str, Any]:
+    """按周或按月统计最近 months 个月的单价趋势
+
+    Args:
+        location: 地点，为空时统计全部运单
+        goods_types: 货物类型，每种单独统计一条趋势；为空时统计全部货物
+        period: week 或 month
+        months: 统计的月数（包含本月）
+        today: 当前日期，默认为今天
+
+    Returns:
+        period、start（统计的起始日期）和 series（每种货物类型一条，buckets 为各周期的
+        count、average、min、max、median、p90，没有运单的周期不输出）
+
+    Raises:
+        ValueError: 周期、月数或货物类型的数量不正确
+    """
+    if period not in TREND_PERIODS:
+        raise ValueError(f"只支持以下统计周期：{', '.join(TREND_PERIODS)}")
+    if not 1 <= months <= MAX_TREND_MONTHS:
+        raise ValueError(f"统计的月数应在 1 到 {MAX_TREND_MONTHS} 之间")
+    goods_types = [goods_type.strip() for goods_type in goods_types or [] if goods_type and goods_type.strip()]
+    if len(goods_types) > MAX_TREND_GOODS_TYPES:
+        raise ValueError(f"每次最多统计 {MAX_TREND_GOODS_TYPES} 种货物类型")
+
+    start = window_start(today or date.today(), months, period)
+    normalized_location = normalize_location(location or '')
+    series = []
+    for goods_type in goods_types or [stats_service.ALL_GOODS]:
+        queries = _trend_queries(normalized_location, normalize_goods_type(goods_type), start)
+        days, prices = await asyncio.to_thread(_load_prices, queries)
+        series.append({'goods_type': goods_type, 'buckets': bucket_stats(days, prices, period)})
+    return {'period': period, 'start': start.isoformat(), 'series': series}
@@ -0,0 +1,54 @@
+"""
+数据库写入队列
+
+SQLite 同一时间只允许一个写事务。导入的每批运单和启动时的数据补充都提交到这里，
+由一个专用线程依次执行：多个导入任务可以同时解析表格，写入时按提交顺序排队，
+不会在数据库锁上互相等待或出现 database is locked。
+"""
+import asyncio
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable
+
+
+class WriteQueue:
+    """在单个线程中依次执行写入操作的队列"""
+    def __init__(self):
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-writer")
+        self._local = threading.local()
+        self._pending = 0
+        self._lock = threading.Lock()
+
+    def _execute(self, func: Callable[..., Any], args, kwargs) -> Any:
+        self._local.active = True
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self._local.active = False
+            with self._lock:
+                self._pending -= 1
+
+    def submit(self, func: Callable[..., Any], *args, **kwargs) -> Future:
+        """把写入操作加入队列，立即返回"""
+        with self._lock:
+            self._pending += 1
+        return self._executor.submit(self._execute, func, args, kwargs)
+
+    def run(self, func: Callable[..., Any], *args, **kwargs) -> Any:
+        """把写入操作加入队列并等待其完成；已在写入线程中时直接执行"""
+        if getattr(self._local, 'active', False):
+            return func(*args, **kwargs)
+        return self.submit(func, *args, **kwargs).result()
+
+    async def run_async(self, func: Callable[..., Any], *args, **kwargs) -> Any:
+        """run 的异步版本，等待期间不阻塞事件循环"""
+        return await asyncio.wrap_future(self.submit(func, *args, **kwargs))
+
+    @property
+    def pending(self) -> int:
+        """排队和正在执行的写入操作数"""
+        with self._lock:
+            return self._pending
+
+
+write_queue = WriteQueue()
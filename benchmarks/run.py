@@ -0,0 +1,312 @@
+"""
+性能基准测试
+
+在临时数据库上依次测量：
+- 地址解析：每个地址的解析微秒数（parse_address 不使用缓存 / parse_addresses 全部命中缓存）
+- 导入：ingest_file 每秒处理的行数，按读取、清洗、去重、地址、货物、写入各阶段拆分
+- 查询：运单表达到不同行数时 /search 接口的 p50、p99 延迟（每次查询都不命中结果缓存）
+
+结果与保存的基准比较，任何指标比基准差超过允许的幅度时以状态码 1 退出。
+基准与机器和行政区划数据相关：测量环境（Python 版本、平台、CPU 数、china.db 的规模）
+或测量参数与基准不同时只打印对照，不判断退化，除非指定 --force。
+仓库中的 baseline.json 是在测试用的小型 china.db（11 个省级、29 个地级、151 个县级行政区）
+和单核机器上测得的，只用于同一环境的回归检查；在正式数据或其他机器上应先用 --save-baseline 重新生成。
+
+用法：
+    python -m benchmarks.run                       # 与 benchmarks/baseline.json 比较
+    python -m benchmarks.run --save-baseline       # 重新生成基准
+    python -m benchmarks.run --sizes 10000,50000,200000 --output result.json
+    python -m benchmarks.run --force               # 环境不同也按基准判断退化
+"""
+import argparse
+import contextlib
+import gc
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from . import workload
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+# 默认的基准文件
+BASELINE_PATH = os.path.join(BENCHMARK_DIR, "baseline.json")
+
+# 运单表依次达到的行数
+DEFAULT_SIZES = (10000, 50000)
+# 地址解析测量的地址数
+PARSE_OPS = 20000
+# 每种表大小下的查询次数
+SEARCH_QUERIES = 200
+# 默认允许的退化幅度（相对基准）
+DEFAULT_TOLERANCE = 0.25
+# 波动较大的指标单独放宽
+TOLERANCES = {
+    'search_p99_ms': 0.5,
+}
+
+# 查询使用的货物类型（None 表示不限；“托盘”不是标准类型，走模糊匹配）
+SEARCH_GOODS = [None, None, '配重', '全电动', '前移', '托盘']
+# 额外查询的不规范地址和不存在的地址
+SEARCH_EXTRA_LOCATIONS = ['北京朝阳', '昆山', '江阴', '上海浦东', '浙江义乌', '火星']
+
+
+def percentile(values: List[float], q: float) -> float:
+    """最近秩法计算分位数"""
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(q * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def lower_is_better(name: str) -> bool:
+    """耗时类指标越小越好，吞吐量类指标越大越好"""
+    return not name.split('@')[0].endswith('_per_sec')
+
+
+def tolerance_of(name: str, default: float) -> float:
+    return TOLERANCES.get(name.split('@')[0], default)
+
+
+def bench_parse_address(ops: int, seed: int) -> Dict[str, float]:
+    """地址解析每次调用的微秒数"""
+    from app.services.region_service import RegionService
+
+    addresses = workload.sample_addresses(ops, seed)
+    metrics = {}
+
+    # 先完成一次完整的垃圾回收，避免生成地址时积累的回收被计入初始化耗时
+    gc.collect()
+    started = time.perf_counter()
+    uncached = RegionService(cache_size=0)
+    metrics['region_service_init_ms'] = (time.perf_counter() - started) * 1000
+
+    started = time.perf_counter()
+    for address in addresses:
+        uncached.parse_address(address)
+    metrics['parse_address_us'] = (time.perf_counter() - started) / len(addresses) * 1e6
+
+    # 导入时使用的批量解析：第一次调用填充缓存，第二次全部命中缓存
+    cached = RegionService()
+    cached.parse_addresses(addresses)
+    started = time.perf_counter()
+    cached.parse_addresses(addresses)
+    metrics['parse_address_cached_us'] = (time.perf_counter() - started) / len(addresses) * 1e6
+    return metrics
+
+
+def bench_ingest(path: str) -> Dict[str, Any]:
+    """导入一个文件，返回导入结果"""
+    from app.services import excel_service
+
+    started = time.perf_counter()
+    # 不输出跳过行的警告
+    with contextlib.redirect_stdout(io.StringIO()):
+        report = excel_service.ingest_file(path)
+    report['elapsed'] = time.perf_counter() - started
+    if report['failed_chunks']:
+        raise RuntimeError(f"导入失败: {report['failed_chunks']}")
+    return report
+
+
+def search_locations(rows: List[List[Any]], count: int, seed: int, sampler: workload.RegionSampler) -> List[str]:
+    """从生成的数据中挑选查询的地点：省、市、区县名称和不规范写法"""
+    from app.services.region_service import get_region_service
+
+    service = get_region_service()
+    rnd = random.Random(seed)
+    names = list(sampler.provinces.values()) + [
+        name for name, _ in sampler.cities.values() if name not in ('市辖区', '县') and '直辖' not in name
+    ]
+    locations = []
+    addresses = [row[3] for row in rows if row[3]]
+    while len(locations) < count:
+        kind = rnd.random()
+        if kind < 0.3:
+            locations.append(rnd.choice(names))
+        elif kind < 0.9:
+            # 取地址中已解析出的区县或城市
+            info = service.parse_address(rnd.choice(addresses))
+            locations.append(info.get('area') or info.get('city') or info.get('province') or '火星')
+        else:
+            locations.append(rnd.choice(SEARCH_EXTRA_LOCATIONS))
+    return locations
+
+
+def bench_search(client, locations: List[str], seed: int) -> Dict[str, float]:
+    """/search 的 p50、p99 延迟（毫秒），每次查询前使结果缓存失效"""
+    from app.services.price_service import _search_cache
+
+    rnd = random.Random(seed)
+    latencies = []
+    for location in locations:
+        params = {'location': location}
+        goods_type = rnd.choice(SEARCH_GOODS)
+        if goods_type:
+            params['goods_type'] = goods_type
+        _search_cache.clear()
+        started = time.perf_counter()
+        response = client.get('/search', params=params)
+        latencies.append((time.perf_counter() - started) * 1000)
+        if response.status_code != 200:
+            raise RuntimeError(f"查询失败: {params} {response.status_code} {response.text}")
+    return {
+        'search_p50_ms': percentile(latencies, 0.5),
+        'search_p99_ms': percentile(latencies, 0.99),
+    }
+
+
+def run_suite(sizes: List[int], parse_ops: int, queries: int, seed: int, workdir: str) -> Dict[str, float]:
+    """执行全部基准测试，返回指标"""
+    metrics: Dict[str, float] = {}
+
+    print("测量地址解析...")
+    metrics.update(bench_parse_address(parse_ops, seed))
+
+    # 应用在导入时读取 DB_PATH，这里才导入
+    from fastapi.testclient import TestClient
+    from app.main import app
+    from app.services import excel_service
+
+    client = TestClient(app)
+    sampler = workload.RegionSampler()
+    stage_seconds = {stage: 0.0 for stage in excel_service.INGEST_STAGES}
+    ingested = 0
+    ingest_seconds = 0.0
+    previous = 0
+    for step, size in enumerate(sorted(sizes)):
+        rows = workload.generate_rows(size - previous, seed + step, sampler)
+        path = os.path.join(workdir, f"workload_{size}.xlsx")
+        workload.write_rows(path, rows)
+        print(f"导入 {size - previous} 行（运单表达到 {size} 行）...")
+        report = bench_ingest(path)
+        ingested += report['rows']
+        ingest_seconds += report['elapsed']
+        for stage, seconds in report['timings'].items():
+            stage_seconds[stage] += seconds
+        previous = size
+
+        print(f"在 {size} 行上查询 {queries} 次...")
+        locations = search_locations(rows, queries, seed + step, sampler)
+        for name, value in bench_search(client, locations, seed + step).items():
+            metrics[f"{name}@{size}"] = value
+
+    metrics['ingest_rows_per_sec'] = ingested / ingest_seconds if ingest_seconds else 0.0
+    for stage, seconds in stage_seconds.items():
+        metrics[f"ingest_{stage}_rows_per_sec"] = ingested / seconds if seconds else 0.0
+    return metrics
+
+
+def compare(metrics: Dict[str, float], baseline: Dict[str, float], tolerance: float
+            ) -> List[Tuple[str, Optional[float], float, Optional[float], bool]]:
+    """与基准比较
+
+    Returns:
+        每个指标的 (名称, 基准值, 当前值, 相对基准的变化, 是否退化)
+    """
+    result = []
+    for name, value in metrics.items():
+        base = baseline.get(name)
+        if not base:
+            result.append((name, base, value, None, False))
+            continue
+        change = (value - base) / base
+        worse = change if lower_is_better(name) else -change
+        result.append((name, base, value, change, worse > tolerance_of(name, tolerance)))
+    return result
+
+
+def environment() -> Dict[str, Any]:
+    """记录测量时的环境（包括行政区划数据的规模），便于判断基准是否可比"""
+    sampler = workload.RegionSampler()
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'machine': platform.machine(),
+        'cpus': os.cpu_count(),
+        'regions': {
+            'provinces': len(sampler.provinces),
+            'cities': len(sampler.cities),
+            'areas': len(sampler.areas),
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="物流价格查询系统性能基准测试")
+    parser.add_argument('--sizes', default=','.join(map(str, DEFAULT_SIZES)), help="运单表依次达到的行数，逗号分隔")
+    parser.add_argument('--parse-ops', type=int, default=PARSE_OPS, help="地址解析测量的地址数")
+    parser.add_argument('--queries', type=int, default=SEARCH_QUERIES, help="每种表大小下的查询次数")
+    parser.add_argument('--seed', type=int, default=0, help="随机种子")
+    parser.add_argument('--baseline', default=BASELINE_PATH, help="基准文件")
+    parser.add_argument('--save-baseline', action='store_true', help="把本次结果保存为基准")
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE, help="允许的退化幅度，如 0.25 表示 25%%")
+    parser.add_argument('--output', help="把本次结果写入 JSON 文件")
+    parser.add_argument('--force', action='store_true', help="测量环境或参数与基准不同时也判断退化")
+    args = parser.parse_args()
+    sizes = [int(size) for size in args.sizes.split(',') if size.strip()]
+
+    workdir = tempfile.mkdtemp(prefix="logistics_bench_")
+    # 使用临时数据库和暂存目录，不影响正式数据
+    os.environ['DB_PATH'] = os.path.join(workdir, "logistics.db")
+    os.environ.setdefault('UPLOAD_SPOOL_DIR', os.path.join(workdir, "uploads"))
+    try:
+        metrics = run_suite(sizes, args.parse_ops, args.queries, args.seed, workdir)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    result = {
+        'environment': environment(),
+        'params': {'sizes': sizes, 'parse_ops': args.parse_ops, 'queries': args.queries, 'seed': args.seed},
+        'metrics': metrics,
+    }
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+
+    if args.save_baseline:
+        with open(args.baseline, 'w', encoding='utf-8') as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+            f.write('\n')
+        for name, value in metrics.items():
+            print(f"{name:36} {value:14.2f}")
+        print(f"已保存基准: {args.baseline}")
+        return 0
+
+    baseline: Dict[str, Any] = {}
+    comparable = True
+    if os.path.exists(args.baseline):
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+        if baseline.get('params') != result['params']:
+            print(f"注意: 基准的参数 {baseline.get('params')} 与本次不同，部分指标不可比")
+            comparable = False
+        if baseline.get('environment') != result['environment']:
+            print(f"注意: 基准的测量环境 {baseline.get('environment')} 与本次不同，结果仅供参考")
+            comparable = False
+    else:
+        print(f"基准文件不存在: {args.baseline}")
+
+    regressions = 0
+    print(f"{'指标':34} {'基准':>12} {'本次':>12} {'变化':>6}")
+    for name, base, value, change, regressed in compare(metrics, baseline.get('metrics', {}), args.tolerance):
+        base_text = f"{base:14.2f}" if base else f"{'-':>14}"
+        change_text = f"{change:+8.1%}" if change is not None else f"{'-':>8}"
+        print(f"{name:36} {base_text} {value:14.2f} {change_text}{'  退化' if regressed else ''}")
+        regressions += regressed
+    if regressions:
+        print(f"{regressions} 个指标比基准差超过允许的幅度")
+        if not comparable and not args.force:
+            print("测量环境或参数与基准不同，不判断退化（使用 --force 强制判断，或用 --save-baseline 重新生成基准）")
+            return 0
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,204 @@
+"""
+合成工作负载生成器
+
+从 china.db 中抽取真实的省、市、区县名称，生成与实际账单相似的 Excel 表格：
+地址中混有省略后缀、直辖市简称、江苏县级市等不规范写法，货物名称包含“+”组合，
+另有少量日期、件数、价格不合法的行。相同的参数和随机种子总是生成相同的数据。
+
+用法：
+    python -m benchmarks.workload output.xlsx --rows 10000 --seed 1
+"""
+import argparse
+import datetime
+import os
+import random
+import sqlite3
+from contextlib import closing
+from typing import Any, Dict, List, Optional
+
+# 行政区划数据库路径
+CHINA_DB_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app", "data", "china.db")
+
+# 表头（第一行是合并单元格标题，第二行是列名）
+TITLE_ROW = ['运单汇总', None, None, None, None, None]
+HEADER_ROW = ['日期', '品名', '件数', '地址', '价格', '备注']
+
+MUNICIPALITIES = ['北京', '上海', '天津', '重庆']
+# 行政区划名称可以省略的后缀
+NAME_SUFFIXES = ('特别行政区', '自治区', '自治州', '自治县', '省', '市', '区', '县', '盟', '旗')
+# 地址末尾的门牌、仓库等信息
+ADDRESS_TAILS = ['', '', '', '工业园', '开发区5号', '路18号', '物流园A仓', '（自提）', ' 张先生 138****0000']
+# 常见的货物名称，部分不属于任何标准货物类型
+GOODS_NAMES = [
+    '全电动叉车', '电动搬运车', '配重式叉车', '平衡重', '前移式叉车', '大金刚', '小金刚',
+    '半电动堆高车', '托盘', '电池', '配件', '手动液压车',
+]
+
+# 各种不规范写法所占比例
+MESSY_RATE = 0.35
+COMBO_RATE = 0.15
+INVALID_RATE = 0.02
+BLANK_RATE = 0.01
+
+# 日期范围
+START_DATE = datetime.date(2023, 1, 1)
+DATE_SPAN_DAYS = 730
+
+
+def strip_suffix(name: str) -> str:
+    """去掉行政区划名称的后缀，去掉后少于两个字时保留原名"""
+    for suffix in NAME_SUFFIXES:
+        if name.endswith(suffix) and len(name) - len(suffix) >= 2:
+            return name[:-len(suffix)]
+    return name
+
+
+class RegionSampler:
+    """从行政区划数据中抽取地址"""
+    def __init__(self, db_path: str = CHINA_DB_PATH):
+        with closing(sqlite3.connect(db_path)) as conn:
+            provinces = dict(conn.execute("SELECT code, name FROM province"))
+            cities = {code: (name, province) for code, name, province
+                      in conn.execute("SELECT code, name, provinceCode FROM city")}
+            self.areas = conn.execute("SELECT name, cityCode, provinceCode FROM area").fetchall()
+        self.provinces = provinces
+        self.cities = cities
+        # 江苏省的县级市（如昆山、江阴），账单中常常不写省和地级市
+        self.jiangsu_cities = [name for name, _, province in self.areas
+                               if province == '32' and name.endswith('市')]
+        # 直辖市的区县，账单中常写作“北京朝阳”
+        self.municipality_areas = {
+            municipality: [name for name, _, province in self.areas
+                           if provinces.get(province, '').startswith(municipality)]
+            for municipality in MUNICIPALITIES
+        }
+
+    def canonical(self, rnd: random.Random) -> str:
+        """规范写法：省 + 市 + 区县"""
+        area, city_code, province_code = rnd.choice(self.areas)
+        city = self.cities.get(city_code, ('', ''))[0]
+        province = self.provinces.get(province_code, '')
+        if city in ('市辖区', '县') or '直辖' in city:
+            city = ''
+        return province + city + area
+
+    def messy(self, rnd: random.Random) -> str:
+        """不规范写法"""
+        kind = rnd.random()
+        if kind < 0.3 and self.jiangsu_cities:
+            # 江苏县级市，常常省略“市”
+            name = rnd.choice(self.jiangsu_cities)
+            return name if rnd.random() < 0.4 else strip_suffix(name)
+        if kind < 0.5:
+            # 直辖市简称 + 区县
+            municipality = rnd.choice(MUNICIPALITIES)
+            areas = self.municipality_areas[municipality]
+            area = rnd.choice(areas) if areas else ''
+            return municipality + (strip_suffix(area) if rnd.random() < 0.5 else area)
+        area, city_code, province_code = rnd.choice(self.areas)
+        city = self.cities.get(city_code, ('', ''))[0]
+        province = self.provinces.get(province_code, '')
+        if kind < 0.8:
+            # 省略后缀
+            return strip_suffix(province) + strip_suffix(city) + strip_suffix(area)
+        # 只写市和区县
+        return city + area
+
+    def address(self, rnd: random.Random) -> str:
+        """随机地址，按 MESSY_RATE 混入不规范写法"""
+        address = self.messy(rnd) if rnd.random() < MESSY_RATE else self.canonical(rnd)
+        return address + rnd.choice(ADDRESS_TAILS)
+
+
+def _goods(rnd: random.Random) -> str:
+    if rnd.random() < COMBO_RATE:
+        return '+'.join(rnd.sample(GOODS_NAMES, rnd.choice((2, 2, 3))))
+    return rnd.choice(GOODS_NAMES)
+
+
+def _date(rnd: random.Random) -> Any:
+    day = START_DATE + datetime.timedelta(days=rnd.randrange(DATE_SPAN_DAYS))
+    kind = rnd.random()
+    if kind < 0.8:
+        return datetime.datetime(day.year, day.month, day.day)
+    if kind < 0.9:
+        return day.strftime('%Y-%m-%d')
+    return day.strftime('%Y/%m/%d')
+
+
+def _quantity(rnd: random.Random) -> Any:
+    quantity = rnd.choice((1, 1, 1, 2, 2, 3, 4, 5, 10))
+    return quantity if rnd.random() < 0.8 else f"{quantity}台"
+
+
+def _price(rnd: random.Random, quantity: Any) -> Any:
+    count = quantity if isinstance(quantity, int) else int(quantity[:-1])
+    return round(rnd.uniform(80, 1500) * count, 1)
+
+
+def _invalid_row(rnd: random.Random, row: List[Any]) -> List[Any]:
+    """把一行改成会被跳过的数据"""
+    column = rnd.choice((0, 1, 2, 3, 4))
+    row[column] = rnd.choice((None, 'abc')) if column in (0, 2, 4) else None
+    return row
+
+
+def generate_rows(rows: int, seed: int = 0, sampler: Optional[RegionSampler] = None) -> List[List[Any]]:
+    """生成数据行（不含标题和表头）"""
+    rnd = random.Random(seed)
+    sampler = sampler or RegionSampler()
+    result = []
+    for _ in range(rows):
+        if rnd.random() < BLANK_RATE:
+            result.append([None] * len(HEADER_ROW))
+            continue
+        quantity = _quantity(rnd)
+        row = [_date(rnd), _goods(rnd), quantity, sampler.address(rnd), _price(rnd, quantity), None]
+        if rnd.random() < INVALID_RATE:
+            row = _invalid_row(rnd, row)
+        result.append(row)
+    return result
+
+
+def write_rows(path: str, rows: List[List[Any]]):
+    """把数据行连同标题和表头写入 .xlsx 文件"""
+    from openpyxl import Workbook
+
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet()
+    sheet.append(TITLE_ROW)
+    sheet.append(HEADER_ROW)
+    for row in rows:
+        sheet.append(row)
+    workbook.save(path)
+
+
+def write_workbook(path: str, rows: int, seed: int = 0, sampler: Optional[RegionSampler] = None) -> Dict[str, Any]:
+    """生成合成账单并写入 .xlsx 文件
+
+    Returns:
+        文件信息：路径、行数、随机种子、字节数
+    """
+    write_rows(path, generate_rows(rows, seed, sampler))
+    return {'path': path, 'rows': rows, 'seed': seed, 'bytes': os.path.getsize(path)}
+
+
+def sample_addresses(count: int, seed: int = 0, sampler: Optional[RegionSampler] = None) -> List[str]:
+    """生成地址列表，用于单独测量地址解析"""
+    rnd = random.Random(seed)
+    sampler = sampler or RegionSampler()
+    return [sampler.address(rnd) for _ in range(count)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="生成合成物流账单")
+    parser.add_argument('output', help="输出的 .xlsx 文件")
+    parser.add_argument('--rows', type=int, default=10000, help="数据行数")
+    parser.add_argument('--seed', type=int, default=0, help="随机种子")
+    args = parser.parse_args()
+    info = write_workbook(args.output, args.rows, args.seed)
+    print(f"已生成 {info['rows']} 行数据: {info['path']} ({info['bytes']} 字节)")
+
+
+if __name__ == '__main__':
+    main()